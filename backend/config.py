@@ -14,12 +14,24 @@ class Settings(BaseSettings):
     google_api_key: str
     google_cloud_project: str
     firestore_database: str = "(default)"
+    firestore_pool_size: int = 4  # Firestore clients (gRPC channels) used round-robin
     gcs_bucket: Optional[str] = None
+    gcs_pool_size: int = 64  # pooled HTTP connections shared by all GCS calls
+    gcs_list_cache_ttl: int = 5  # seconds a file listing is reused; 0 disables
+    gcs_info_cache_ttl: int = 5  # seconds file metadata (and existence) is reused; 0 disables
+    gcs_public_cache_max_age: int = 300  # Cache-Control max-age on public files; 0 disables edge caching
+    conversation_cache_ttl: int = 60  # seconds a fetched conversation is reused; 0 disables
+    conversation_cache_max_entries: int = 1024
+    models_cache_ttl: int = 600  # seconds the Gemini model list is reused; 0 disables
+    response_cache_ttl: int = 0  # seconds an identical prompt reuses its Gemini answer; 0 disables
+    response_cache_max_entries: int = 256
     
     # JWT configuration (for Phase 3)
     jwt_secret_key: Optional[str] = None
     jwt_access_expire_minutes: int = 30
     jwt_refresh_expire_days: int = 7
+    jwt_cache_ttl: int = 5  # seconds a verified access token is reused; 0 disables
+    jwt_cache_max_entries: int = 10_000
     
     # Single user credentials (for Phase 3)
     username: Optional[str] = None
@@ -29,9 +41,12 @@ class Settings(BaseSettings):
     # Rate limiting
     auth_rate_limit: int = 10  # requests per minute
     chat_rate_limit: int = 30  # requests per minute
+    rate_limit_shards: int = 16
+    rate_limit_max_keys: int = 100_000  # tracked clients before the least recent is evicted
     
     # Encryption configuration
     aes_key_hash: Optional[str] = None
+    encryption_stream_threshold: int = 0  # bytes; larger JSON responses are sent as encrypted frames, 0 disables
     
     class Config:
         env_file = ".env"
@@ -2,13 +2,16 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from contextlib import asynccontextmanager
+import asyncio
 import os
 import logging
+import orjson
 from datetime import datetime
 from routers import chat_router, conversations_router, notes_router, files_router
+from routers.chat import drain_background_writes
 from routers.auth import router as auth_router
 from routers.models import router as models_router
-from middleware.security_middleware import add_security_headers, rate_limit_middleware
+from middleware.security_middleware import SecurityMiddleware, evict_rate_limits_periodically
 from middleware.encryption_middleware import EncryptionMiddleware
 
 # Configure logging
@@ -20,25 +23,54 @@ logger = logging.getLogger(__name__)
 async def lifespan(app: FastAPI):
     """Application lifespan management"""
     logger.info("Starting Toolkits backend...")
+    rate_limit_eviction = asyncio.create_task(evict_rate_limits_periodically())
     yield
+    rate_limit_eviction.cancel()
+    await drain_background_writes()
     logger.info("Shutting down Toolkits backend...")
 
 
+API_VERSION = "1.0.0"
+
+
+def health_status() -> dict:
+    """Health check payload"""
+    return {
+        "status": "healthy",
+        "timestamp": datetime.utcnow().isoformat(),
+        "version": API_VERSION
+    }
+
+
+ROOT_INFO = {
+    "message": "Toolkits API is running",
+    "version": API_VERSION,
+    "docs": "/docs"
+}
+_ROOT_BODY = orjson.dumps(ROOT_INFO)
+
+
 # Create FastAPI app
 app = FastAPI(
     title="Toolkits API",
     description="Secure AI chat application with Google Gemini integration",
-    version="1.0.0",
+    version=API_VERSION,
     lifespan=lifespan
 )
 
-# Add security middleware
-app.middleware("http")(add_security_headers)
-app.middleware("http")(rate_limit_middleware)
-
 # Add encryption middleware
 app.add_middleware(EncryptionMiddleware)
 
+# Add security middleware (rate limiting + headers), ahead of decryption work.
+# Health probes and the root endpoint are answered directly by it.
+app.add_middleware(
+    SecurityMiddleware,
+    fast_routes={
+        "/health": lambda: orjson.dumps(health_status()),
+        "/": lambda: _ROOT_BODY,
+    },
+)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -60,21 +92,13 @@ app.include_router(files_router)
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {
-        "status": "healthy",
-        "timestamp": datetime.utcnow().isoformat(),
-        "version": "1.0.0"
-    }
+    return health_status()
 
 
 @app.get("/")
 async def root():
     """Root endpoint"""
-    return {
-        "message": "Toolkits API is running",
-        "version": "1.0.0",
-        "docs": "/docs"
-    }
+    return ROOT_INFO
 
 
 if __name__ == "__main__":
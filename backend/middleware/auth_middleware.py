@@ -1,19 +1,89 @@
-from fastapi import HTTPException, status, Depends
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from typing import Optional
+from fastapi import HTTPException, status, Depends, Header
+from collections import OrderedDict
+from typing import Optional, Tuple
+import hashlib
+import time
+from config import settings
 from services.auth_service import auth_service, TokenData
 
 
-# Initialize HTTP Bearer security scheme
-security = HTTPBearer(auto_error=False)
+async def bearer_token(authorization: Optional[str] = Header(default=None)) -> Optional[str]:
+    """Extract the raw token from an `Authorization: Bearer <token>` header"""
+    if not authorization:
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    return token
+
+
+class TokenCache:
+    """Bounded LRU cache of verified access tokens with per-entry expiry"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # sha256(token) -> (monotonic expiry, token data); raw tokens are never stored
+        self._entries: "OrderedDict[bytes, Tuple[float, TokenData]]" = OrderedDict()
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token: str) -> Optional[TokenData]:
+        """Return cached token data if present and not expired"""
+        if self.ttl <= 0:
+            return None
+        key = self._key(token)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, token_data = entry
+        if time.monotonic() >= expires_at:
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return token_data
+
+    def set(self, token: str, token_data: TokenData) -> None:
+        """Cache verified token data, never beyond the token's own expiry"""
+        if self.ttl <= 0:
+            return
+        ttl = self.ttl
+        # Expiry comes from the already-verified claims; the token is not parsed again
+        if token_data.expires_at is not None:
+            ttl = min(ttl, token_data.expires_at - time.time())
+        if ttl <= 0:
+            return
+        key = self._key(token)
+        self._entries[key] = (time.monotonic() + ttl, token_data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+# Global verified-token cache instance
+token_cache = TokenCache(maxsize=settings.jwt_cache_max_entries, ttl=settings.jwt_cache_ttl)
+
+
+def _verify_access_token(token: str) -> TokenData:
+    """Verify an access token, reusing a recent verification when available"""
+    token_data = token_cache.get(token)
+    if token_data is None:
+        token_data = auth_service.verify_token(token, token_type="access")
+        token_cache.set(token, token_data)
+    return token_data
 
 
-async def get_current_user(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)) -> TokenData:
+async def get_current_user(token: Optional[str] = Depends(bearer_token)) -> TokenData:
     """
     Dependency to get current authenticated user from JWT token.
     
     Args:
-        credentials: HTTP Bearer credentials from request header
+        token: Bearer token from the Authorization header
         
     Returns:
         TokenData: Validated token data containing username
@@ -21,7 +91,7 @@ async def get_current_user(credentials: Optional[HTTPAuthorizationCredentials] =
     Raises:
         HTTPException: If token is missing or invalid
     """
-    if credentials is None:
+    if token is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Missing authentication token",
@@ -29,27 +99,27 @@ async def get_current_user(credentials: Optional[HTTPAuthorizationCredentials] =
         )
     
     # Verify the access token
-    token_data = auth_service.verify_token(credentials.credentials, token_type="access")
+    token_data = _verify_access_token(token)
     
     return token_data
 
 
-async def get_optional_user(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)) -> Optional[TokenData]:
+async def get_optional_user(token: Optional[str] = Depends(bearer_token)) -> Optional[TokenData]:
     """
     Optional dependency to get current authenticated user from JWT token.
     Returns None if no token is provided or token is invalid.
     
     Args:
-        credentials: HTTP Bearer credentials from request header
+        token: Bearer token from the Authorization header
         
     Returns:
         TokenData or None: Validated token data or None if not authenticated
     """
-    if credentials is None:
+    if token is None:
         return None
     
     try:
-        token_data = auth_service.verify_token(credentials.credentials, token_type="access")
+        token_data = _verify_access_token(token)
         return token_data
     except HTTPException:
         return None
\ No newline at end of file
@@ -1,163 +1,369 @@
-from fastapi import Request, HTTPException, status
-from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import Response
-import json
-from typing import Dict, Any, Optional
+from contextvars import ContextVar
+from fastapi import HTTPException, status
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import asyncio
+import logging
+import orjson
+from typing import Awaitable, Callable, Dict, Any, Optional, Tuple, Type, TypeVar
+from pydantic import BaseModel, ValidationError
+from config import settings
 from services.encryption_service import EncryptionService
 
+logger = logging.getLogger(__name__)
 
-class EncryptionMiddleware(BaseHTTPMiddleware):
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+# Per-request values published by the middleware for endpoints
+decrypted_data_var: ContextVar[Optional[Any]] = ContextVar("decrypted_data", default=None)
+encryption_key_var: ContextVar[Optional[str]] = ContextVar("encryption_key", default=None)
+
+
+def _error_response(status_code: int, code: str, message: str) -> ORJSONResponse:
+    """Build the standard error envelope returned by the middleware"""
+    return ORJSONResponse(
+        status_code=status_code,
+        content={
+            "success": False,
+            "error": {
+                "code": code,
+                "message": message
+            }
+        }
+    )
+
+
+class _StaticResponse:
+    """Pre-serialized JSON response that can be sent repeatedly without re-encoding"""
+
+    def __init__(self, status_code: int, content: Any):
+        self.status_code = status_code
+        self.body = orjson.dumps(content)
+        self.raw_headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(self.body)).encode("latin-1")),
+        ]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # Fresh header list per send; outer middleware may extend it in place
+        await send({"type": "http.response.start", "status": self.status_code, "headers": list(self.raw_headers)})
+        await send({"type": "http.response.body", "body": self.body})
+
+
+def _static_error(status_code: int, code: str, message: str) -> _StaticResponse:
+    """Build a reusable error envelope for errors with a fixed message"""
+    return _StaticResponse(status_code, {"success": False, "error": {"code": code, "message": message}})
+
+
+# Error envelopes whose messages never vary, serialized once
+_ERR_PAYLOAD_MISSING = _static_error(
+    status.HTTP_400_BAD_REQUEST, "ENCRYPTION_PAYLOAD_MISSING", "Encrypted payload required"
+)
+_ERR_FORMAT_INVALID = _static_error(
+    status.HTTP_400_BAD_REQUEST, "ENCRYPTION_FORMAT_INVALID", "Payload must contain 'encrypted_data' field"
+)
+_ERR_JSON_INVALID = _static_error(
+    status.HTTP_400_BAD_REQUEST, "ENCRYPTION_JSON_INVALID", "Invalid JSON in request body"
+)
+
+
+# Methods whose JSON bodies arrive encrypted and must be decrypted
+_DECRYPT_METHODS = frozenset({"POST", "PATCH", "PUT"})
+
+# Methods that never carry a JSON payload in either direction
+_PASSTHROUGH_METHODS = frozenset({"HEAD", "OPTIONS"})
+
+# Statuses whose JSON responses get encrypted
+_ENCRYPT_STATUSES = frozenset({200, 201})
+
+# Payloads at least this large are parsed/encrypted/decrypted in a worker thread;
+# smaller ones finish inline faster than the thread hand-off
+CRYPTO_OFFLOAD_THRESHOLD = 64 * 1024
+
+
+async def _run_crypto(size: int, func: Callable[..., Any], *args: Any) -> Any:
+    """Run a blocking crypto call inline when small, off the event loop when large"""
+    if size >= CRYPTO_OFFLOAD_THRESHOLD:
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
+
+
+# Header marking a response sent as newline-delimited encrypted frames
+CHUNKED_HEADER = "x-encrypted-chunked"
+
+# Raw header names as they appear in ASGI messages (always lowercase)
+_CONTENT_TYPE = b"content-type"
+_CONTENT_LENGTH = b"content-length"
+_CHUNKED_HEADERS = [(_CONTENT_TYPE, b"application/octet-stream"), (CHUNKED_HEADER.encode("latin-1"), b"1")]
+
+
+class EncryptionMiddleware:
     """Middleware to handle encryption/decryption for protected endpoints"""
-    
-    ENCRYPTED_ENDPOINTS = {
+
+    # Tuple so a single C-level str.startswith call checks every prefix
+    ENCRYPTED_ENDPOINTS = (
         "/api/chat",
         "/api/conversations",
         "/api/notes",
         "/api/files",
-    }
-    
-    async def dispatch(self, request: Request, call_next) -> Response:
-        # Check if this endpoint requires encryption
-        path = request.url.path
-        requires_encryption = any(path.startswith(endpoint) for endpoint in self.ENCRYPTED_ENDPOINTS)
-        
-        if not requires_encryption:
-            return await call_next(request)
-        
-        # Get server-side encryption key (no client data involved)
+    )
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        # The server key never changes at runtime, so resolve it once
+        self._key: Optional[str] = None
+        self._key_error: Optional[_StaticResponse] = None
         try:
-            encryption_key = EncryptionService.get_server_encryption_key()
+            self._key = EncryptionService.get_server_encryption_key()
         except ValueError as e:
-            return JSONResponse(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                content={
-                    "success": False,
-                    "error": {
-                        "code": "ENCRYPTION_CONFIG_ERROR",
-                        "message": str(e)
-                    }
-                }
+            logger.error(f"Encryption disabled: {e}")
+            self._key_error = _static_error(
+                status.HTTP_500_INTERNAL_SERVER_ERROR, "ENCRYPTION_CONFIG_ERROR", str(e)
             )
-        
-        # Store encryption key in request state for use by endpoints
-        request.state.encryption_key = encryption_key
-        
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Check if this endpoint requires encryption
+        if not scope["path"].startswith(self.ENCRYPTED_ENDPOINTS):
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        if method in _PASSTHROUGH_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        encryption_key = self._key
+        if encryption_key is None:
+            await self._key_error(scope, receive, send)
+            return
+
         # Handle POST/PATCH/PUT requests with encrypted payloads when JSON
-        if request.method in ["POST", "PATCH", "PUT"]:
-            try:
-                # Only attempt decryption for JSON requests. Skip for form/multipart.
-                content_type = request.headers.get("content-type", "").lower()
-                is_json_request = content_type.startswith("application/json")
-
-                if is_json_request:
-                    # Read and decrypt request body
-                    body = await request.body()
-                    if not body:
-                        return JSONResponse(
-                            status_code=status.HTTP_400_BAD_REQUEST,
-                            content={
-                                "success": False,
-                                "error": {
-                                    "code": "ENCRYPTION_PAYLOAD_MISSING",
-                                    "message": "Encrypted payload required"
-                                }
-                            }
-                        )
-                    # Parse JSON body
-                    try:
-                        encrypted_payload = json.loads(body.decode('utf-8'))
-                        if "encrypted_data" not in encrypted_payload:
-                            return JSONResponse(
-                                status_code=status.HTTP_400_BAD_REQUEST,
-                                content={
-                                    "success": False,
-                                    "error": {
-                                        "code": "ENCRYPTION_FORMAT_INVALID",
-                                        "message": "Payload must contain 'encrypted_data' field"
-                                    }
-                                }
-                            )
-                    except json.JSONDecodeError:
-                        return JSONResponse(
-                            status_code=status.HTTP_400_BAD_REQUEST,
-                            content={
-                                "success": False,
-                                "error": {
-                                    "code": "ENCRYPTION_JSON_INVALID",
-                                    "message": "Invalid JSON in request body"
-                                }
-                            }
-                        )
-
-                    # Decrypt the payload
-                    try:
-                        decrypted_data = EncryptionService.decrypt_data(
-                            encrypted_payload["encrypted_data"], 
-                            encryption_key
-                        )
-                        request.state.decrypted_data = decrypted_data
-                    except ValueError as e:
-                        return JSONResponse(
-                            status_code=status.HTTP_400_BAD_REQUEST,
-                            content={
-                                "success": False,
-                                "error": {
-                                    "code": "DECRYPTION_FAILED",
-                                    "message": str(e)
-                                }
-                            }
-                        )
-                
-            except Exception as e:
-                return JSONResponse(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    content={
-                        "success": False,
-                        "error": {
-                            "code": "ENCRYPTION_ERROR",
-                            "message": f"Encryption processing failed: {str(e)}"
-                        }
-                    }
-                )
-        
-        # Call the endpoint
-        response = await call_next(request)
-        
-        # Encrypt response for successful requests if JSON and not SSE
-        content_type_out = response.headers.get("content-type", "").lower()
-        if (
-            response.status_code in [200, 201]
-            and "text/event-stream" not in content_type_out
-            and content_type_out.startswith("application/json")
-        ):
+        decrypted_token = None
+        if method in _DECRYPT_METHODS:
+            # Only attempt decryption for JSON requests. Skip for form/multipart.
+            content_type = b""
+            for name, value in scope["headers"]:
+                if name == _CONTENT_TYPE:
+                    content_type = value.lower()
+                    break
+            if content_type.startswith(b"application/json"):
+                try:
+                    # Read the whole body once and replay it to the endpoint
+                    body, receive = await self._read_body(receive)
+                    decrypted_data, error_response = await _run_crypto(
+                        len(body), self._decrypt_request, body, encryption_key
+                    )
+                    if error_response is not None:
+                        await error_response(scope, receive, send)
+                        return
+                    decrypted_token = decrypted_data_var.set(decrypted_data)
+
+                except Exception as e:
+                    response = _error_response(
+                        status.HTTP_500_INTERNAL_SERVER_ERROR,
+                        "ENCRYPTION_ERROR",
+                        f"Encryption processing failed: {str(e)}"
+                    )
+                    await response(scope, receive, send)
+                    return
+
+        # Call the endpoint, encrypting successful JSON responses on the way out
+        key_token = encryption_key_var.set(encryption_key)
+        try:
+            await self.app(scope, receive, self._encrypting_send(send, encryption_key))
+        finally:
+            encryption_key_var.reset(key_token)
+            if decrypted_token is not None:
+                decrypted_data_var.reset(decrypted_token)
+
+    @staticmethod
+    async def _read_body(receive: Receive) -> Tuple[bytes, Receive]:
+        """Collect the request body and return a receive callable that replays it"""
+        body = bytearray()
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] != "http.request":
+                break
+            body.extend(message.get("body", b""))
+            more_body = message.get("more_body", False)
+
+        body_bytes = bytes(body)
+        replayed = False
+
+        async def replay_receive() -> Message:
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body_bytes, "more_body": False}
+            return await receive()
+
+        return body_bytes, replay_receive
+
+    @staticmethod
+    def _decrypt_request(body: bytes, encryption_key: str) -> Tuple[Optional[Dict[str, Any]], Optional[ASGIApp]]:
+        """Decrypt an encrypted JSON request body, returning (data, error_response)"""
+        if not body:
+            return None, _ERR_PAYLOAD_MISSING
+        # Parse JSON body
+        try:
+            encrypted_payload = orjson.loads(body)
+            if "encrypted_data" not in encrypted_payload:
+                return None, _ERR_FORMAT_INVALID
+        except orjson.JSONDecodeError:
+            return None, _ERR_JSON_INVALID
+
+        # Decrypt the payload
+        try:
+            decrypted_data = EncryptionService.decrypt_data(
+                encrypted_payload["encrypted_data"],
+                encryption_key
+            )
+        except ValueError as e:
+            return None, _error_response(status.HTTP_400_BAD_REQUEST, "DECRYPTION_FAILED", str(e))
+
+        return decrypted_data, None
+
+    @staticmethod
+    def _encrypting_send(send: Send, encryption_key: str) -> Send:
+        """Wrap `send` so successful JSON responses are buffered and encrypted
+
+        Responses growing past `encryption_stream_threshold` bytes switch to
+        chunked mode: each frame is encrypted and forwarded as it fills, so
+        large payloads never sit in memory whole.
+        """
+        threshold = settings.encryption_stream_threshold
+        start_message: Optional[Message] = None
+        response_body = bytearray()
+        frame_index = 0
+        streaming = False
+
+        async def send_frame(frame: bytes, final: bool) -> None:
+            nonlocal frame_index
+            line = await _run_crypto(
+                len(frame), EncryptionService.encrypt_chunk, frame, encryption_key, frame_index, final
+            )
+            frame_index += 1
+            await send({"type": "http.response.body", "body": line, "more_body": not final})
+
+        async def encrypting_send(message: Message) -> None:
+            nonlocal start_message, streaming
+
+            if message["type"] == "http.response.start":
+                # Encrypt response for successful requests if JSON and not SSE
+                if message["status"] not in _ENCRYPT_STATUSES:
+                    await send(message)
+                    return
+                content_type_out = b""
+                content_length_out = None
+                for name, value in message["headers"]:
+                    if name == _CONTENT_TYPE:
+                        content_type_out = value.lower()
+                    elif name == _CONTENT_LENGTH:
+                        content_length_out = value
+                if (
+                    b"text/event-stream" not in content_type_out
+                    and content_type_out.startswith(b"application/json")
+                    and content_length_out != b"0"
+                ):
+                    start_message = message
+                    return
+                await send(message)
+                return
+
+            if message["type"] != "http.response.body" or start_message is None:
+                await send(message)
+                return
+
+            response_body.extend(message.get("body", b""))
+            more_body = message.get("more_body", False)
+
+            if threshold > 0 and (streaming or len(response_body) > threshold):
+                if not streaming:
+                    streaming = True
+                    start_message["headers"] = [
+                        (name, value) for name, value in start_message["headers"]
+                        if name != _CONTENT_LENGTH and name != _CONTENT_TYPE
+                    ] + _CHUNKED_HEADERS
+                    await send(start_message)
+                while len(response_body) >= threshold:
+                    await send_frame(bytes(response_body[:threshold]), final=False)
+                    del response_body[:threshold]
+                if not more_body:
+                    if response_body:
+                        await send_frame(bytes(response_body), final=False)
+                        response_body.clear()
+                    # Authenticated empty trailer marks the end of the stream
+                    await send_frame(b"", final=True)
+                return
+
+            if more_body:
+                return
+
             try:
-                # Read response body
-                response_body = b"".join([chunk async for chunk in response.body_iterator])
-                response_data = json.loads(response_body.decode('utf-8'))
-                
-                # Encrypt the response
-                encrypted_response = EncryptionService.encrypt_response(response_data, encryption_key)
-                
-                # Return new encrypted response (exclude Content-Length to avoid mismatch)
-                response_headers = dict(response.headers)
-                response_headers.pop('content-length', None)  # Remove Content-Length if present
-                
-                return JSONResponse(
-                    content=encrypted_response,
-                    status_code=response.status_code,
-                    headers=response_headers
+                # The endpoint already produced JSON, so encrypt its bytes as-is;
+                # base64 never needs JSON escaping, so the envelope is spliced directly
+                encrypted_data = await _run_crypto(
+                    len(response_body), EncryptionService.encrypt_bytes_b64, response_body, encryption_key
                 )
+                body = b'{"encrypted_data":"' + encrypted_data + b'"}'
+
+                # Replace Content-Length to match the encrypted body
+                start_message["headers"] = [
+                    (name, value) for name, value in start_message["headers"] if name != _CONTENT_LENGTH
+                ]
+                start_message["headers"].append((_CONTENT_LENGTH, str(len(body)).encode("latin-1")))
             except Exception as e:
-                return JSONResponse(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    content={
-                        "success": False,
-                        "error": {
-                            "code": "RESPONSE_ENCRYPTION_FAILED",
-                            "message": f"Failed to encrypt response: {str(e)}"
-                        }
-                    }
+                error_response = _error_response(
+                    status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    "RESPONSE_ENCRYPTION_FAILED",
+                    f"Failed to encrypt response: {str(e)}"
                 )
+                start_message = {
+                    "type": "http.response.start",
+                    "status": error_response.status_code,
+                    "headers": error_response.raw_headers,
+                }
+                body = error_response.body
+
+            await send(start_message)
+            await send({"type": "http.response.body", "body": body, "more_body": False})
+
+        return encrypting_send
+
+
+async def get_decrypted_data() -> Optional[Any]:
+    """Dependency returning the decrypted request payload, if any"""
+    return decrypted_data_var.get()
+
+
+async def get_encryption_key() -> Optional[str]:
+    """Dependency returning the server encryption key for encrypted routes"""
+    return encryption_key_var.get()
+
+
+def decrypted_body(model: Type[ModelT]) -> Callable[[], Awaitable[ModelT]]:
+    """
+    Build a dependency that validates the middleware's decrypted payload as `model`.
+    
+    Args:
+        model: Pydantic model describing the decrypted request body
         
-        return response
+    Returns:
+        Dependency returning the validated model instance
+    """
+    async def dependency() -> ModelT:
+        decrypted_data = decrypted_data_var.get()
+        if decrypted_data is None:
+            raise HTTPException(status_code=400, detail="Encrypted payload required")
+        try:
+            return model.model_validate(decrypted_data)
+        except ValidationError as e:
+            raise RequestValidationError(e.errors())
+
+    return dependency
@@ -1,109 +1,222 @@
+import asyncio
+import threading
 import time
-from collections import defaultdict, deque
-from typing import Dict, Deque
-from fastapi import Request, HTTPException, status
-from fastapi.responses import Response
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Mapping, Optional, Tuple
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 from config import settings
 
 
 class RateLimiter:
-    """Simple in-memory rate limiter"""
+    """Simple in-memory sliding-window rate limiter, bounded to `max_keys` clients"""
     
-    def __init__(self):
-        self.requests: Dict[str, Deque[float]] = defaultdict(deque)
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        # key -> (window id, requests in that window, requests in the previous window),
+        # kept in least-recently-seen order so the oldest key is evicted first
+        self.requests: "OrderedDict[Hashable, Tuple[int, int, int]]" = OrderedDict()
     
-    def is_allowed(self, key: str, max_requests: int, window_seconds: int = 60) -> bool:
+    def is_allowed(self, key: Hashable, max_requests: int, window_seconds: int = 60) -> bool:
         """Check if request is allowed within rate limit"""
-        now = time.time()
-        window_start = now - window_seconds
+        # Monotonic integer clock: immune to wall-clock jumps, no float math
+        now = time.monotonic_ns()
+        window_ns = window_seconds * 1_000_000_000
+        window, elapsed = divmod(now, window_ns)
         
-        # Clean old requests
-        request_times = self.requests[key]
-        while request_times and request_times[0] < window_start:
-            request_times.popleft()
+        # Slide the counters forward to the current window
+        current_window, count, previous_count = self.requests.get(key, (window, 0, 0))
+        if current_window == window - 1:
+            count, previous_count = 0, count
+        elif current_window != window:
+            count, previous_count = 0, 0
         
-        # Check if we've exceeded the limit
-        if len(request_times) >= max_requests:
-            return False
+        # Weight the previous window by how much of it still overlaps,
+        # scaled by window_ns so the comparison stays in integers
+        allowed = previous_count * (window_ns - elapsed) + count * window_ns < max_requests * window_ns
         
         # Add current request
-        request_times.append(now)
-        return True
-
-
-# Global rate limiter instance
-rate_limiter = RateLimiter()
+        self.requests[key] = (window, count + 1 if allowed else count, previous_count)
+        self.requests.move_to_end(key)
+        if len(self.requests) > self.max_keys:
+            self.requests.popitem(last=False)
+        return allowed
+    
+    def evict_stale(self, window_seconds: int = 60) -> int:
+        """Drop counters that no longer affect any decision"""
+        window = time.monotonic_ns() // (window_seconds * 1_000_000_000)
+        stale = [key for key, (key_window, _, _) in self.requests.items() if key_window < window - 1]
+        for key in stale:
+            del self.requests[key]
+        return len(stale)
 
 
-async def add_security_headers(request: Request, call_next):
-    """Add security headers to all responses"""
-    response = await call_next(request)
+class ShardedRateLimiter:
+    """Rate limiter striped across independently locked shards"""
     
-    # Security headers
-    response.headers["X-Content-Type-Options"] = "nosniff"
-    response.headers["X-Frame-Options"] = "DENY"
-    response.headers["X-XSS-Protection"] = "1; mode=block"
-    response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
-    response.headers["Permissions-Policy"] = "geolocation=(), microphone=(), camera=()"
+    def __init__(self, shards: int = 16, max_keys: int = 100_000):
+        # Round up to a power of two so the shard index is a bit mask
+        shard_count = 1 << max(shards - 1, 0).bit_length()
+        self._mask = shard_count - 1
+        # Each shard is its own bounded LRU holding an equal share of the keys
+        shard_keys = max(max_keys // shard_count, 1)
+        self.shards = [(RateLimiter(shard_keys), threading.Lock()) for _ in range(shard_count)]
     
-    # Content Security Policy
-    path = request.url.path
-    allow_swagger_cdn = path.startswith("/docs") or path.startswith("/redoc")
-    if allow_swagger_cdn:
-        # Allow Swagger UI CDN (jsdelivr) for FastAPI Docs only
-        csp = (
-            "default-src 'self'; "
-            "script-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net; "
-            "style-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net; "
-            "img-src 'self' data: https:; "
-            "connect-src 'self'; "
-            "font-src 'self' data:; "
-            "object-src 'none'; "
-            "media-src 'none'; "
-            "frame-src 'none';"
-        )
-    else:
-        csp = (
-            "default-src 'self'; "
-            "script-src 'self' 'unsafe-inline'; "
-            "style-src 'self' 'unsafe-inline'; "
-            "img-src 'self' data: https:; "
-            "connect-src 'self'; "
-            "font-src 'self'; "
-            "object-src 'none'; "
-            "media-src 'none'; "
-            "frame-src 'none';"
-        )
-    response.headers["Content-Security-Policy"] = csp
-    
-    # HSTS (only for HTTPS)
-    if request.url.scheme == "https":
-        response.headers["Strict-Transport-Security"] = "max-age=31536000; includeSubDomains"
+    def is_allowed(self, key: Hashable, max_requests: int, window_seconds: int = 60) -> bool:
+        """Check if request is allowed within rate limit"""
+        limiter, lock = self.shards[hash(key) & self._mask]
+        with lock:
+            return limiter.is_allowed(key, max_requests, window_seconds)
     
-    return response
+    def evict_stale(self, window_seconds: int = 60) -> int:
+        """Drop stale counters from every shard"""
+        evicted = 0
+        for limiter, lock in self.shards:
+            with lock:
+                evicted += limiter.evict_stale(window_seconds)
+        return evicted
 
 
-async def rate_limit_middleware(request: Request, call_next):
-    """Rate limiting middleware"""
-    client_ip = request.client.host if request.client else "unknown"
-    path = request.url.path
-    
-    # Define rate limits for different endpoints
-    if path.startswith("/auth/"):
-        max_requests = settings.auth_rate_limit
-    elif path.startswith("/api/chat"):
-        max_requests = settings.chat_rate_limit
-    else:
-        max_requests = 100  # Default rate limit
+# Global rate limiter instance
+rate_limiter = ShardedRateLimiter(settings.rate_limit_shards, settings.rate_limit_max_keys)
+
+# Per-prefix request limits (per minute), checked in order; first match wins
+RATE_LIMIT_RULES = (
+    ("/auth/", settings.auth_rate_limit),
+    ("/api/chat", settings.chat_rate_limit),
+)
+DEFAULT_RATE_LIMIT = 100
+
+# First path segment -> rate limit bucket; unknown segments share "other"
+RATE_LIMIT_BUCKETS = {"auth": "auth", "api": "api", "": "root"}
+
+
+def get_rate_limit(path: str) -> int:
+    """Return the per-minute request limit for a request path"""
+    for prefix, max_requests in RATE_LIMIT_RULES:
+        if path.startswith(prefix):
+            return max_requests
+    return DEFAULT_RATE_LIMIT
+
+
+async def evict_rate_limits_periodically(interval_seconds: int = 60):
+    """Background task that keeps the rate limiter from growing without bound"""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        rate_limiter.evict_stale()
+
+
+# Content Security Policy for the app and API
+CSP = (
+    "default-src 'self'; "
+    "script-src 'self' 'unsafe-inline'; "
+    "style-src 'self' 'unsafe-inline'; "
+    "img-src 'self' data: https:; "
+    "connect-src 'self'; "
+    "font-src 'self'; "
+    "object-src 'none'; "
+    "media-src 'none'; "
+    "frame-src 'none';"
+)
+
+# Allow Swagger UI CDN (jsdelivr) for FastAPI Docs only
+DOCS_CSP = (
+    "default-src 'self'; "
+    "script-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net; "
+    "style-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net; "
+    "img-src 'self' data: https:; "
+    "connect-src 'self'; "
+    "font-src 'self' data:; "
+    "object-src 'none'; "
+    "media-src 'none'; "
+    "frame-src 'none';"
+)
+
+SECURITY_HEADERS = (
+    ("X-Content-Type-Options", "nosniff"),
+    ("X-Frame-Options", "DENY"),
+    ("X-XSS-Protection", "1; mode=block"),
+    ("Referrer-Policy", "strict-origin-when-cross-origin"),
+    ("Permissions-Policy", "geolocation=(), microphone=(), camera=()"),
+)
+
+
+def _encode_headers(headers) -> Tuple[Tuple[bytes, bytes], ...]:
+    return tuple((name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers)
+
+
+# Raw ASGI header pairs, encoded once at import
+_APP_HEADERS = _encode_headers(SECURITY_HEADERS + (("Content-Security-Policy", CSP),))
+_DOCS_HEADERS = _encode_headers(SECURITY_HEADERS + (("Content-Security-Policy", DOCS_CSP),))
+_HSTS_HEADER = _encode_headers((("Strict-Transport-Security", "max-age=31536000; includeSubDomains"),))
+_DOCS_PREFIXES = ("/docs", "/redoc")
+
+
+# Precomputed 429 response, matching FastAPI's HTTPException envelope
+_RATE_LIMITED_BODY = b'{"detail":"Rate limit exceeded. Too many requests."}'
+_RATE_LIMITED_START = {
+    "type": "http.response.start",
+    "status": 429,
+    "headers": [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(_RATE_LIMITED_BODY)).encode("latin-1")),
+        (b"retry-after", b"60"),
+    ],
+}
+
+
+class SecurityMiddleware:
+    """Rate limit requests and add security headers to all responses
     
-    # Create rate limit key
-    rate_key = f"{client_ip}:{path.split('/')[1] if '/' in path else 'root'}"
+    `fast_routes` maps GET paths (e.g. health probes) to callables returning a
+    JSON body; after rate limiting and with the usual security headers, those
+    are answered here without reaching the rest of the stack.
+    """
     
-    if not rate_limiter.is_allowed(rate_key, max_requests, 60):  # 60-second window
-        raise HTTPException(
-            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-            detail="Rate limit exceeded. Too many requests.",
-            headers={"Retry-After": "60"}
-        )
+    def __init__(self, app: ASGIApp, fast_routes: Optional[Mapping[str, Callable[[], bytes]]] = None):
+        self.app = app
+        self.fast_routes = dict(fast_routes or {})
     
-    return await call_next(request)
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        path = scope["path"]
+        extra_headers = _DOCS_HEADERS if path.startswith(_DOCS_PREFIXES) else _APP_HEADERS
+        # HSTS (only for HTTPS)
+        if scope.get("scheme") == "https":
+            extra_headers = extra_headers + _HSTS_HEADER
+        
+        # Rate limit per client and top-level path bucket
+        client = scope.get("client")
+        client_ip = client[0] if client else "unknown"
+        segment_end = path.find("/", 1)
+        segment = path[1:segment_end] if segment_end > 0 else path[1:]
+        rate_key = (client_ip, RATE_LIMIT_BUCKETS.get(segment, "other"))
+        
+        if not rate_limiter.is_allowed(rate_key, get_rate_limit(path), 60):  # 60-second window
+            await send({
+                **_RATE_LIMITED_START,
+                "headers": _RATE_LIMITED_START["headers"] + list(extra_headers),
+            })
+            await send({"type": "http.response.body", "body": _RATE_LIMITED_BODY})
+            return
+        
+        fast_route = self.fast_routes.get(path)
+        if fast_route is not None and scope["method"] == "GET":
+            body = fast_route()
+            headers = [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("latin-1")),
+            ]
+            headers.extend(extra_headers)
+            await send({"type": "http.response.start", "status": 200, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+            return
+        
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", ())) + list(extra_headers)
+            await send(message)
+        
+        await self.app(scope, receive, send_with_headers)
@@ -1,9 +1,17 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional
-from datetime import datetime
+from typing import Annotated, List, Optional
+from datetime import datetime, timezone
 from enum import Enum
 
 
+_UTC = timezone.utc
+
+
+def _now() -> datetime:
+    """Current time as a timezone-aware UTC datetime"""
+    return datetime.now(_UTC)
+
+
 class MessageRole(str, Enum):
     """Message role enumeration"""
     USER = "user"
@@ -20,7 +28,7 @@ class Message(BaseModel):
     grounding_supports: Optional[List["GroundingSupport"]] = None
     url_context_urls: Optional[List[str]] = None
     grounded: bool = False
-    created_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=_now)
 
 
 class GroundingSupport(BaseModel):
@@ -40,6 +48,11 @@ class Reference(BaseModel):
     snippet: Optional[str] = None
 
 
+# Resolve Message's forward references now, so its validator is built at import
+# rather than on the first request that validates a message
+Message.model_rebuild()
+
+
 class ChatRequest(BaseModel):
     """Chat request model"""
     message: str = Field(..., min_length=1, max_length=4000)
@@ -48,6 +61,12 @@ class ChatRequest(BaseModel):
     model: str = "gemini-2.5-flash"  # Selected Gemini model
 
 
+class BatchChatRequest(BaseModel):
+    """Independent one-shot prompts answered concurrently, without conversation history"""
+    messages: List[Annotated[str, Field(min_length=1, max_length=4000)]] = Field(..., min_length=1, max_length=20)
+    model: str = "gemini-2.5-flash"  # Selected Gemini model
+
+
 class StarRequest(BaseModel):
     """Star/unstar request model"""
     starred: bool
@@ -76,8 +95,8 @@ class Conversation(BaseModel):
     conversation_id: str
     title: Optional[str] = None
     messages: List[Message] = []
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    last_updated: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=_now)
+    last_updated: datetime = Field(default_factory=_now)
     starred: bool = False
 
 
@@ -97,12 +116,13 @@ class ConversationList(BaseModel):
     conversations: List[ConversationSummary]
     total: int
     has_more: bool = False
+    next_cursor: Optional[str] = None
 
 
 class HealthCheck(BaseModel):
     """Health check response"""
     status: str = "healthy"
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    timestamp: datetime = Field(default_factory=_now)
     version: str = "1.0.0"
 
 
@@ -119,8 +139,8 @@ class Note(BaseModel):
     note_id: str
     title: str
     content: str
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=_now)
+    updated_at: datetime = Field(default_factory=_now)
     owner: Optional[str] = None
 
 
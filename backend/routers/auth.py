@@ -1,5 +1,4 @@
 from fastapi import APIRouter, HTTPException, status, Depends
-from fastapi.security import HTTPBearer
 from services.auth_service import (
     auth_service, 
     LoginRequest, 
@@ -9,6 +8,7 @@ from services.auth_service import (
 )
 from middleware.auth_middleware import get_current_user
 from models import APIResponse
+import asyncio
 import logging
 
 
@@ -32,8 +32,9 @@ async def login(login_request: LoginRequest):
     """
     try:
         # Authenticate user
-        if not auth_service.authenticate_user(login_request.username, login_request.password):
-            logger.warning(f"Failed login attempt for username: {login_request.username}")
+        # Password hashing is deliberately slow, so keep it off the event loop
+        if not await asyncio.to_thread(auth_service.authenticate_user, login_request.username, login_request.password):
+            logger.warning("Failed login attempt for username: %s", login_request.username)
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid credentials",
@@ -43,13 +44,13 @@ async def login(login_request: LoginRequest):
         # Create tokens
         tokens = auth_service.create_tokens(login_request.username)
         
-        logger.info(f"Successful login for user: {login_request.username}")
+        logger.info("Successful login for user: %s", login_request.username)
         return tokens
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Login error: {str(e)}")
+        logger.error("Login error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Authentication service error"
@@ -82,7 +83,7 @@ async def refresh_token(refresh_request: RefreshTokenRequest):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Token refresh error: {str(e)}")
+        logger.error("Token refresh error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Token refresh service error"
@@ -105,14 +106,14 @@ async def logout(current_user: TokenData = Depends(get_current_user)):
         APIResponse: Logout confirmation
     """
     try:
-        logger.info(f"User logged out: {current_user.username}")
+        logger.info("User logged out: %s", current_user.username)
         return APIResponse(
             success=True,
             message="Logged out successfully"
         )
         
     except Exception as e:
-        logger.error(f"Logout error: {str(e)}")
+        logger.error("Logout error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Logout service error"
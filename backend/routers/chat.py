@@ -1,21 +1,174 @@
-from fastapi import APIRouter, HTTPException, Request, Depends
+from fastapi import APIRouter, HTTPException, Depends
 from fastapi.responses import StreamingResponse
-import json
+import orjson
 import logging
 import asyncio
-from typing import AsyncGenerator, Optional, List
-from models import ChatRequest, Message, MessageRole
+import uuid
+from typing import AsyncGenerator, AsyncIterable, Optional, List, Set
+from models import BatchChatRequest, ChatRequest, Conversation, Message, MessageRole
 from services import gemini_service, firestore_service
 from middleware.auth_middleware import get_current_user
+from middleware.encryption_middleware import decrypted_body, get_encryption_key
 from services.auth_service import TokenData
 from services.encryption_service import EncryptionService
+from services.gemini_service import HISTORY_LIMIT
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/chat", tags=["chat"])
 
+# Streaming headers; X-Accel-Buffering stops Nginx-style proxies from buffering the stream
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
+    "Access-Control-Allow-Headers": "*",
+}
 
-async def create_sse_stream(message: str, encryption_key: str, conversation_id: str = None, enable_search: bool = False, model: str = "gemini-2.5-flash") -> AsyncGenerator[str, None]:
+
+# Stream chunks are merged until a frame holds this many characters or this much time passes
+STREAM_FLUSH_CHARS = 64
+STREAM_FLUSH_SECONDS = 0.02
+
+# Upstream chunks read ahead of the SSE consumer before the reader pauses
+STREAM_PREFETCH_CHUNKS = 32
+
+_STREAM_END = object()
+
+
+async def prefetch_chunks(
+    chunks: AsyncIterable[str],
+    maxsize: int = STREAM_PREFETCH_CHUNKS
+) -> AsyncGenerator[str, None]:
+    """
+    Read a stream in a background task so upstream I/O overlaps with consumer work
+    
+    The queue is bounded: a slow consumer pauses the reader instead of
+    buffering the whole response in memory.
+    
+    Args:
+        chunks: Source stream of text chunks
+        maxsize: Maximum number of chunks read ahead
+        
+    Yields:
+        str: Chunks in source order; a source error is re-raised here
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+
+    async def produce() -> None:
+        try:
+            async for chunk in chunks:
+                await queue.put(chunk)
+        except Exception as e:
+            await queue.put(e)
+            return
+        await queue.put(_STREAM_END)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        producer.cancel()
+
+
+async def coalesce_chunks(
+    chunks: AsyncIterable[str],
+    min_chars: int = STREAM_FLUSH_CHARS,
+    max_delay: float = STREAM_FLUSH_SECONDS
+) -> AsyncGenerator[str, None]:
+    """
+    Merge small text chunks so each yielded piece is worth an encrypt + SSE frame
+    
+    Args:
+        chunks: Source stream of text chunks
+        min_chars: Flush as soon as this many characters are buffered
+        max_delay: Flush buffered text at most this many seconds after it arrived
+        
+    Yields:
+        str: Concatenated chunks
+    """
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    buffer: List[str] = []
+    size = 0
+    deadline = None
+    # The pending read is awaited with a timeout but never cancelled by it,
+    # so a slow chunk is not lost when a time-based flush happens first
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait((pending,), timeout=timeout)
+            if not done:
+                yield "".join(buffer)
+                buffer.clear()
+                size = 0
+                deadline = None
+                continue
+            
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                break
+            buffer.append(chunk)
+            size += len(chunk)
+            if deadline is None:
+                deadline = loop.time() + max_delay
+            if size >= min_chars:
+                yield "".join(buffer)
+                buffer.clear()
+                size = 0
+                deadline = None
+        
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+# Strong references to in-flight persistence tasks so they are not garbage collected
+# and can be drained on shutdown, even if their stream was cancelled
+_background_writes: Set[asyncio.Task] = set()
+
+
+async def _persist_turn(conversation_id: str, user_write_task: asyncio.Task, user_message: Message, ai_record: dict) -> None:
+    """Append a finished turn to an existing conversation; failed writes go to the dead-letter store"""
+    user_saved = await user_write_task
+    # If the early write failed, store both messages together in one update
+    pending_messages = [ai_record] if user_saved else [user_message, ai_record]
+    if not await firestore_service.append_messages(conversation_id, pending_messages):
+        await firestore_service.record_failed_write(conversation_id, pending_messages)
+
+
+async def drain_background_writes() -> None:
+    """Wait for pending conversation writes; called on shutdown"""
+    if _background_writes:
+        await asyncio.gather(*_background_writes, return_exceptions=True)
+
+
+def _sse(event: dict) -> bytes:
+    """Frame one JSON event as an SSE data line"""
+    return b"data: " + orjson.dumps(event) + b"\n\n"
+
+
+def _encrypted_event(event_type: str, data: dict, encryption_key: str) -> bytes:
+    """Frame an SSE event whose payload is encrypted"""
+    return _sse({'type': event_type, 'encrypted_data': EncryptionService.encrypt_data(data, encryption_key)})
+
+
+async def create_sse_stream(message: str, encryption_key: str, conversation_id: str = None, enable_search: bool = False, model: str = "gemini-2.5-flash", conversation: Optional[Conversation] = None) -> AsyncGenerator[bytes, None]:
     """
     Create Server-Sent Events stream for chat response
     
@@ -25,25 +178,40 @@ async def create_sse_stream(message: str, encryption_key: str, conversation_id:
         conversation_id: Optional existing conversation ID
         enable_search: Enable Google Search grounding
         model: Gemini model to use
+        conversation: Already-fetched conversation, saving a second lookup
         
     Yields:
-        str: SSE formatted data
+        bytes: SSE formatted data
     """
+    # SSE comment line: flushes response headers through proxies before the first token
+    yield b":\n\n"
+    
+    # New chats need a title; generate it while the response streams
+    title_task = asyncio.create_task(gemini_service.generate_title(message)) if not conversation_id else None
+    user_write_task = None
+    
     try:
         # Get conversation history if continuing existing chat
         conversation_history = []
         if conversation_id:
-            conversation = await firestore_service.get_conversation(conversation_id)
+            if conversation is None:
+                conversation = await firestore_service.get_conversation(conversation_id)
             if conversation:
-                # Convert messages to format expected by Gemini
+                # Convert messages to format expected by Gemini; only the most recent are sent
                 conversation_history = [
                     {"role": msg.role.value, "content": msg.content}
-                    for msg in conversation.messages
+                    for msg in conversation.messages[-HISTORY_LIMIT:]
                 ]
+            
+            # Persist the user's message right away; the AI reply is appended when complete
+            user_message = Message(role=MessageRole.USER, content=message)
+            user_write_task = asyncio.create_task(
+                firestore_service.append_messages(conversation_id, [user_message])
+            )
         
         # Send conversation ID event if this is a new chat
         if not conversation_id:
-            yield f"data: {json.dumps({'type': 'conversation_start'})}\n\n"
+            yield _sse({'type': 'conversation_start'})
         
         # Initialize variables for grounding
         references = []
@@ -58,50 +226,48 @@ async def create_sse_stream(message: str, encryption_key: str, conversation_id:
                 message, conversation_history, enable_search, None, model
             )
             
-            encrypted_chunk = EncryptionService.encrypt_response({'content': complete_response}, encryption_key)
-            yield f"data: {json.dumps({'type': 'encrypted_chunk', 'encrypted_data': encrypted_chunk['encrypted_data']})}\n\n"
+            yield _encrypted_event('encrypted_chunk', {'content': complete_response}, encryption_key)
 
         else:
             # Use real streaming for normal requests (no search/grounding needed)
             complete_response = ""
-            async for chunk in gemini_service.generate_response_stream(message, conversation_history, enable_search, model):
+            upstream = prefetch_chunks(gemini_service.generate_response_stream(message, conversation_history, enable_search, model))
+            async for chunk in coalesce_chunks(upstream):
                 complete_response += chunk
-                # Encrypt and stream each chunk in real-time
-                encrypted_chunk = EncryptionService.encrypt_response({'content': chunk}, encryption_key)
-                yield f"data: {json.dumps({'type': 'encrypted_chunk', 'encrypted_data': encrypted_chunk['encrypted_data']})}\n\n"
+                # Encrypt and stream each batch of chunks in near real-time
+                yield _encrypted_event('encrypted_chunk', {'content': chunk}, encryption_key)
+        
+        # Serialize the AI message once; the same dict is stored and feeds the final event
+        ai_record = Message(
+            message_id=str(uuid.uuid4()),
+            role=MessageRole.AI, 
+            content=complete_response,
+            references=references,
+            search_queries=search_queries,
+            grounding_supports=grounding_supports,
+            url_context_urls=url_context_urls,
+            grounded=grounded
+        ).model_dump()
         
         # Save conversation to Firestore
         if conversation_id:
-            # Add to existing conversation
-            user_message = Message(role=MessageRole.USER, content=message)
-            ai_message = Message(
-                role=MessageRole.AI, 
-                content=complete_response,
-                references=references,
-                search_queries=search_queries,
-                grounding_supports=grounding_supports,
-                url_context_urls=url_context_urls,
-                grounded=grounded
-            )
-            await firestore_service.add_message_to_conversation_with_grounding(
-                conversation_id, user_message, ai_message
+            # The turn is stored before 'done': the client reloads the conversation and list right
+            # away, and the next turn's user message must land after this reply. The task is
+            # tracked and shielded so a client disconnect does not cancel the write.
+            persist_task = asyncio.create_task(
+                _persist_turn(conversation_id, user_write_task, user_message, ai_record)
             )
+            _background_writes.add(persist_task)
+            persist_task.add_done_callback(_background_writes.discard)
+            await asyncio.shield(persist_task)
             final_conversation_id = conversation_id
         else:
+            # New chats are written first: the client loads the conversation as soon as 'done' arrives
             # Create new conversation
             user_message = Message(role=MessageRole.USER, content=message)
-            ai_message = Message(
-                role=MessageRole.AI, 
-                content=complete_response,
-                references=references,
-                search_queries=search_queries,
-                grounding_supports=grounding_supports,
-                url_context_urls=url_context_urls,
-                grounded=grounded
-            )
-            title = await gemini_service.generate_title(message)
+            title = await title_task
             final_conversation_id = await firestore_service.create_conversation_with_grounding(
-                user_message, ai_message, title
+                user_message, ai_record, title
             )
         
         # Send final event with conversation ID and grounding metadata
@@ -111,58 +277,49 @@ async def create_sse_stream(message: str, encryption_key: str, conversation_id:
         }
         if grounded:
             final_data.update({
-                'references': [ref.dict() for ref in references],
+                'references': ai_record['references'],
                 'search_queries': search_queries,
-                'grounding_supports': [support.dict() for support in grounding_supports],
+                'grounding_supports': ai_record['grounding_supports'],
                 'url_context_urls': url_context_urls,
                 'grounded': grounded
             })
         
         # Encrypt final event data
-        encrypted_final_data = EncryptionService.encrypt_response(final_data, encryption_key)
-        yield f"data: {json.dumps({'type': 'encrypted_done', 'encrypted_data': encrypted_final_data['encrypted_data']})}\n\n"
+        yield _encrypted_event('encrypted_done', final_data, encryption_key)
         
     except Exception as e:
         logger.error(f"Error in SSE stream: {e}")
         error_msg = "An error occurred while generating the response. Please try again."
-        yield f"data: {json.dumps({'type': 'error', 'error': error_msg})}\n\n"
+        yield _sse({'type': 'error', 'error': error_msg})
+    finally:
+        if title_task is not None and not title_task.done():
+            title_task.cancel()
 
 
 @router.post("/")
 async def start_chat(
-    request: Request,
-    current_user: TokenData = Depends(get_current_user)
+    current_user: TokenData = Depends(get_current_user),
+    chat_request: ChatRequest = Depends(decrypted_body(ChatRequest)),
+    encryption_key: str = Depends(get_encryption_key)
 ):
     """
     Start a new chat conversation with streaming response
     
     Args:
-        request: FastAPI request object with decrypted data
         current_user: Current authenticated user
+        chat_request: Validated decrypted chat payload
+        encryption_key: Key for encrypting the streamed events
         
     Returns:
         StreamingResponse: Server-Sent Events stream
     """
     try:
-        # Get decrypted data from middleware
-        if not hasattr(request.state, 'decrypted_data'):
-            raise HTTPException(status_code=400, detail="Encrypted payload required")
-        
-        decrypted_data = request.state.decrypted_data
-        chat_request = ChatRequest(**decrypted_data)
-        
         logger.info(f"Starting new chat with message: {chat_request.message[:100]}...")
         
         return StreamingResponse(
-            create_sse_stream(chat_request.message, request.state.encryption_key, enable_search=chat_request.enable_search, model=chat_request.model),
+            create_sse_stream(chat_request.message, encryption_key, enable_search=chat_request.enable_search, model=chat_request.model),
             media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
-                "Access-Control-Allow-Headers": "*",
-            }
+            headers=SSE_HEADERS
         )
         
     except Exception as e:
@@ -170,48 +327,58 @@ async def start_chat(
         raise HTTPException(status_code=500, detail="Failed to start chat")
 
 
+# Declared before /{conversation_id} so "batch" is not taken for a conversation ID
+@router.post("/batch")
+async def batch_chat(
+    current_user: TokenData = Depends(get_current_user),
+    batch_request: BatchChatRequest = Depends(decrypted_body(BatchChatRequest))
+):
+    """
+    Answer several independent prompts in one request
+    
+    Args:
+        current_user: Current authenticated user
+        batch_request: Validated decrypted batch payload
+        
+    Returns:
+        dict: Responses in the order of the prompts
+    """
+    logger.info(f"Answering batch of {len(batch_request.messages)} prompts")
+    responses = await gemini_service.generate_batch(batch_request.messages, model=batch_request.model)
+    return {"responses": responses}
+
+
 @router.post("/{conversation_id}")
 async def continue_chat(
     conversation_id: str,
-    request: Request,
-    current_user: TokenData = Depends(get_current_user)
+    current_user: TokenData = Depends(get_current_user),
+    chat_request: ChatRequest = Depends(decrypted_body(ChatRequest)),
+    encryption_key: str = Depends(get_encryption_key)
 ):
     """
     Continue an existing chat conversation with streaming response
     
     Args:
         conversation_id: ID of the existing conversation
-        request: FastAPI request object with decrypted data
         current_user: Current authenticated user
+        chat_request: Validated decrypted chat payload
+        encryption_key: Key for encrypting the streamed events
         
     Returns:
         StreamingResponse: Server-Sent Events stream
     """
     try:
-        # Get decrypted data from middleware
-        if not hasattr(request.state, 'decrypted_data'):
-            raise HTTPException(status_code=400, detail="Encrypted payload required")
-        
-        decrypted_data = request.state.decrypted_data
-        chat_request = ChatRequest(**decrypted_data)
-        
         logger.info(f"Continuing chat {conversation_id} with message: {chat_request.message[:100]}...")
         
-        # Verify conversation exists
+        # Verify conversation exists; the stream reuses it as the chat history
         conversation = await firestore_service.get_conversation(conversation_id)
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
         return StreamingResponse(
-            create_sse_stream(chat_request.message, request.state.encryption_key, conversation_id, chat_request.enable_search, chat_request.model),
+            create_sse_stream(chat_request.message, encryption_key, conversation_id, chat_request.enable_search, chat_request.model, conversation),
             media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
-                "Access-Control-Allow-Headers": "*",
-            }
+            headers=SSE_HEADERS
         )
         
     except HTTPException:
@@ -1,9 +1,10 @@
-from fastapi import APIRouter, HTTPException, Query, Depends, Request
+from fastapi import APIRouter, HTTPException, Query, Depends
 from typing import Optional
 import logging
 from models import ConversationList, Conversation, APIResponse, StarRequest, RenameRequest
 from services import firestore_service
 from middleware.auth_middleware import get_current_user
+from middleware.encryption_middleware import decrypted_body
 from services.auth_service import TokenData
 
 logger = logging.getLogger(__name__)
@@ -16,6 +17,7 @@ async def list_conversations(
     limit: int = Query(50, ge=1, le=100),
     offset: int = Query(0, ge=0),
     starred: Optional[bool] = Query(None),
+    cursor: Optional[str] = Query(None),
     current_user: TokenData = Depends(get_current_user)
 ):
     """
@@ -25,18 +27,15 @@ async def list_conversations(
         limit: Number of conversations to return (1-100)
         offset: Number of conversations to skip
         starred: Filter by starred status (optional)
+        cursor: next_cursor from the previous page; replaces offset (optional)
         
     Returns:
         ConversationList: List of conversation summaries
     """
     try:
-        logger.info(f"Listing conversations: limit={limit}, offset={offset}, starred={starred}")
+        logger.info(f"Listing conversations: limit={limit}, offset={offset}, starred={starred}, cursor={cursor}")
         
-        conversations = await firestore_service.list_conversations(limit, offset)
-        
-        # Filter by starred status if specified
-        if starred is not None:
-            conversations = [conv for conv in conversations if conv.starred == starred]
+        conversations = await firestore_service.list_conversations(limit, offset, starred=starred, cursor=cursor)
         
         # Check if there are more conversations
         has_more = len(conversations) == limit
@@ -44,7 +43,8 @@ async def list_conversations(
         return ConversationList(
             conversations=conversations,
             total=len(conversations),
-            has_more=has_more
+            has_more=has_more,
+            next_cursor=conversations[-1].conversation_id if has_more else None
         )
         
     except Exception as e:
@@ -80,24 +80,18 @@ async def get_conversation(conversation_id: str, current_user: TokenData = Depen
 
 
 @router.post("/{conversation_id}/star", response_model=APIResponse)
-async def star_conversation(conversation_id: str, request: Request, current_user: TokenData = Depends(get_current_user)):
+async def star_conversation(conversation_id: str, current_user: TokenData = Depends(get_current_user), star_request: StarRequest = Depends(decrypted_body(StarRequest))):
     """
     Star or unstar a conversation
     
     Args:
         conversation_id: The conversation ID
-        request: FastAPI request object with decrypted data
+        star_request: Validated decrypted star payload
         
     Returns:
         APIResponse: Success response
     """
     try:
-        # Get decrypted data from middleware
-        if not hasattr(request.state, 'decrypted_data'):
-            raise HTTPException(status_code=400, detail="Encrypted payload required")
-        
-        decrypted_data = request.state.decrypted_data
-        star_request = StarRequest(**decrypted_data)
         starred = star_request.starred
         logger.info(f"{'Starring' if starred else 'Unstarring'} conversation: {conversation_id}")
         
@@ -119,24 +113,18 @@ async def star_conversation(conversation_id: str, request: Request, current_user
 
 
 @router.patch("/{conversation_id}/title", response_model=APIResponse)
-async def rename_conversation(conversation_id: str, request: Request, current_user: TokenData = Depends(get_current_user)):
+async def rename_conversation(conversation_id: str, current_user: TokenData = Depends(get_current_user), rename_request: RenameRequest = Depends(decrypted_body(RenameRequest))):
     """
     Rename a conversation
     
     Args:
         conversation_id: The conversation ID
-        request: FastAPI request object with decrypted data
+        rename_request: Validated decrypted rename payload
         
     Returns:
         APIResponse: Success response
     """
     try:
-        # Get decrypted data from middleware
-        if not hasattr(request.state, 'decrypted_data'):
-            raise HTTPException(status_code=400, detail="Encrypted payload required")
-        
-        decrypted_data = request.state.decrypted_data
-        rename_request = RenameRequest(**decrypted_data)
         title = rename_request.title.strip()
         logger.info(f"Renaming conversation {conversation_id} to '{title}'")
         
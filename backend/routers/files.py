@@ -1,21 +1,81 @@
-from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form, Query, Request
+from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form, Query
 from fastapi.responses import StreamingResponse
-from typing import Optional
+from typing import Any, Optional
+import asyncio
 import uuid
 import base64
+import binascii
 
 from middleware.auth_middleware import get_current_user
+from middleware.encryption_middleware import get_decrypted_data, get_encryption_key
 from services.gcs_service import gcs_service
 from services.auth_service import TokenData
+from services.encryption_service import EncryptionService
 
 
 router = APIRouter(prefix="/api/files", tags=["files"])
 
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+MAX_UPLOAD_SIZE = 200 * 1024 * 1024
+MAX_FRAME_SIZE = 16 << 20
+# Base64 characters decoded per step; a multiple of 4 keeps windows aligned to whole groups
+BASE64_WINDOW = 4 << 20
+
+
+class UploadTooLargeError(ValueError):
+    """An upload stream went past MAX_UPLOAD_SIZE"""
+
+
+async def _stream_download(file_id: str, is_public: bool) -> StreamingResponse:
+    """Stream a stored file in fixed-size chunks read off the event loop"""
+    reader, size = await asyncio.to_thread(gcs_service.open_blob_stream, file_id, is_public, DOWNLOAD_CHUNK_SIZE)
+
+    async def body():
+        try:
+            while True:
+                chunk = await asyncio.to_thread(reader.read, DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            reader.close()
+
+    return StreamingResponse(body(), media_type='application/octet-stream', headers={
+        'Content-Disposition': f'attachment; filename="{file_id}"',
+        'Content-Length': str(size)
+    })
+
+
+def _copy_upload(source, file_id: str, is_public: bool) -> tuple:
+    """Copy an uploaded file into GCS chunk by chunk (blocking)"""
+    size = 0
+    with gcs_service.blob_writer(file_id, is_public=is_public) as (writer, object_path):
+        while True:
+            chunk = source.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > MAX_UPLOAD_SIZE:
+                raise UploadTooLargeError(f"File too large: {size} bytes")
+            writer.write(chunk)
+    return object_path, size
+
+
+def _store_base64(content_b64: str, file_id: str, is_public: bool) -> tuple:
+    """Decode strict base64 window by window straight into GCS (blocking)"""
+    size = 0
+    with gcs_service.blob_writer(file_id, is_public=is_public) as (writer, object_path):
+        for start in range(0, len(content_b64), BASE64_WINDOW):
+            chunk = binascii.a2b_base64(content_b64[start:start + BASE64_WINDOW], strict_mode=True)
+            writer.write(chunk)
+            size += len(chunk)
+    return object_path, size
+
 
 @router.get("/")
 async def list_files(is_public: Optional[bool] = Query(None), current_user: TokenData = Depends(get_current_user)):
     try:
-        return {"files": gcs_service.list_files(is_public=is_public)}
+        return {"files": await asyncio.to_thread(gcs_service.list_files, is_public=is_public)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to list files: {str(e)}")
 
@@ -28,18 +88,19 @@ async def upload_file(
     current_user: TokenData = Depends(get_current_user)
 ):
     try:
-        data = await file.read()
         fid = file_id or str(uuid.uuid4())
-        object_path, size = gcs_service.upload_from_bytes(data, fid, is_public=public)
+        object_path, size = await asyncio.to_thread(_copy_upload, file.file, fid, public)
         return {"file_id": fid, "object_path": object_path, "size": size, "is_public": public}
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to upload file: {str(e)}")
 
 
 @router.post("/upload-encrypted")
 async def upload_file_encrypted(
-    request: Request,
-    current_user: TokenData = Depends(get_current_user)
+    current_user: TokenData = Depends(get_current_user),
+    data: Optional[Any] = Depends(get_decrypted_data)
 ):
     """
     Encrypted upload endpoint: client sends JSON { encrypted_data: "..." }.
@@ -47,23 +108,30 @@ async def upload_file_encrypted(
     Server decrypts then stores plaintext bytes in GCS.
     """
     try:
-        data = getattr(request.state, "decrypted_data", None)
         if not data:
             raise HTTPException(status_code=400, detail="Encrypted payload required")
 
         content_b64 = data.get("content_b64")
-        if not content_b64:
+        if not content_b64 or not isinstance(content_b64, str):
             raise HTTPException(status_code=400, detail="content_b64 required")
 
+        # Reject from the encoded length alone, before spending time and memory decoding
+        decoded_size = len(content_b64) * 3 // 4
+        if decoded_size > MAX_UPLOAD_SIZE:
+            raise HTTPException(status_code=413, detail=f"File too large: {decoded_size} bytes")
+
         fid = data.get("file_id") or str(uuid.uuid4())
         public = bool(data.get("public", False))
 
         try:
-            file_bytes = base64.b64decode(content_b64)
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid base64 content")
-
-        object_path, size = gcs_service.upload_from_bytes(file_bytes, fid, is_public=public)
+            object_path, size = await asyncio.to_thread(_store_base64, content_b64, fid, public)
+        except binascii.Error:
+            # Not strict base64 (e.g. embedded line breaks); fall back to lenient whole-string decoding
+            try:
+                file_bytes = base64.b64decode(content_b64)
+            except Exception:
+                raise HTTPException(status_code=400, detail="Invalid base64 content")
+            object_path, size = await asyncio.to_thread(gcs_service.upload_from_bytes, file_bytes, fid, is_public=public)
         return {"file_id": fid, "object_path": object_path, "size": size, "is_public": public}
     except HTTPException:
         raise
@@ -71,11 +139,62 @@ async def upload_file_encrypted(
         raise HTTPException(status_code=500, detail=f"Failed to upload encrypted file: {str(e)}")
 
 
+def _store_encrypted_frames(source, file_id: str, is_public: bool, frame_size: int, encryption_key: str) -> tuple:
+    """Decrypt a framed upload frame by frame straight into GCS (blocking)"""
+    encrypted_frame_size = frame_size + EncryptionService.FRAME_OVERHEAD
+    size = 0
+    index = 0
+    # Only a fully authenticated stream is committed
+    with gcs_service.blob_writer(file_id, is_public=is_public) as (writer, object_path):
+        frame = source.read(encrypted_frame_size)
+        if not frame:
+            raise ValueError("Encrypted payload required")
+        while frame:
+            next_frame = source.read(encrypted_frame_size)
+            plaintext = EncryptionService.decrypt_frame(frame, encryption_key, index, final=not next_frame)
+            size += len(plaintext)
+            if size > MAX_UPLOAD_SIZE:
+                raise UploadTooLargeError(f"File too large: {size} bytes")
+            writer.write(plaintext)
+            index += 1
+            frame = next_frame
+    return object_path, size
+
+
+@router.post("/upload-encrypted-binary")
+async def upload_file_encrypted_binary(
+    file: UploadFile = File(...),
+    file_id: Optional[str] = Form(None),
+    public: bool = Form(False),
+    frame_size: int = Form(DOWNLOAD_CHUNK_SIZE, ge=1, le=MAX_FRAME_SIZE),
+    current_user: TokenData = Depends(get_current_user),
+    encryption_key: Optional[str] = Depends(get_encryption_key)
+):
+    """
+    Encrypted binary upload: the multipart file body is a sequence of AES-GCM
+    frames (EncryptionService.encrypt_frame) of `frame_size` plaintext bytes each,
+    the last one flagged final. Avoids the base64 inflation of /upload-encrypted.
+    """
+    try:
+        fid = file_id or str(uuid.uuid4())
+        object_path, size = await asyncio.to_thread(
+            _store_encrypted_frames, file.file, fid, public, frame_size, encryption_key
+        )
+        return {"file_id": fid, "object_path": object_path, "size": size, "is_public": public}
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        # Missing or unauthenticated frames
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to upload encrypted file: {str(e)}")
+
+
 @router.post("/upload-url")
 async def upload_from_url(url: str = Form(...), file_id: Optional[str] = Form(None), public: bool = Form(False), current_user: TokenData = Depends(get_current_user)):
     try:
         fid = file_id or str(uuid.uuid4())
-        object_path, size = gcs_service.upload_from_url(url, fid, is_public=public)
+        object_path, size = await asyncio.to_thread(gcs_service.upload_from_url, url, fid, is_public=public)
         return {"file_id": fid, "object_path": object_path, "size": size, "is_public": public}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to upload from URL: {str(e)}")
@@ -84,7 +203,7 @@ async def upload_from_url(url: str = Form(...), file_id: Optional[str] = Form(No
 @router.get("/{file_id}")
 async def get_file_info(file_id: str, public: bool = Query(False), current_user: TokenData = Depends(get_current_user)):
     try:
-        info = gcs_service.get_file_info(file_id, is_public=public)
+        info = await asyncio.to_thread(gcs_service.get_file_info, file_id, is_public=public)
         return {"file_id": file_id, "is_public": public, **info}
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
@@ -95,10 +214,7 @@ async def get_file_info(file_id: str, public: bool = Query(False), current_user:
 @router.get("/{file_id}/download")
 async def download_file(file_id: str, public: bool = Query(False), current_user: TokenData = Depends(get_current_user)):
     try:
-        data = gcs_service.download_file(file_id, is_public=public)
-        return StreamingResponse(iter([data]), media_type='application/octet-stream', headers={
-            'Content-Disposition': f'attachment; filename="{file_id}"'
-        })
+        return await _stream_download(file_id, is_public=public)
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -108,7 +224,7 @@ async def download_file(file_id: str, public: bool = Query(False), current_user:
 @router.patch("/{file_id}")
 async def rename_file(file_id: str, new_file_id: str = Form(...), public: bool = Form(False), current_user: TokenData = Depends(get_current_user)):
     try:
-        new_path = gcs_service.rename_file(file_id, new_file_id, is_public=public)
+        new_path = await asyncio.to_thread(gcs_service.rename_file, file_id, new_file_id, is_public=public)
         return {"file_id": new_file_id, "object_path": new_path, "is_public": public}
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
@@ -119,7 +235,7 @@ async def rename_file(file_id: str, new_file_id: str = Form(...), public: bool =
 @router.delete("/{file_id}")
 async def delete_file(file_id: str, public: bool = Query(False), current_user: TokenData = Depends(get_current_user)):
     try:
-        ok = gcs_service.delete_file(file_id, is_public=public)
+        ok = await asyncio.to_thread(gcs_service.delete_file, file_id, is_public=public)
         if not ok:
             raise HTTPException(status_code=404, detail="File not found")
         return {"success": True}
@@ -132,8 +248,10 @@ async def delete_file(file_id: str, public: bool = Query(False), current_user: T
 @router.post("/{file_id}/toggle-share")
 async def toggle_share(file_id: str, current_public: bool = Form(False), current_user: TokenData = Depends(get_current_user)):
     try:
-        new_path, new_public = gcs_service.toggle_share(file_id, current_public)
+        new_path, new_public = await asyncio.to_thread(gcs_service.toggle_share, file_id, current_public)
         return {"file_id": file_id, "object_path": new_path, "is_public": new_public}
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to toggle share: {str(e)}")
 
@@ -141,10 +259,7 @@ async def toggle_share(file_id: str, current_public: bool = Form(False), current
 @router.get("/public/{file_id}")
 async def public_download_file(file_id: str):
     try:
-        data = gcs_service.download_file(file_id, is_public=True)
-        return StreamingResponse(iter([data]), media_type='application/octet-stream', headers={
-            'Content-Disposition': f'attachment; filename="{file_id}"'
-        })
+        return await _stream_download(file_id, is_public=True)
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except Exception as e:
@@ -158,8 +273,8 @@ async def download_file_encrypted(file_id: str, public: bool = Query(False), cur
     This keeps storage plaintext, transport app-encrypted.
     """
     try:
-        data = gcs_service.download_file(file_id, is_public=public)
-        content_b64 = base64.b64encode(data).decode('utf-8')
+        data = await asyncio.to_thread(gcs_service.download_file, file_id, is_public=public)
+        content_b64 = binascii.b2a_base64(data, newline=False).decode('ascii')
         return {
             "file_id": file_id,
             "size": len(data),
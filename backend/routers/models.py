@@ -1,6 +1,7 @@
 from fastapi import APIRouter, HTTPException, Depends
-from typing import List, Dict
+from fastapi.responses import ORJSONResponse
 import logging
+from config import settings
 from services import gemini_service
 from middleware.auth_middleware import get_current_user
 from services.auth_service import TokenData
@@ -10,7 +11,7 @@ logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/models", tags=["models"])
 
 
-@router.get("/", response_model=List[Dict[str, str]])
+@router.get("/", response_model=None, response_class=ORJSONResponse)
 async def get_available_models(
     current_user: TokenData = Depends(get_current_user)
 ):
@@ -26,7 +27,9 @@ async def get_available_models(
     try:
         logger.info("Fetching available Gemini models")
         models = await gemini_service.get_available_models()
-        return models
+        # Returned directly so FastAPI skips re-encoding the list;
+        # authenticated content: browsers may reuse it, shared caches must not
+        return ORJSONResponse(models, headers={"Cache-Control": f"private, max-age={settings.models_cache_ttl}"})
         
     except Exception as e:
         logger.error(f"Error fetching models: {e}")
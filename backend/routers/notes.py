@@ -1,81 +1,195 @@
-from fastapi import APIRouter, HTTPException, Depends, Request, status, Query
-from typing import List, Optional
-from datetime import datetime
+from fastapi import APIRouter, HTTPException, Depends, status, Query
+from fastapi.responses import ORJSONResponse
+from typing import Any, Iterable, List, Optional
+from datetime import datetime, timezone
+import asyncio
+import orjson
 import uuid
 
+from google.api_core.exceptions import NotFound
+from google.cloud import firestore
 from middleware.auth_middleware import get_current_user
-from services.firestore_service import FirestoreService
-from services.encryption_service import EncryptionService
+from middleware.encryption_middleware import get_decrypted_data
+from services.firestore_service import FirestoreService, firestore_service
 from services.auth_service import TokenData
 
 
-router = APIRouter(prefix="/api/notes", tags=["notes"])
-_fs: FirestoreService | None = None
+def _json_default(value: Any) -> Any:
+    # Firestore timestamps are datetime subclasses, which orjson does not serialize itself
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+class NotesResponse(ORJSONResponse):
+    """orjson-rendered notes payload
+
+    Handlers return it directly so FastAPI skips both response-model validation
+    and the jsonable_encoder pass over every note.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+router = APIRouter(prefix="/api/notes", tags=["notes"], default_response_class=NotesResponse)
+
+# Firestore caps a single batched write at 500 operations; batched reads share the cap
+MAX_BULK_OPS = 500
+
+# Characters of content kept in the stored `preview` field
+PREVIEW_LENGTH = 200
+
+# Fields the list view reads; searches add `search_text`, never the full content
+LIST_FIELDS = ["note_id", "title", "preview", "created_at", "updated_at"]
+
+# Fields a single-note read returns; the derived preview/search_text copies stay behind
+NOTE_FIELDS = ["note_id", "title", "content", "created_at", "updated_at", "owner"]
+
+
+# Sort key for notes without updated_at: after every real timestamp
+_OLDEST = datetime.min.replace(tzinfo=timezone.utc)
 
 
 def get_fs() -> FirestoreService:
-    global _fs
-    if _fs is None:
-        _fs = FirestoreService()
-    return _fs
+    # Share the app-wide Firestore client instead of opening a second one
+    return firestore_service
+
+
+def _note_preview(content: str) -> str:
+    """Plaintext list preview stored alongside the note content"""
+    return content[0:PREVIEW_LENGTH]
+
+
+def _search_text(title: str, content: str) -> str:
+    """Lowercased title and content, stored so searches skip per-request lowering"""
+    return f"{title}\n{content}".lower()
+
 
+def _summarize_note(note_id: str, data: dict, needle: str) -> Optional[dict]:
+    """List entry for one note, or None if it is empty or does not match `needle`"""
+    title = (data.get("title") or "")
+    if needle:
+        haystack = data.get("search_text")
+        if haystack is not None:
+            if needle not in haystack:
+                return None
+        # Notes without stored search text: a title hit skips lowering the content
+        elif needle not in title.lower() and needle not in (data.get("content") or "").lower():
+            return None
+    # Decrypt content for response (plaintext in-memory, will be encrypted in transit by middleware)
+    # try:
+    #     decrypted = EncryptionService.decrypt_data(data.get("content_encrypted"), EncryptionService.get_server_encryption_key())
+    #     content = decrypted.get("content")
+    # except Exception:
+    #     content = None
+    preview = data.get("preview")
+    if preview is None:
+        preview = _note_preview(data.get("content") or "")
+    if not title or not preview:
+        return None
+    return {
+        "note_id": data.get("note_id", note_id),
+        "title": title,
+        # "content": content,
+        "content": preview,
+        "created_at": data.get("created_at"),
+        "updated_at": data.get("updated_at")
+    }
 
-@router.get("/", response_model=List[dict])
+
+def _summarize_notes(docs: Iterable[Any], needle: str, db: Any = None) -> List[dict]:
+    """Filter streamed note documents and build their list entries (blocking)
+
+    Documents may be projected to LIST_FIELDS (plus search_text when
+    searching); notes stored before those fields existed are then re-read in
+    full through `db` in one get_all call.
+    """
+    derived_field = "search_text" if needle else "preview"
+    result: List[Any] = []
+    stale = {}
+    for d in docs:
+        data = d.to_dict()
+        if db is not None and derived_field not in data and "content" not in data:
+            # Keep its position; filled in once the full document is read
+            stale[d.id] = len(result)
+            result.append(None)
+            continue
+        result.append(_summarize_note(d.id, data, needle))
+
+    if stale:
+        notes_ref = db.collection("notes")
+        for doc in db.get_all([notes_ref.document(note_id) for note_id in stale]):
+            if doc.exists:
+                result[stale[doc.id]] = _summarize_note(doc.id, doc.to_dict(), needle)
+    return [entry for entry in result if entry is not None]
+
+
+@router.get("/", response_model=None)
 async def list_notes(
     q: Optional[str] = Query(default=None, description="Optional search query for title/content"),
     page: Optional[int] = Query(default=None, ge=1, description="Optional page number (1-based)"),
     page_size: Optional[int] = Query(default=None, ge=1, le=100, description="Optional page size"),
+    cursor: Optional[str] = Query(default=None, description="Optional note_id to continue after (replaces page)"),
     current_user: TokenData = Depends(get_current_user),
 ):
     try:
         fs = get_fs()
-        # notes_ref = fs.db.collection("notes").where("owner", "==", current_user.username)
-        notes_ref = fs.db.collection("notes")
-        docs = list(notes_ref.stream())
-        result = []
+        db = fs.db
+        # notes_ref = db.collection("notes").where("owner", "==", current_user.username)
+        notes_ref = db.collection("notes")
         needle = (q or "").strip().lower()
-        for d in docs:
-            data = d.to_dict()
-            title = (data.get("title") or "")
-            content = (data.get("content") or "")
-            if needle and needle not in title.lower() and needle not in content.lower():
-                continue
-            # Decrypt content for response (plaintext in-memory, will be encrypted in transit by middleware)
-            # try:
-            #     decrypted = EncryptionService.decrypt_data(data.get("content_encrypted"), EncryptionService.get_server_encryption_key())
-            #     content = decrypted.get("content")
-            # except Exception:
-            #     content = None
-            if title and content:
-                result.append({
-                    "note_id": data.get("note_id", d.id),
-                    "title": title,
-                    # "content": content,
-                    "content": content[0:200],
-                    "created_at": data.get("created_at"),
-                    "updated_at": data.get("updated_at")
-                })
+        effective_page_size = page_size or 50
+
+        server_paged = not needle and (page is not None or cursor is not None)
+        if server_paged:
+            # Let Firestore order and cut the page so only that page is read; notes must
+            # have updated_at, as ordering leaves out documents without the field (see DEPLOYMENT.md)
+            query = notes_ref.order_by("updated_at", direction=firestore.Query.DESCENDING)
+            if cursor is not None:
+                # start_after only needs the ordering field from the cursor note
+                cursor_doc = await asyncio.to_thread(notes_ref.document(cursor).get, ["updated_at"])
+                if not cursor_doc.exists:
+                    return NotesResponse([])
+                query = query.start_after(cursor_doc)
+            elif page > 1:
+                query = query.offset((page - 1) * effective_page_size)
+            query = query.limit(effective_page_size)
+        else:
+            # Search has no index to use and the unpaged listing returns everything
+            query = notes_ref
+
+        # Skip downloading full note bodies; listing needs previews, search its stored text
+        query = query.select(LIST_FIELDS + ["search_text"] if needle else LIST_FIELDS)
 
-        # Sort by most recently updated first
-        result.sort(key=lambda x: x.get("updated_at") or datetime.min, reverse=True)
+        # Streaming and per-note filtering both run in a worker thread, off the event loop
+        result = await asyncio.to_thread(_summarize_notes, query.stream(), needle, db)
+
+        if server_paged:
+            return NotesResponse(result)
+
+        # Sort by most recently updated first; notes without updated_at go last
+        result.sort(key=lambda x: x.get("updated_at") or _OLDEST, reverse=True)
 
         # Optional pagination (preserve existing behavior when page is not provided)
-        if page is not None:
-            effective_page_size = page_size or 50
+        if cursor is not None:
+            note_ids = [note["note_id"] for note in result]
+            start = note_ids.index(cursor) + 1 if cursor in note_ids else len(result)
+            result = result[start:start + effective_page_size]
+        elif page is not None:
             start = (page - 1) * effective_page_size
             end = start + effective_page_size
             result = result[start:end]
 
-        return result
+        return NotesResponse(result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to list notes: {str(e)}")
 
 
-@router.post("/", response_model=dict, status_code=status.HTTP_201_CREATED)
-async def create_note(request: Request, current_user: TokenData = Depends(get_current_user)):
+@router.post("/", response_model=None, status_code=status.HTTP_201_CREATED)
+async def create_note(current_user: TokenData = Depends(get_current_user), decrypted: Optional[Any] = Depends(get_decrypted_data)):
     try:
         fs = get_fs()
-        decrypted = getattr(request.state, "decrypted_data", None)
         if not decrypted:
             raise HTTPException(status_code=400, detail="Missing decrypted payload")
         title = decrypted.get("title")
@@ -84,7 +198,7 @@ async def create_note(request: Request, current_user: TokenData = Depends(get_cu
             raise HTTPException(status_code=400, detail="title and content are required")
 
         note_id = str(uuid.uuid4())
-        now = datetime.utcnow()
+        now = datetime.now(timezone.utc)
 
         # # Encrypt content for at-rest storage
         # content_encrypted = EncryptionService.encrypt_data({"content": content}, EncryptionService.get_server_encryption_key())
@@ -94,24 +208,142 @@ async def create_note(request: Request, current_user: TokenData = Depends(get_cu
             "title": title,
             # "content_encrypted": content_encrypted,
             "content": content,
+            "preview": _note_preview(content),
+            "search_text": _search_text(title, content),
             # "owner": current_user.username,
             "created_at": now,
             "updated_at": now
         }
-        fs.db.collection("notes").document(note_id).set(data)
+        await asyncio.to_thread(fs.db.collection("notes").document(note_id).set, data)
 
-        return data
+        return NotesResponse(data, status_code=status.HTTP_201_CREATED)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create note: {str(e)}")
 
 
-@router.get("/{note_id}", response_model=dict)
+@router.post("/bulk", response_model=None)
+async def bulk_notes(current_user: TokenData = Depends(get_current_user), decrypted: Optional[Any] = Depends(get_decrypted_data)):
+    """Apply up to MAX_BULK_OPS create/update/delete ops atomically in one batch commit"""
+    try:
+        fs = get_fs()
+        ops = decrypted.get("ops") if isinstance(decrypted, dict) else None
+        if not isinstance(ops, list) or not ops:
+            raise HTTPException(status_code=400, detail="ops must be a non-empty list")
+        if len(ops) > MAX_BULK_OPS:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_OPS} ops per request")
+
+        # One pooled client for the whole batch
+        db = fs.db
+        notes_ref = db.collection("notes")
+        batch = db.batch()
+        now = datetime.now(timezone.utc)
+        results = []
+        for op in ops:
+            kind = op.get("op") if isinstance(op, dict) else None
+            if kind == "create":
+                title = op.get("title")
+                content = op.get("content")
+                if not title or content is None:
+                    raise HTTPException(status_code=400, detail="title and content are required")
+                note_id = str(uuid.uuid4())
+                batch.set(notes_ref.document(note_id), {
+                    "note_id": note_id,
+                    "title": title,
+                    "content": content,
+                    "preview": _note_preview(content),
+                    "search_text": _search_text(title, content),
+                    "created_at": now,
+                    "updated_at": now
+                })
+            elif kind in ("update", "delete"):
+                note_id = op.get("note_id")
+                if not note_id:
+                    raise HTTPException(status_code=400, detail="note_id is required")
+                if kind == "delete":
+                    batch.delete(notes_ref.document(note_id))
+                else:
+                    updates = {"updated_at": now}
+                    if "title" in op:
+                        updates["title"] = op["title"]
+                    if "content" in op:
+                        updates["content"] = op["content"]
+                        updates["preview"] = _note_preview(op["content"] or "")
+                    if "title" in op and "content" in op:
+                        updates["search_text"] = _search_text(op["title"] or "", op["content"] or "")
+                    elif "title" in op or "content" in op:
+                        # The other half is unknown without a read; searches fall back to the content
+                        updates["search_text"] = firestore.DELETE_FIELD
+                    # Fails the whole batch if the note does not exist
+                    batch.update(notes_ref.document(note_id), updates)
+            else:
+                raise HTTPException(status_code=400, detail="op must be create, update or delete")
+            results.append({"op": kind, "note_id": note_id})
+
+        try:
+            await asyncio.to_thread(batch.commit)
+        except NotFound:
+            raise HTTPException(status_code=404, detail="Note not found")
+
+        return NotesResponse({"success": True, "results": results})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to apply bulk note ops: {str(e)}")
+
+
+def _fetch_notes(db: Any, refs: List[Any]) -> List[dict]:
+    """Read several notes in one get_all round trip (blocking); missing notes are skipped"""
+    result = []
+    for doc in db.get_all(refs):
+        if not doc.exists:
+            continue
+        data = doc.to_dict()
+        result.append({
+            "note_id": data.get("note_id", doc.id),
+            "title": data.get("title"),
+            "content": data.get("content"),
+            "created_at": data.get("created_at"),
+            "updated_at": data.get("updated_at")
+        })
+    return result
+
+
+@router.post("/get_many", response_model=None)
+async def get_many_notes(current_user: TokenData = Depends(get_current_user), decrypted: Optional[Any] = Depends(get_decrypted_data)):
+    """Return the requested notes, in request order, using a single batched read"""
+    try:
+        fs = get_fs()
+        note_ids = decrypted.get("note_ids") if isinstance(decrypted, dict) else None
+        if not isinstance(note_ids, list) or not all(isinstance(i, str) and i for i in note_ids):
+            raise HTTPException(status_code=400, detail="note_ids must be a list of note ids")
+        # Drop duplicates but keep the caller's order
+        note_ids = list(dict.fromkeys(note_ids))
+        if len(note_ids) > MAX_BULK_OPS:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_OPS} note ids per request")
+        if not note_ids:
+            return NotesResponse([])
+
+        db = fs.db
+        refs = [db.collection("notes").document(note_id) for note_id in note_ids]
+        notes = await asyncio.to_thread(_fetch_notes, db, refs)
+
+        # get_all does not guarantee result order
+        position = {note_id: i for i, note_id in enumerate(note_ids)}
+        notes.sort(key=lambda n: position.get(n["note_id"], len(position)))
+        return NotesResponse(notes)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get notes: {str(e)}")
+
+
+@router.get("/{note_id}", response_model=None)
 async def get_note(note_id: str, current_user: TokenData = Depends(get_current_user)):
     try:
         fs = get_fs()
-        doc = fs.db.collection("notes").document(note_id).get()
+        doc = await asyncio.to_thread(fs.db.collection("notes").document(note_id).get, NOTE_FIELDS)
         if not doc.exists:
             raise HTTPException(status_code=404, detail="Note not found")
         data = doc.to_dict()
@@ -119,68 +351,74 @@ async def get_note(note_id: str, current_user: TokenData = Depends(get_current_u
         #     raise HTTPException(status_code=403, detail="Forbidden")
 
         # decrypted = EncryptionService.decrypt_data(data.get("content_encrypted"), EncryptionService.get_server_encryption_key())
-        return {
+        return NotesResponse({
             "note_id": data.get("note_id", note_id),
             "title": data.get("title"),
             # "content": decrypted.get("content"),
             "content": data.get("content"),
             "created_at": data.get("created_at"),
             "updated_at": data.get("updated_at")
-        }
+        })
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get note: {str(e)}")
 
 
-@router.put("/{note_id}", response_model=dict)
-async def update_note(note_id: str, request: Request, current_user: TokenData = Depends(get_current_user)):
+@router.put("/{note_id}", response_model=None)
+async def update_note(note_id: str, current_user: TokenData = Depends(get_current_user), decrypted: Optional[Any] = Depends(get_decrypted_data)):
     try:
+        # Reject a missing payload before paying for the Firestore read
+        if not decrypted:
+            raise HTTPException(status_code=400, detail="Missing decrypted payload")
+
+        content = decrypted.get("content")
+
         fs = get_fs()
         doc_ref = fs.db.collection("notes").document(note_id)
-        doc = doc_ref.get()
+        # Only read the stored content when the update does not replace it
+        fields = ["owner", "title"] if content is not None else ["owner", "title", "content"]
+        doc = await asyncio.to_thread(doc_ref.get, fields)
         if not doc.exists:
             raise HTTPException(status_code=404, detail="Note not found")
         data = doc.to_dict()
         # if data.get("owner") != current_user.username:
         #     raise HTTPException(status_code=403, detail="Forbidden")
 
-        decrypted = getattr(request.state, "decrypted_data", None)
-        if not decrypted:
-            raise HTTPException(status_code=400, detail="Missing decrypted payload")
-
         title = decrypted.get("title", data.get("title"))
-        content = decrypted.get("content")
-        now = datetime.utcnow()
+        now = datetime.now(timezone.utc)
 
         updates = {"title": title, "updated_at": now}
         if content is not None:
             # Align with current storage model which keeps plaintext `content`.
             # Transit encryption is handled by middleware; at-rest encryption is not enabled here.
             updates["content"] = content
+            updates["preview"] = _note_preview(content)
+        updates["search_text"] = _search_text(title or "", content if content is not None else (data.get("content") or ""))
 
-        doc_ref.update(updates)
+        await asyncio.to_thread(doc_ref.update, updates)
 
-        return {"note_id": note_id, "title": title, "content": content if content is not None else None, "updated_at": now}
+        return NotesResponse({"note_id": note_id, "title": title, "content": content if content is not None else None, "updated_at": now})
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to update note: {str(e)}")
 
 
-@router.delete("/{note_id}", response_model=dict)
+@router.delete("/{note_id}", response_model=None)
 async def delete_note(note_id: str, current_user: TokenData = Depends(get_current_user)):
     try:
         fs = get_fs()
         doc_ref = fs.db.collection("notes").document(note_id)
-        doc = doc_ref.get()
+        # Existence and ownership only need metadata, not the note body
+        doc = await asyncio.to_thread(doc_ref.get, ["owner"])
         if not doc.exists:
             raise HTTPException(status_code=404, detail="Note not found")
         data = doc.to_dict()
         # if data.get("owner") != current_user.username:
         #     raise HTTPException(status_code=403, detail="Forbidden")
-        doc_ref.delete()
-        return {"success": True}
+        await asyncio.to_thread(doc_ref.delete)
+        return NotesResponse({"success": True})
     except HTTPException:
         raise
     except Exception as e:
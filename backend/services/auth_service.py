@@ -1,17 +1,37 @@
+import functools
 import hashlib
+import hmac
 import secrets
 from datetime import datetime, timedelta, timezone
 from typing import Optional, Tuple
-from jose import JWTError, jwt
+from jose import JWTError, jwk, jwt
+from jose.backends.base import Key
 from fastapi import HTTPException, status
 from pydantic import BaseModel
 from config import settings
 
 
+# scrypt cost parameters for newly generated password hashes
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_DKLEN = 32
+
+
+JWT_ALGORITHM = "HS256"
+
+
+@functools.lru_cache(maxsize=4)
+def _signing_key(secret: str) -> Key:
+    """Prepared HMAC key, so jose skips re-parsing the secret on every sign/verify"""
+    return jwk.construct(secret, JWT_ALGORITHM)
+
+
 class TokenData(BaseModel):
     """Token data model"""
     username: Optional[str] = None
     token_type: str = "access"
+    expires_at: Optional[float] = None  # token `exp` as a Unix timestamp
 
 
 class Token(BaseModel):
@@ -42,57 +62,72 @@ class AuthService:
             raise ValueError("USERNAME and PASSWORD_HASH environment variables are required")
     
     @staticmethod
-    def hash_password(password: str) -> str:
-        """Hash password using SHA256"""
-        return hashlib.sha256(password.encode()).hexdigest()
+    def hash_password(password: str, salt: Optional[bytes] = None) -> str:
+        """Hash password with scrypt as `scrypt$n$r$p$salt_hex$hash_hex`"""
+        salt = salt if salt is not None else secrets.token_bytes(16)
+        derived = hashlib.scrypt(
+            password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=SCRYPT_DKLEN
+        )
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${derived.hex()}"
     
     @staticmethod
     def verify_password(password: str, hashed_password: str) -> bool:
-        """Verify password against hash"""
-        return AuthService.hash_password(password) == hashed_password
+        """Verify password against an scrypt hash or a legacy SHA256 hex digest"""
+        if hashed_password.startswith("scrypt$"):
+            try:
+                _, n, r, p, salt_hex, hash_hex = hashed_password.split("$")
+                expected = bytes.fromhex(hash_hex)
+                derived = hashlib.scrypt(
+                    password.encode(), salt=bytes.fromhex(salt_hex),
+                    n=int(n), r=int(r), p=int(p), dklen=len(expected)
+                )
+            except ValueError:
+                return False
+            return hmac.compare_digest(derived, expected)
+        # Constant-time comparison so response timing leaks nothing about the hash
+        digest = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(digest, hashed_password.lower())
     
     @staticmethod
     def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
         """Create JWT access token"""
         to_encode = data.copy()
-        if expires_delta:
-            expire = datetime.now(timezone.utc) + expires_delta
-        else:
-            expire = datetime.now(timezone.utc) + timedelta(minutes=settings.jwt_access_expire_minutes)
+        # One clock read so exp and iat come from the same instant
+        now = datetime.now(timezone.utc)
+        expire = now + (expires_delta or timedelta(minutes=settings.jwt_access_expire_minutes))
         
         to_encode.update({
             "exp": expire,
             "type": "access",
-            "iat": datetime.now(timezone.utc)
+            "iat": now
         })
         
-        encoded_jwt = jwt.encode(to_encode, settings.jwt_secret_key, algorithm="HS256")
+        encoded_jwt = jwt.encode(to_encode, _signing_key(settings.jwt_secret_key), algorithm=JWT_ALGORITHM)
         return encoded_jwt
     
     @staticmethod
     def create_refresh_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
         """Create JWT refresh token"""
         to_encode = data.copy()
-        if expires_delta:
-            expire = datetime.now(timezone.utc) + expires_delta
-        else:
-            expire = datetime.now(timezone.utc) + timedelta(days=settings.jwt_refresh_expire_days)
+        # One clock read so exp and iat come from the same instant
+        now = datetime.now(timezone.utc)
+        expire = now + (expires_delta or timedelta(days=settings.jwt_refresh_expire_days))
         
         to_encode.update({
             "exp": expire,
             "type": "refresh",
-            "iat": datetime.now(timezone.utc),
+            "iat": now,
             "jti": secrets.token_hex(16)  # Unique ID for refresh token
         })
         
-        encoded_jwt = jwt.encode(to_encode, settings.jwt_secret_key, algorithm="HS256")
+        encoded_jwt = jwt.encode(to_encode, _signing_key(settings.jwt_secret_key), algorithm=JWT_ALGORITHM)
         return encoded_jwt
     
     @staticmethod
     def verify_token(token: str, token_type: str = "access") -> TokenData:
         """Verify JWT token and return token data"""
         try:
-            payload = jwt.decode(token, settings.jwt_secret_key, algorithms=["HS256"])
+            payload = jwt.decode(token, _signing_key(settings.jwt_secret_key), algorithms=[JWT_ALGORITHM])
             username: str = payload.get("sub")
             type_check: str = payload.get("type")
             
@@ -103,7 +138,7 @@ class AuthService:
                     headers={"WWW-Authenticate": "Bearer"},
                 )
             
-            token_data = TokenData(username=username, token_type=type_check)
+            token_data = TokenData(username=username, token_type=type_check, expires_at=payload.get("exp"))
             return token_data
             
         except JWTError:
@@ -115,7 +150,7 @@ class AuthService:
     
     def authenticate_user(self, username: str, password: str) -> bool:
         """Authenticate user credentials"""
-        if username != settings.username:
+        if not hmac.compare_digest(username.encode(), settings.username.encode()):
             return False
         if not self.verify_password(password, settings.password_hash):
             return False
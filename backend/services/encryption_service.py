@@ -1,6 +1,9 @@
-import json
+import orjson
 import base64
+import binascii
+import functools
 import hashlib
+import struct
 from typing import Dict, Any, Optional, Tuple
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.exceptions import InvalidTag
@@ -8,6 +11,12 @@ import secrets
 from config import settings
 
 
+@functools.lru_cache(maxsize=8)
+def _get_aesgcm(key: str) -> AESGCM:
+    """AES-GCM cipher for a key string, derived once per key (SHA256 of the key)"""
+    return AESGCM(hashlib.sha256(key.encode('utf-8')).digest())
+
+
 class EncryptionService:
     """Service for AES-GCM encryption/decryption operations"""
     
@@ -30,21 +39,33 @@ class EncryptionService:
         Returns base64-encoded string containing nonce + ciphertext + tag
         """
         # Convert data to JSON bytes
-        json_data = json.dumps(data, separators=(',', ':')).encode('utf-8')
-        
-        # Derive 32-byte key from input key using SHA256
-        key_bytes = hashlib.sha256(key.encode('utf-8')).digest()
-        
+        json_data = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        return EncryptionService.encrypt_bytes(json_data, key)
+    
+    @staticmethod
+    def encrypt_bytes(plaintext: bytes, key: str) -> str:
+        """
+        Encrypt already-serialized bytes using AES-GCM
+        Returns base64-encoded string containing nonce + ciphertext + tag
+        """
+        return EncryptionService.encrypt_bytes_b64(plaintext, key).decode('ascii')
+    
+    @staticmethod
+    def encrypt_bytes_b64(plaintext: bytes, key: str) -> bytes:
+        """
+        Encrypt already-serialized bytes using AES-GCM
+        Returns the base64 of nonce + ciphertext + tag as ASCII bytes, ready to
+        splice into a JSON body without a str round trip
+        """
         # Generate random 12-byte nonce
         nonce = secrets.token_bytes(12)
         
         # Encrypt using AES-GCM
-        aesgcm = AESGCM(key_bytes)
-        ciphertext = aesgcm.encrypt(nonce, json_data, None)
+        aesgcm = _get_aesgcm(key)
+        ciphertext = aesgcm.encrypt(nonce, plaintext, None)
         
         # Combine nonce + ciphertext and encode as base64
-        encrypted_payload = nonce + ciphertext
-        return base64.b64encode(encrypted_payload).decode('utf-8')
+        return binascii.b2a_base64(nonce + ciphertext, newline=False)
     
     @staticmethod
     def decrypt_data(encrypted_data: str, key: str) -> Dict[str, Any]:
@@ -54,26 +75,25 @@ class EncryptionService:
         """
         try:
             # Decode base64
-            encrypted_payload = base64.b64decode(encrypted_data)
+            encrypted_payload = binascii.a2b_base64(encrypted_data)
             
             # Extract nonce (first 12 bytes) and ciphertext
             if len(encrypted_payload) < 12:
                 raise ValueError("Invalid encrypted payload")
             
-            nonce = encrypted_payload[:12]
-            ciphertext = encrypted_payload[12:]
-            
-            # Derive 32-byte key from input key using SHA256
-            key_bytes = hashlib.sha256(key.encode('utf-8')).digest()
+            # Slice through a memoryview so the ciphertext is not copied
+            view = memoryview(encrypted_payload)
+            nonce = view[:12]
+            ciphertext = view[12:]
             
             # Decrypt using AES-GCM
-            aesgcm = AESGCM(key_bytes)
+            aesgcm = _get_aesgcm(key)
             decrypted_data = aesgcm.decrypt(nonce, ciphertext, None)
             
             # Parse JSON
-            return json.loads(decrypted_data.decode('utf-8'))
+            return orjson.loads(decrypted_data)
             
-        except (InvalidTag, ValueError, json.JSONDecodeError, Exception) as e:
+        except (InvalidTag, ValueError, orjson.JSONDecodeError, Exception) as e:
             raise ValueError(f"Decryption failed: {str(e)}")
     
     @staticmethod
@@ -84,5 +104,49 @@ class EncryptionService:
         """
         encrypted_data = EncryptionService.encrypt_data(data, key)
         return {"encrypted_data": encrypted_data}
-
-
+    
+    # Bytes added to each frame: 12-byte nonce + 16-byte GCM tag
+    FRAME_OVERHEAD = 28
+    
+    @staticmethod
+    def encrypt_frame(frame: bytes, key: str, index: int, final: bool = False) -> bytes:
+        """
+        Encrypt one frame of a chunked stream
+        Returns raw nonce + ciphertext + tag; the frame index and final flag are
+        authenticated so frames cannot be reordered or truncated without detection
+        """
+        nonce = secrets.token_bytes(12)
+        aad = struct.pack(">Q?", index, final)
+        return nonce + _get_aesgcm(key).encrypt(nonce, frame, aad)
+    
+    @staticmethod
+    def decrypt_frame(encrypted_payload: bytes, key: str, index: int, final: bool = False) -> bytes:
+        """
+        Decrypt one frame produced by encrypt_frame
+        """
+        try:
+            if len(encrypted_payload) < EncryptionService.FRAME_OVERHEAD:
+                raise ValueError("Invalid encrypted frame")
+            aad = struct.pack(">Q?", index, final)
+            return _get_aesgcm(key).decrypt(encrypted_payload[:12], encrypted_payload[12:], aad)
+        except (InvalidTag, ValueError, Exception) as e:
+            raise ValueError(f"Decryption failed: {str(e)}")
+    
+    @staticmethod
+    def encrypt_chunk(frame: bytes, key: str, index: int, final: bool = False) -> bytes:
+        """
+        Encrypt one frame of a chunked response
+        Returns the encrypt_frame output as a base64 line terminated by a newline
+        """
+        return base64.b64encode(EncryptionService.encrypt_frame(frame, key, index, final)) + b"\n"
+    
+    @staticmethod
+    def decrypt_chunk(line: bytes, key: str, index: int, final: bool = False) -> bytes:
+        """
+        Decrypt one frame produced by encrypt_chunk
+        """
+        try:
+            encrypted_payload = base64.b64decode(line.strip())
+        except ValueError as e:
+            raise ValueError(f"Decryption failed: {str(e)}")
+        return EncryptionService.decrypt_frame(encrypted_payload, key, index, final)
@@ -1,40 +1,163 @@
 from google.cloud import firestore
-from typing import List, Optional, Dict, Any
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.api_core.exceptions import InvalidArgument, NotFound
+from collections import OrderedDict
+from typing import List, Optional, Dict, Any, Set, Tuple, Union
+import asyncio
+import itertools
+import time
 import uuid
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
 from config import settings
 from models import Conversation, Message, ConversationSummary, MessageRole
 
 logger = logging.getLogger(__name__)
 
+# Batch commits in flight at once during bulk deletes
+BATCH_COMMIT_CONCURRENCY = 8
+
+# Marks conversations whose message_count/last_message_preview fields are
+# maintained on every write; older documents are summarized from `messages`
+SUMMARY_VERSION = 1
+
+# Subcollection for messages that no longer fit in the conversation document
+OVERFLOW_COLLECTION = "messages"
+
+# Part of the InvalidArgument message Firestore returns for a write over its 1 MiB document limit
+DOCUMENT_TOO_LARGE = "maximum allowed size"
+
+# Fields a conversation listing reads; the messages array is never downloaded
+SUMMARY_FIELDS = [
+    "conversation_id", "title", "created_at", "last_updated", "starred",
+    "message_count", "last_message_preview", "summary_version",
+]
+
+# Firestore's limit on operations in one write batch
+BATCH_LIMIT = 500
+
+
+class ConversationCache:
+    """Process-local LRU cache of conversations with per-entry expiry
+    
+    Writes made through FirestoreService invalidate their entry; writes from
+    other instances become visible once the entry expires.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # conversation_id -> (monotonic expiry, conversation)
+        self._entries: "OrderedDict[str, Tuple[float, Conversation]]" = OrderedDict()
+        # Bumped by every invalidation; a read that started before one is not cached
+        self.generation = 0
+
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        """Return the cached conversation if present and not expired"""
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            return None
+        expires_at, conversation = entry
+        if time.monotonic() >= expires_at:
+            self._entries.pop(conversation_id, None)
+            return None
+        self._entries.move_to_end(conversation_id)
+        return conversation
+
+    def set(self, conversation_id: str, conversation: Conversation, generation: Optional[int] = None) -> None:
+        """Cache a conversation read at `generation`, unless a write has landed since"""
+        if self.ttl <= 0 or (generation is not None and generation != self.generation):
+            return
+        self._entries[conversation_id] = (time.monotonic() + self.ttl, conversation)
+        self._entries.move_to_end(conversation_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, conversation_id: str) -> None:
+        self.generation += 1
+        self._entries.pop(conversation_id, None)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._entries.clear()
+
 
 class FirestoreService:
     """Service for interacting with Firestore database"""
     
     def __init__(self):
-        self.db = None
+        self._clients: List[firestore.Client] = []
+        self._next_client = itertools.count()
+        self.cache = ConversationCache(
+            maxsize=settings.conversation_cache_max_entries,
+            ttl=settings.conversation_cache_ttl
+        )
+        # Conversations seen with messages_overflow set; their appends skip the array write
+        self._overflowed: Set[str] = set()
         self._initialize_client()
     
     def _initialize_client(self):
-        """Initialize the Firestore client"""
+        """Initialize the pool of Firestore clients"""
         try:
-            self.db = firestore.Client(
-                project=settings.google_cloud_project,
-                database=settings.firestore_database
-            )
-            logger.info("Firestore client initialized successfully")
+            # Each client owns its own gRPC channel, so concurrent calls are
+            # spread over several channels instead of queueing on one
+            self._clients = [
+                firestore.Client(
+                    project=settings.google_cloud_project,
+                    database=settings.firestore_database
+                )
+                for _ in range(max(1, settings.firestore_pool_size))
+            ]
+            logger.info(f"Firestore client pool initialized successfully ({len(self._clients)} clients)")
         except Exception as e:
             logger.error(f"Failed to initialize Firestore client: {e}")
             raise
     
-    async def create_conversation_with_grounding(self, first_message: Message, ai_message: Message, title: str = None) -> str:
+    @property
+    def db(self) -> Optional[firestore.Client]:
+        """Next client from the pool, handed out round-robin"""
+        if not self._clients:
+            return None
+        return self._clients[next(self._next_client) % len(self._clients)]
+    
+    @db.setter
+    def db(self, client: firestore.Client) -> None:
+        self._clients = [client]
+    
+    @staticmethod
+    def _message_record(message: Union[Message, Dict[str, Any]]) -> Dict[str, Any]:
+        """Firestore dict for a message; dicts are taken as already-dumped messages"""
+        if isinstance(message, dict):
+            return message
+        if not message.message_id:
+            message.message_id = str(uuid.uuid4())
+        return message.model_dump()
+    
+    @staticmethod
+    def _message_preview(record: Dict[str, Any]) -> str:
+        """List preview of a stored message: its first 100 characters"""
+        content = record.get("content", "")
+        preview = content[:100]
+        if len(content) > 100:
+            preview += "..."
+        return preview
+    
+    @classmethod
+    def _summary_fields(cls, records: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Denormalized listing fields for a new conversation holding `records`"""
+        return {
+            "message_count": len(records),
+            "last_message_preview": cls._message_preview(records[-1]),
+            "summary_version": SUMMARY_VERSION,
+        }
+    
+    async def create_conversation_with_grounding(self, first_message: Message, ai_message: Union[Message, Dict[str, Any]], title: str = None) -> str:
         """
         Create a new conversation with the first user message and AI response (with grounding support)
         
         Args:
             first_message: The initial user message
-            ai_message: The AI's message (with potential grounding data)
+            ai_message: The AI's message (with potential grounding data), or its model_dump()
             title: Optional conversation title
             
         Returns:
@@ -42,31 +165,30 @@ class FirestoreService:
         """
         try:
             conversation_id = str(uuid.uuid4())
-            now = datetime.utcnow()
+            now = datetime.now(timezone.utc)
             
-            # Set message IDs and timestamps if not already set
-            if not first_message.message_id:
-                first_message.message_id = str(uuid.uuid4())
-            if not ai_message.message_id:
-                ai_message.message_id = str(uuid.uuid4())
+            # Set the AI message timestamp if it has no ID yet
+            if isinstance(ai_message, Message) and not ai_message.message_id:
                 ai_message.created_at = now
             
             # Create conversation document
+            records = [
+                self._message_record(first_message),
+                self._message_record(ai_message)
+            ]
             conversation_data = {
                 "conversation_id": conversation_id,
                 "title": title,
-                "messages": [
-                    first_message.model_dump(),
-                    ai_message.model_dump()
-                ],
+                "messages": records,
                 "created_at": now,
-                "last_updated": now,
-                "starred": False
+                "last_updated": firestore.SERVER_TIMESTAMP,
+                "starred": False,
+                **self._summary_fields(records)
             }
             
             # Save to Firestore
             doc_ref = self.db.collection("conversations").document(conversation_id)
-            doc_ref.set(conversation_data)
+            await asyncio.to_thread(doc_ref.set, conversation_data)
             
             logger.info(f"Created conversation {conversation_id} with grounding support")
             return conversation_id
@@ -89,7 +211,7 @@ class FirestoreService:
         """
         try:
             conversation_id = str(uuid.uuid4())
-            now = datetime.utcnow()
+            now = datetime.now(timezone.utc)
             
             # Create AI response message
             ai_message = Message(
@@ -100,21 +222,23 @@ class FirestoreService:
             )
             
             # Create conversation document
+            records = [
+                self._message_record(first_message),
+                self._message_record(ai_message)
+            ]
             conversation_data = {
                 "conversation_id": conversation_id,
                 "title": title,
-                "messages": [
-                    first_message.model_dump(),
-                    ai_message.model_dump()
-                ],
+                "messages": records,
                 "created_at": now,
-                "last_updated": now,
-                "starred": False
+                "last_updated": firestore.SERVER_TIMESTAMP,
+                "starred": False,
+                **self._summary_fields(records)
             }
             
             # Save to Firestore
             doc_ref = self.db.collection("conversations").document(conversation_id)
-            doc_ref.set(conversation_data)
+            await asyncio.to_thread(doc_ref.set, conversation_data)
             
             logger.info(f"Created conversation {conversation_id}")
             return conversation_id
@@ -135,37 +259,93 @@ class FirestoreService:
         Returns:
             bool: Success status
         """
-        try:
-            doc_ref = self.db.collection("conversations").document(conversation_id)
+        # Both messages land in one ArrayUnion update; a missing conversation
+        # makes the update fail, so no separate existence read is needed
+        return await self.append_messages(conversation_id, [user_message, ai_message])
+
+    async def append_messages(self, conversation_id: str, messages: List[Union[Message, Dict[str, Any]]]) -> bool:
+        """
+        Append messages to an existing conversation in a single update
+        
+        The write runs in a worker thread so callers can start it as a task
+        and keep streaming while it completes.
+        
+        Args:
+            conversation_id: The conversation ID
+            messages: Messages to append, in order; dicts are stored as given
             
-            # Check if conversation exists
-            doc = doc_ref.get()
-            if not doc.exists:
-                logger.warning(f"Conversation {conversation_id} not found")
-                return False
-            
-            # Set message IDs if not already set
-            if not user_message.message_id:
-                user_message.message_id = str(uuid.uuid4())
-            if not ai_message.message_id:
-                ai_message.message_id = str(uuid.uuid4())
-            
-            # Update conversation with new messages
-            doc_ref.update({
-                "messages": firestore.ArrayUnion([
-                    user_message.model_dump(),
-                    ai_message.model_dump()
-                ]),
-                "last_updated": datetime.utcnow()
-            })
+        Returns:
+            bool: Success status (False if the conversation does not exist)
+        """
+        try:
+            records = [self._message_record(message) for message in messages]
+            summary = {
+                "last_updated": firestore.SERVER_TIMESTAMP,
+                "message_count": firestore.Increment(len(records)),
+                "last_message_preview": self._message_preview(records[-1])
+            }
             
-            logger.info(f"Added messages to conversation {conversation_id} with grounding support")
+            doc_ref = self.db.collection("conversations").document(conversation_id)
+            if conversation_id in self._overflowed:
+                # Already full, so the array write would only be rejected again
+                await asyncio.to_thread(self._write_overflow, doc_ref, records, summary)
+            else:
+                try:
+                    await asyncio.to_thread(doc_ref.update, {"messages": firestore.ArrayUnion(records), **summary})
+                except InvalidArgument as e:
+                    if DOCUMENT_TOO_LARGE not in str(e):
+                        raise
+                    # The document is at Firestore's 1 MiB limit, so the messages go to the subcollection
+                    logger.info(f"Conversation {conversation_id} is full, storing messages separately")
+                    await asyncio.to_thread(self._write_overflow, doc_ref, records, summary)
+                    self._overflowed.add(conversation_id)
+            # Drop the entry only once the write landed, so a read racing it cannot re-cache stale data
+            self.cache.invalidate(conversation_id)
+            
+            logger.info(f"Appended {len(messages)} message(s) to conversation {conversation_id}")
             return True
             
+        except NotFound:
+            logger.warning(f"Conversation {conversation_id} not found")
+            return False
         except Exception as e:
-            logger.error(f"Error adding message to conversation with grounding: {e}")
+            logger.error(f"Error appending messages to conversation {conversation_id}: {e}")
             return False
 
+    def _write_overflow(self, doc_ref: Any, records: List[Dict[str, Any]], summary: Dict[str, Any]) -> None:
+        """Store messages in the overflow subcollection and flag the conversation (blocking)"""
+        batch = self.db.batch()
+        messages_ref = doc_ref.collection(OVERFLOW_COLLECTION)
+        for record in records:
+            batch.set(messages_ref.document(record.get("message_id") or str(uuid.uuid4())), record)
+        # Part of the same batch, so a missing conversation fails the whole write with NotFound
+        batch.update(doc_ref, {**summary, "messages_overflow": True})
+        batch.commit()
+
+    def _overflow_messages(self, doc_ref: Any) -> List[Dict[str, Any]]:
+        """Messages kept in the overflow subcollection, oldest first (blocking)"""
+        query = doc_ref.collection(OVERFLOW_COLLECTION).order_by("created_at")
+        return [doc.to_dict() for doc in query.stream()]
+
+    async def record_failed_write(self, conversation_id: str, messages: List[Union[Message, Dict[str, Any]]]) -> None:
+        """
+        Keep messages that could not be appended in a dead-letter collection
+        
+        Args:
+            conversation_id: The conversation the messages belong to
+            messages: The messages that failed to persist
+        """
+        try:
+            doc_ref = self.db.collection("failed_writes").document(str(uuid.uuid4()))
+            await asyncio.to_thread(doc_ref.set, {
+                "conversation_id": conversation_id,
+                "messages": [self._message_record(message) for message in messages],
+                "created_at": datetime.now(timezone.utc)
+            })
+            logger.warning(f"Recorded {len(messages)} unsaved message(s) for conversation {conversation_id}")
+        except Exception as e:
+            logger.error(f"Error recording failed write for conversation {conversation_id}: {e}")
+
     async def add_message_to_conversation(self, conversation_id: str, user_message: Message, ai_response: str) -> bool:
         """
         Add a new user message and AI response to an existing conversation
@@ -178,42 +358,18 @@ class FirestoreService:
         Returns:
             bool: Success status
         """
-        try:
-            doc_ref = self.db.collection("conversations").document(conversation_id)
-            
-            # Check if conversation exists
-            doc = doc_ref.get()
-            if not doc.exists:
-                logger.warning(f"Conversation {conversation_id} not found")
-                return False
-            
-            # Create AI response message
-            ai_message = Message(
-                message_id=str(uuid.uuid4()),
-                role=MessageRole.AI,
-                content=ai_response,
-                created_at=datetime.utcnow()
-            )
-            
-            # Update conversation with new messages
-            doc_ref.update({
-                "messages": firestore.ArrayUnion([
-                    user_message.model_dump(),
-                    ai_message.model_dump()
-                ]),
-                "last_updated": datetime.utcnow()
-            })
-            
-            logger.info(f"Added messages to conversation {conversation_id}")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Error adding message to conversation: {e}")
-            return False
+        # Create AI response message
+        ai_message = Message(
+            message_id=str(uuid.uuid4()),
+            role=MessageRole.AI,
+            content=ai_response
+        )
+        
+        return await self.append_messages(conversation_id, [user_message, ai_message])
     
     async def get_conversation(self, conversation_id: str) -> Optional[Conversation]:
         """
-        Get a conversation by ID
+        Get a conversation by ID, served from the local cache when fresh
         
         Args:
             conversation_id: The conversation ID
@@ -221,9 +377,14 @@ class FirestoreService:
         Returns:
             Conversation: The conversation object, or None if not found
         """
+        cached = self.cache.get(conversation_id)
+        if cached is not None:
+            return cached
+        generation = self.cache.generation
+        
         try:
             doc_ref = self.db.collection("conversations").document(conversation_id)
-            doc = doc_ref.get()
+            doc = await asyncio.to_thread(doc_ref.get)
             
             if not doc.exists:
                 return None
@@ -231,11 +392,16 @@ class FirestoreService:
             data = doc.to_dict()
             
             # Convert messages to Message objects
-            messages = []
-            for msg_data in data.get("messages", []):
-                messages.append(Message(**msg_data))
-            
-            return Conversation(
+            messages = [Message.model_validate(msg_data) for msg_data in data.get("messages", [])]
+            if data.get("messages_overflow"):
+                self._overflowed.add(conversation_id)
+                # Messages that did not fit in the document; small ones may still have been
+                # added to the array afterwards, so the merged list is put in time order
+                for msg_data in await asyncio.to_thread(self._overflow_messages, doc_ref):
+                    messages.append(Message.model_validate(msg_data))
+                messages.sort(key=lambda message: message.created_at)
+            
+            conversation = Conversation(
                 conversation_id=data["conversation_id"],
                 title=data.get("title"),
                 messages=messages,
@@ -243,61 +409,107 @@ class FirestoreService:
                 last_updated=data["last_updated"],
                 starred=data.get("starred", False)
             )
+            self.cache.set(conversation_id, conversation, generation)
+            return conversation
             
         except Exception as e:
             logger.error(f"Error getting conversation {conversation_id}: {e}")
             return None
     
-    async def list_conversations(self, limit: int = 50, offset: int = 0) -> List[ConversationSummary]:
+    async def list_conversations(self, limit: int = 50, offset: int = 0, starred: Optional[bool] = None, cursor: Optional[str] = None) -> List[ConversationSummary]:
         """
         List conversations ordered by last_updated (newest first)
         
         Args:
             limit: Maximum number of conversations to return
-            offset: Number of conversations to skip
+            offset: Number of conversations to skip (ignored when cursor is given)
+            starred: Only return conversations with this starred status (optional)
+            cursor: Conversation ID to start after, from a previous page (optional)
             
         Returns:
             List[ConversationSummary]: List of conversation summaries
         """
         try:
-            # Query conversations ordered by last_updated
-            query = self.db.collection("conversations")\
-                          .order_by("last_updated", direction=firestore.Query.DESCENDING)\
-                          .limit(limit)\
-                          .offset(offset)
-            
-            docs = query.stream()
-            summaries = []
-            
-            for doc in docs:
-                data = doc.to_dict()
-                messages = data.get("messages", [])
-                
-                # Get preview from the last message
-                preview = None
-                if messages:
-                    last_message = messages[-1]
-                    preview = last_message.get("content", "")[:100]
-                    if len(last_message.get("content", "")) > 100:
-                        preview += "..."
-                
-                summary = ConversationSummary(
-                    conversation_id=data["conversation_id"],
-                    title=data.get("title", "Untitled Conversation"),
-                    created_at=data["created_at"],
-                    last_updated=data["last_updated"],
-                    starred=data.get("starred", False),
-                    message_count=len(messages),
-                    preview=preview
-                )
-                summaries.append(summary)
-            
-            return summaries
+            # Query conversations ordered by last_updated; the starred filter
+            # uses the (starred, last_updated DESC) composite index
+            collection = self.db.collection("conversations")
+            query = collection.order_by("last_updated", direction=firestore.Query.DESCENDING)
+            # An equality filter skips documents without the field, and conversations stored
+            # before `starred` existed count as not starred, so starred=False is applied while streaming
+            unstarred_only = starred is False
+            if starred:
+                query = query.where(filter=FieldFilter("starred", "==", True))
+            
+            if cursor:
+                # Resume after the cursor document; unlike offset, skipped documents are not read
+                cursor_doc = await asyncio.to_thread(collection.document(cursor).get, ["last_updated"])
+                if not cursor_doc.exists:
+                    return []
+                query = query.start_after(cursor_doc)
+                offset = 0
+            elif offset and not unstarred_only:
+                query = query.offset(offset)
+            
+            if unstarred_only:
+                query = query.select(SUMMARY_FIELDS)
+                return await asyncio.to_thread(self._summarize_conversations, query, True, offset, limit)
+            
+            query = query.limit(limit).select(SUMMARY_FIELDS)
+            return await asyncio.to_thread(self._summarize_conversations, query)
             
         except Exception as e:
             logger.error(f"Error listing conversations: {e}")
             return []
     
+    def _summarize_conversations(self, query: Any, unstarred_only: bool = False, offset: int = 0, limit: Optional[int] = None) -> List[ConversationSummary]:
+        """Build summaries from a projected query (blocking)
+        
+        Conversations written before the summary fields existed are re-read in
+        full, in one get_all call, and summarized from their messages. With
+        `unstarred_only`, starred conversations are skipped while streaming and
+        `offset`/`limit` apply to what remains; the stream stops once `limit` is reached.
+        """
+        rows: List[Any] = []
+        stale = {}
+        for doc in query.stream():
+            data = doc.to_dict()
+            if unstarred_only:
+                # Missing or None counts as not starred, as in bulk_delete_nonstarred
+                if data.get("starred") is True:
+                    continue
+                if offset:
+                    offset -= 1
+                    continue
+            if data.get("summary_version") != SUMMARY_VERSION:
+                stale[doc.id] = len(rows)
+            rows.append(data)
+            if limit is not None and len(rows) >= limit:
+                break
+        
+        if stale:
+            collection = self.db.collection("conversations")
+            for doc in self.db.get_all([collection.document(doc_id) for doc_id in stale]):
+                if doc.exists:
+                    data = doc.to_dict()
+                    messages = data.get("messages", [])
+                    data["message_count"] = len(messages)
+                    # Get preview from the last message
+                    data["last_message_preview"] = self._message_preview(messages[-1]) if messages else None
+                    rows[stale[doc.id]] = data
+        
+        return [
+            ConversationSummary(
+                conversation_id=data["conversation_id"],
+                title=data.get("title", "Untitled Conversation"),
+                created_at=data["created_at"],
+                last_updated=data["last_updated"],
+                starred=data.get("starred", False),
+                message_count=data.get("message_count", 0),
+                preview=data.get("last_message_preview")
+            )
+            for data in rows
+        ]
+    
     async def delete_conversation(self, conversation_id: str) -> bool:
         """
         Delete a conversation
@@ -310,7 +522,9 @@ class FirestoreService:
         """
         try:
             doc_ref = self.db.collection("conversations").document(conversation_id)
-            doc_ref.delete()
+            await asyncio.to_thread(self._delete_conversation_doc, doc_ref)
+            self.cache.invalidate(conversation_id)
+            self._overflowed.discard(conversation_id)
             logger.info(f"Deleted conversation {conversation_id}")
             return True
             
@@ -318,6 +532,20 @@ class FirestoreService:
             logger.error(f"Error deleting conversation {conversation_id}: {e}")
             return False
     
+    def _delete_conversation_doc(self, doc_ref: Any) -> None:
+        """Delete a conversation along with any overflow messages (blocking)"""
+        refs = list(doc_ref.collection(OVERFLOW_COLLECTION).list_documents())
+        if not refs:
+            doc_ref.delete()
+            return
+        # Messages go first, so a failure never leaves them without their conversation
+        refs.append(doc_ref)
+        for i in range(0, len(refs), BATCH_LIMIT):
+            batch = self.db.batch()
+            for ref in refs[i:i + BATCH_LIMIT]:
+                batch.delete(ref)
+            batch.commit()
+    
     async def star_conversation(self, conversation_id: str, starred: bool) -> bool:
         """
         Star or unstar a conversation
@@ -331,7 +559,8 @@ class FirestoreService:
         """
         try:
             doc_ref = self.db.collection("conversations").document(conversation_id)
-            doc_ref.update({"starred": starred})
+            await asyncio.to_thread(doc_ref.update, {"starred": starred})
+            self.cache.invalidate(conversation_id)
             logger.info(f"{'Starred' if starred else 'Unstarred'} conversation {conversation_id}")
             return True
             
@@ -352,58 +581,108 @@ class FirestoreService:
         """
         try:
             doc_ref = self.db.collection("conversations").document(conversation_id)
-            # Check if conversation exists
-            doc = doc_ref.get()
-            if not doc.exists:
-                logger.warning(f"Conversation {conversation_id} not found for renaming")
-                return False
-            
-            doc_ref.update({
+            # update() fails on a missing document, so no existence read is needed
+            await asyncio.to_thread(doc_ref.update, {
                 "title": title,
-                "last_updated": datetime.utcnow()
+                "last_updated": firestore.SERVER_TIMESTAMP
             })
+            self.cache.invalidate(conversation_id)
             logger.info(f"Renamed conversation {conversation_id} to '{title}'")
             return True
             
+        except NotFound:
+            logger.warning(f"Conversation {conversation_id} not found for renaming")
+            return False
         except Exception as e:
             logger.error(f"Error renaming conversation {conversation_id}: {e}")
             return False
     
+    def _non_starred_refs(self) -> Tuple[List[Any], Dict[str, List[Any]]]:
+        """References of conversations not explicitly starred, and of their overflow messages by conversation ID (blocking)
+        
+        A `starred == False` query would skip conversations with the field
+        missing or null, so this scans instead, projecting only the fields it
+        needs so message arrays are never downloaded.
+        """
+        refs = []
+        message_refs = {}
+        for doc in self.db.collection("conversations").select(["starred", "messages_overflow"]).stream():
+            data = doc.to_dict()
+            # Consider conversation non-starred if starred is False, None, or missing
+            if data.get("starred", False) != True:  # Only keep if explicitly True
+                refs.append(doc.reference)
+                if data.get("messages_overflow"):
+                    message_refs[doc.id] = list(doc.reference.collection(OVERFLOW_COLLECTION).list_documents())
+        return refs, message_refs
+    
     async def bulk_delete_nonstarred(self) -> int:
         """
         Delete all non-starred conversations
         
+        Matching documents are deleted in 500-operation batches whose commits
+        run concurrently in worker threads, at most BATCH_COMMIT_CONCURRENCY at a time.
+        
         Returns:
             int: Number of conversations deleted
         """
         try:
-            # Get all conversations and filter non-starred ones
-            # This handles cases where 'starred' field might be missing or null
-            all_docs = list(self.db.collection("conversations").stream())
-            non_starred_docs = []
-            
-            for doc in all_docs:
-                data = doc.to_dict()
-                # Consider conversation non-starred if starred is False, None, or missing
-                is_starred = data.get("starred", False)
-                if is_starred != True:  # More explicit check - only keep if explicitly True
-                    non_starred_docs.append(doc)
-            
-            logger.info(f"Found {len(non_starred_docs)} non-starred conversations to delete")
-            
-            # Delete in batches
-            batch_size = 500
-            deleted_count = 0
+            # Filter while streaming in a worker thread; only references of
+            # matching conversations are kept, never the snapshots themselves
+            non_starred_refs, message_refs = await asyncio.to_thread(self._non_starred_refs)
+            
+            logger.info(f"Found {len(non_starred_refs)} non-starred conversations to delete")
+            
+            # Delete in batches, committing them in parallel
+            batch_size = BATCH_LIMIT
+            chunks = []
+            commits = []
+            # Bounded so a large cleanup cannot take over the shared worker-thread pool
+            semaphore = asyncio.Semaphore(BATCH_COMMIT_CONCURRENCY)
             
-            for i in range(0, len(non_starred_docs), batch_size):
+            async def commit(refs: List[Any]) -> None:
                 batch = self.db.batch()
-                batch_docs = non_starred_docs[i:i + batch_size]
-                
-                for doc in batch_docs:
-                    batch.delete(doc.reference)
-                
-                batch.commit()
-                deleted_count += len(batch_docs)
+                for ref in refs:
+                    batch.delete(ref)
+                async with semaphore:
+                    await asyncio.to_thread(batch.commit)
+            
+            # Overflow messages go first, so a failure never leaves them without their conversation;
+            # a batch may hold several conversations' messages, and if it fails all of them are kept
+            message_chunks: List[Tuple[set, List[Any]]] = []
+            for conversation_id, refs in message_refs.items():
+                for ref in refs:
+                    if not message_chunks or len(message_chunks[-1][1]) == batch_size:
+                        message_chunks.append((set(), []))
+                    message_chunks[-1][0].add(conversation_id)
+                    message_chunks[-1][1].append(ref)
+            
+            message_results = await asyncio.gather(
+                *(commit(refs) for _, refs in message_chunks), return_exceptions=True
+            )
+            failed = set()
+            for (conversation_ids, refs), result in zip(message_chunks, message_results):
+                if isinstance(result, Exception):
+                    logger.error(f"Error committing delete batch of {len(refs)} overflow messages: {result}")
+                    failed |= conversation_ids
+            if failed:
+                logger.error(f"Keeping {len(failed)} conversations whose overflow messages were not deleted")
+                non_starred_refs = [ref for ref in non_starred_refs if ref.id not in failed]
+            
+            for i in range(0, len(non_starred_refs), batch_size):
+                batch_refs = non_starred_refs[i:i + batch_size]
+                chunks.append(batch_refs)
+                commits.append(commit(batch_refs))
+            
+            results = await asyncio.gather(*commits, return_exceptions=True)
+            
+            deleted_count = 0
+            for batch_refs, result in zip(chunks, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Error committing delete batch of {len(batch_refs)} conversations: {result}")
+                    continue
+                deleted_count += len(batch_refs)
+                for ref in batch_refs:
+                    self.cache.invalidate(ref.id)
             
             logger.info(f"Bulk deleted {deleted_count} non-starred conversations")
             return deleted_count
@@ -1,19 +1,115 @@
+import base64
 import os
-from typing import List, Optional, Tuple
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
+import google_crc32c
 from google.cloud.exceptions import NotFound
 import requests
-from io import BytesIO
+from urllib3.util.retry import Retry
 from urllib.parse import quote
 from config import settings
+from services.ttl_cache import TTLCache
+
+
+# Downloads above this size are fetched as concurrent ranged reads
+PARALLEL_DOWNLOAD_THRESHOLD = 32 << 20
+PARALLEL_DOWNLOAD_CHUNK_SIZE = 8 << 20
+PARALLEL_DOWNLOAD_WORKERS = 8
+
+# Object metadata entries kept for file_exists/get_file_info
+INFO_CACHE_MAX_ENTRIES = 1024
+
+# Distinguishes a metadata cache miss from a cached "object does not exist"
+_MISSING = object()
+
+# URL uploads read the source in small pieces and commit resumable chunks of this size
+URL_READ_SIZE = 1 << 20
+URL_UPLOAD_CHUNK_SIZE = 8 << 20
+
+# Chunked uploads are written here first, then renamed onto their final path
+UPLOAD_STAGING_PREFIX = "uploads-staging/"
+
+
+def _pooled_client(project_id: str, pool_size: int) -> storage.Client:
+    """Storage client whose keep-alive pool is sized for concurrent worker threads"""
+    credentials, _ = google.auth.default(scopes=storage.Client.SCOPE)
+    session = AuthorizedSession(credentials)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    return storage.Client(project=project_id, credentials=credentials, _http=session)
+
+
+def _download_session() -> requests.Session:
+    """Keep-alive session for fetching upload sources; idempotent GETs retry connection errors"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=20, pool_maxsize=40, max_retries=Retry(total=3, backoff_factor=0.2)
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Shared by upload_from_url calls so repeat sources skip the TCP and TLS handshakes
+_source_session = _download_session()
+
+
+def _cache_control(is_public: bool) -> str:
+    """Cache-Control stored on objects; public ones may be served from Google's edge caches"""
+    max_age = settings.gcs_public_cache_max_age
+    if is_public and max_age > 0:
+        return f"public, max-age={max_age}"
+    return "private, max-age=0, no-store"
+
+
+@lru_cache(maxsize=8192)
+def _public_url(bucket_name: str, object_path: str) -> str:
+    """Public URL of an object; memoized since listings build one per public file"""
+    bucket = bucket_name.replace("gs://", "").strip("/")
+    normalized_path = quote(object_path.lstrip("/"), safe="/")
+    return f"https://storage.googleapis.com/{bucket}/{normalized_path}"
 
 
 class GCSService:
     def __init__(self):
         self.project_id = settings.google_cloud_project
         self.bucket_name = settings.gcs_bucket or os.getenv("GCS_BUCKET", "")
-        self.client = storage.Client(project=self.project_id) if self.project_id else None
-        self.bucket = self.client.bucket(self.bucket_name) if self.client and self.bucket_name else None
+        # pid -> (client, bucket); built on first use in each process, so a forked
+        # worker never inherits its parent's sockets and TLS sessions
+        self._handles: Dict[int, Tuple[Optional[storage.Client], Optional[storage.Bucket]]] = {}
+        # is_public filter -> files; cleared by every write below
+        self._listings = TTLCache(maxsize=3, ttl=settings.gcs_list_cache_ttl)
+        # object path -> metadata, or None if missing; also cleared by writes
+        self._info = TTLCache(maxsize=INFO_CACHE_MAX_ENTRIES, ttl=settings.gcs_info_cache_ttl)
+
+    def _handle(self) -> Tuple[Optional[storage.Client], Optional[storage.Bucket]]:
+        pid = os.getpid()
+        handle = self._handles.get(pid)
+        if handle is None:
+            # One client and connection pool per process; the default pool of 10
+            # would make to_thread callers queue for (or reopen) TLS connections
+            client = _pooled_client(self.project_id, settings.gcs_pool_size) if self.project_id else None
+            bucket = client.bucket(self.bucket_name) if client and self.bucket_name else None
+            handle = self._handles.setdefault(pid, (client, bucket))
+        return handle
+
+    @property
+    def client(self) -> Optional[storage.Client]:
+        return self._handle()[0]
+
+    @property
+    def bucket(self) -> Optional[storage.Bucket]:
+        return self._handle()[1]
+
+    def _invalidate_caches(self) -> None:
+        self._listings.clear()
+        self._info.clear()
 
     def _get_object_path(self, file_id: str, is_public: bool = False) -> str:
         folder = "public" if is_public else "private"
@@ -22,33 +118,31 @@ class GCSService:
     def _public_url_for_path(self, object_path: str) -> Optional[str]:
         if not self.bucket_name:
             return None
-        bucket = self.bucket_name.replace("gs://", "").strip("/")
-        normalized_path = quote(object_path.lstrip("/"), safe="/")
-        return f"https://storage.googleapis.com/{bucket}/{normalized_path}"
+        return _public_url(self.bucket_name, object_path)
 
     def upload_from_url(self, url: str, file_id: str, is_public: bool = False, max_size: int = 200 * 1024 * 1024) -> Tuple[str, int]:
         if not self.bucket:
             raise Exception("GCS not configured")
 
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-
-        content_length = response.headers.get('content-length')
-        if content_length and int(content_length) > max_size:
-            raise ValueError(f"File too large: {content_length} bytes")
-
-        data = BytesIO()
-        size = 0
-        for chunk in response.iter_content(chunk_size=8192):
-            size += len(chunk)
-            if size > max_size:
-                raise ValueError(f"File too large: {size} bytes")
-            data.write(chunk)
-
-        data.seek(0)
-        object_path = self._get_object_path(file_id, is_public)
-        blob = self.bucket.blob(object_path)
-        blob.upload_from_file(data)
+        with _source_session.get(url, stream=True) as response:
+            response.raise_for_status()
+
+            content_length = response.headers.get('content-length')
+            if content_length and int(content_length) > max_size:
+                raise ValueError(f"File too large: {content_length} bytes")
+
+            # Bytes go to GCS as they arrive, so memory stays at one upload chunk
+            response.raw.decode_content = True
+            size = 0
+            with self.blob_writer(file_id, is_public=is_public, chunk_size=URL_UPLOAD_CHUNK_SIZE) as (writer, object_path):
+                while True:
+                    chunk = response.raw.read(URL_READ_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_size:
+                        raise ValueError(f"File too large: {size} bytes")
+                    writer.write(chunk)
 
         return object_path, size
 
@@ -62,37 +156,86 @@ class GCSService:
 
         object_path = self._get_object_path(file_id, is_public)
         blob = self.bucket.blob(object_path)
+        # GCS rejects the upload if the stored object does not match this checksum
+        blob.crc32c = base64.b64encode(google_crc32c.Checksum(file_data).digest()).decode("ascii")
+        blob.cache_control = _cache_control(is_public)
         blob.upload_from_string(file_data)
+        self._invalidate_caches()
 
         return object_path, size
 
+    @contextmanager
+    def blob_writer(self, file_id: str, is_public: bool = False, chunk_size: int = 1 << 20) -> Iterator[Tuple[BinaryIO, str]]:
+        """Chunked upload staged under a temporary name and moved into place only when the block exits cleanly
+
+        An existing object at the target path is never touched by a failed upload.
+        """
+        if not self.bucket:
+            raise Exception("GCS not configured")
+
+        object_path = self._get_object_path(file_id, is_public)
+        staging = self.bucket.blob(f"{UPLOAD_STAGING_PREFIX}{uuid.uuid4().hex}")
+        staging.cache_control = _cache_control(is_public)
+        writer = staging.open("wb", chunk_size=chunk_size)
+        try:
+            yield writer, object_path
+        except BaseException:
+            # An unclosed writer would still commit when garbage collected, so commit it
+            # now and drop the staging object; it is the only object this call created
+            try:
+                writer.close()
+                staging.delete()
+            except Exception:
+                pass
+            raise
+        writer.close()
+        try:
+            self.bucket.rename_blob(staging, object_path)
+        finally:
+            self._invalidate_caches()
+
     def list_files(self, is_public: Optional[bool] = None) -> List[dict]:
         if not self.bucket:
             return []
 
-        files = []
+        cached = self._listings.get(is_public)
+        if cached is not None:
+            return cached
+
         if is_public is None:
             prefixes = ["private/", "public/"]
         else:
             prefixes = ["public/"] if is_public else ["private/"]
 
-        for prefix in prefixes:
-            blobs = self.bucket.list_blobs(prefix=prefix)
-            for blob in blobs:
-                if blob.name != prefix:
-                    file_id = blob.name.split("/", 1)[1]
-                    item = {
-                        "file_id": file_id,
-                        "object_path": blob.name,
-                        "size": blob.size,
-                        "is_public": blob.name.startswith("public/")
-                    }
-                    if item["is_public"]:
-                        url = self._public_url_for_path(blob.name)
-                        if url:
-                            item["public_url"] = url
-                    files.append(item)
+        if len(prefixes) == 1:
+            files = self._list_prefix(prefixes[0])
+        else:
+            # Each prefix is its own paged listing, so both are fetched at once
+            with ThreadPoolExecutor(max_workers=len(prefixes)) as pool:
+                files = [item for items in pool.map(self._list_prefix, prefixes) for item in items]
 
+        self._listings.set(is_public, files)
+        return files
+
+    def _list_prefix(self, prefix: str) -> List[dict]:
+        files = []
+        # Only name and size are used, so skip ACLs and the rest of each blob resource
+        for blob in self.bucket.list_blobs(prefix=prefix, fields="items(name,size),nextPageToken"):
+            name = blob.name
+            # Skip the folder placeholder objects
+            if name.endswith("/"):
+                continue
+            item = {
+                "file_id": name.split("/", 1)[1],
+                "object_path": name,
+                "size": blob.size,
+                "is_public": name.startswith("public/")
+            }
+            if item["is_public"]:
+                url = self._public_url_for_path(name)
+                if url:
+                    item["public_url"] = url
+            files.append(item)
         return files
 
     def download_file(self, file_id: str, is_public: bool = False) -> bytes:
@@ -100,13 +243,52 @@ class GCSService:
             raise Exception("GCS not configured")
 
         object_path = self._get_object_path(file_id, is_public)
-        blob = self.bucket.blob(object_path)
+        blob = self.bucket.get_blob(object_path)
+        if blob is None:
+            raise FileNotFoundError(f"File not found: {file_id}")
 
         try:
-            return blob.download_as_bytes()
+            if blob.size <= PARALLEL_DOWNLOAD_THRESHOLD:
+                return blob.download_as_bytes()
+            return self._download_ranges(blob)
         except NotFound:
             raise FileNotFoundError(f"File not found: {file_id}")
 
+    @staticmethod
+    def _download_ranges(blob: storage.Blob) -> bytes:
+        """Fetch a large blob as concurrent ranged reads pinned to one generation"""
+        buf = bytearray(blob.size)
+        view = memoryview(buf)
+
+        def fetch(start: int) -> None:
+            end = min(start + PARALLEL_DOWNLOAD_CHUNK_SIZE, blob.size) - 1
+            view[start:end + 1] = blob.download_as_bytes(start=start, end=end, if_generation_match=blob.generation)
+
+        with ThreadPoolExecutor(max_workers=PARALLEL_DOWNLOAD_WORKERS) as pool:
+            list(pool.map(fetch, range(0, blob.size, PARALLEL_DOWNLOAD_CHUNK_SIZE)))
+        return bytes(buf)
+
+    def open_blob_stream(self, file_id: str, is_public: bool = False, chunk_size: int = 1 << 20) -> Tuple[BinaryIO, int]:
+        """Open a file for chunked reading; returns (reader, size in bytes)"""
+        if not self.bucket:
+            raise Exception("GCS not configured")
+
+        object_path = self._get_object_path(file_id, is_public)
+        blob = self.bucket.get_blob(object_path)
+        if blob is None:
+            raise FileNotFoundError(f"File not found: {file_id}")
+
+        return blob.open("rb", chunk_size=chunk_size), blob.size
+
+    def _move_blob(self, old_path: str, new_path: str, file_id: str) -> None:
+        """Move an object within the bucket (server-side copy, then delete of the source)"""
+        try:
+            self.bucket.rename_blob(self.bucket.blob(old_path), new_path)
+        except NotFound:
+            raise FileNotFoundError(f"File not found: {file_id}")
+        finally:
+            self._invalidate_caches()
+
     def rename_file(self, old_file_id: str, new_file_id: str, is_public: bool = False) -> str:
         if not self.bucket:
             raise Exception("GCS not configured")
@@ -114,9 +296,7 @@ class GCSService:
         old_path = self._get_object_path(old_file_id, is_public)
         new_path = self._get_object_path(new_file_id, is_public)
 
-        old_blob = self.bucket.blob(old_path)
-        new_blob = self.bucket.copy_blob(old_blob, self.bucket, new_path)
-        old_blob.delete()
+        self._move_blob(old_path, new_path, old_file_id)
 
         return new_path
 
@@ -132,6 +312,8 @@ class GCSService:
             return True
         except NotFound:
             return False
+        finally:
+            self._invalidate_caches()
 
     def toggle_share(self, file_id: str, current_is_public: bool) -> Tuple[str, bool]:
         if not self.bucket:
@@ -141,27 +323,25 @@ class GCSService:
         new_is_public = not current_is_public
         new_path = self._get_object_path(file_id, new_is_public)
 
-        old_blob = self.bucket.blob(old_path)
-        new_blob = self.bucket.copy_blob(old_blob, self.bucket, new_path)
-        old_blob.delete()
+        # Set the new caching policy on the source first; the move copies it over.
+        # Going private, this also stops edges from caching the public URL further
+        blob = self.bucket.blob(old_path)
+        blob.cache_control = _cache_control(new_is_public)
+        try:
+            blob.patch()
+        except NotFound:
+            raise FileNotFoundError(f"File not found: {file_id}")
+        self._move_blob(old_path, new_path, file_id)
 
         return new_path, new_is_public
 
-    def file_exists(self, file_id: str, is_public: bool = False) -> bool:
-        if not self.bucket:
-            return False
-
-        object_path = self._get_object_path(file_id, is_public)
-        blob = self.bucket.blob(object_path)
-        return blob.exists()
-
-    def get_file_info(self, file_id: str, is_public: bool = False) -> dict:
-        if not self.bucket:
-            raise Exception("GCS not configured")
+    def _stat(self, object_path: str) -> Optional[dict]:
+        """Object metadata, or None if it does not exist; reused for a few seconds"""
+        cached = self._info.get(object_path, _MISSING)
+        if cached is not _MISSING:
+            return cached
 
-        object_path = self._get_object_path(file_id, is_public)
         blob = self.bucket.blob(object_path)
-
         try:
             blob.reload()
             info = {
@@ -170,13 +350,30 @@ class GCSService:
                 "created": blob.time_created,
                 "updated": blob.updated
             }
-            if is_public:
+            if object_path.startswith("public/"):
                 url = self._public_url_for_path(object_path)
                 if url:
                     info["public_url"] = url
-            return info
         except NotFound:
+            info = None
+
+        self._info.set(object_path, info)
+        return info
+
+    def file_exists(self, file_id: str, is_public: bool = False) -> bool:
+        if not self.bucket:
+            return False
+
+        return self._stat(self._get_object_path(file_id, is_public)) is not None
+
+    def get_file_info(self, file_id: str, is_public: bool = False) -> dict:
+        if not self.bucket:
+            raise Exception("GCS not configured")
+
+        info = self._stat(self._get_object_path(file_id, is_public))
+        if info is None:
             raise FileNotFoundError(f"File not found: {file_id}")
+        return dict(info)
 
 
 gcs_service = GCSService()
@@ -1,18 +1,97 @@
 from google import genai
 import asyncio
 import logging
+import re
+import time
+from operator import itemgetter
 from typing import AsyncGenerator, Optional, Dict, List, Tuple
 from config import settings
 from models import Reference, GroundingSupport
+from services.ttl_cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# Previous messages sent to the model as context
+HISTORY_LIMIT = 10
+
+# Gemini requests in flight at once for one generate_batch call
+BATCH_CONCURRENCY = 8
+
+# Hyphens in model IDs become spaces in display names
+_DISPLAY_NAME_TABLE = str.maketrans('-', ' ')
+
+# Served when the model list cannot be fetched; built once, callers get a shallow copy
+_FALLBACK_MODELS: Tuple[Dict[str, str], ...] = (
+    {
+        'id': 'gemini-2.5-flash',
+        'name': 'Gemini 2.5 Flash',
+        'description': 'Fast and versatile model for most tasks'
+    },
+    {
+        'id': 'gemini-2.5-pro',
+        'name': 'Gemini 2.5 Pro',
+        'description': 'The most powerful model for demanding tasks'
+    },
+    {
+        'id': 'gemini-2.5-flash-lite',
+        'name': 'Gemini 2.5 Flash Lite',
+        'description': 'Best performance for complex reasoning tasks'
+    },
+)
+
+# URLs in a user message, without trailing punctuation; these enable the url_context tool
+_URL_PATTERN = re.compile(r'https?://[^\s<>"{}|\\^`\[\]]+[^\s<>"{}|\\^`\[\].,;:!?)]')
+
+
+def _extract_domain(uri: str) -> str:
+    """Network location of a URL, as urlparse(uri).netloc would give, or 'Unknown'"""
+    start = uri.find('://')
+    if start < 0:
+        return 'Unknown'
+    start += 3
+    end = len(uri)
+    for separator in '/?#':
+        pos = uri.find(separator, start, end)
+        if pos >= 0:
+            end = pos
+    return uri[start:end] or 'Unknown'
+
+
+def _pick(obj, *names, default=None):
+    """First non-None value among `names`, read as dict keys or attributes
+
+    Grounding metadata arrives as SDK objects (snake_case attributes) or raw
+    dicts (camelCase keys), so callers list every spelling once.
+    """
+    if isinstance(obj, dict):
+        for name in names:
+            value = obj.get(name)
+            if value is not None:
+                return value
+        return default
+    for name in names:
+        value = getattr(obj, name, None)
+        if value is not None:
+            return value
+    return default
+
+
+class ResponseCache(TTLCache):
+    """Bounded LRU cache of complete model answers, keyed on the exact request"""
+
 
 class GeminiService:
     """Service for interacting with Google Gemini API"""
     
     def __init__(self):
         self.client = None
+        # (monotonic expiry, models) from the last successful listing
+        self._models_cache: Optional[Tuple[float, List[Dict[str, str]]]] = None
+        self._models_lock = asyncio.Lock()
+        self.responses = ResponseCache(
+            maxsize=settings.response_cache_max_entries,
+            ttl=settings.response_cache_ttl
+        )
         self._initialize_client()
     
     def _initialize_client(self):
@@ -24,6 +103,13 @@ class GeminiService:
             logger.error(f"Failed to initialize Gemini client: {e}")
             raise
     
+    @staticmethod
+    def _build_contents(message: str, conversation_history: Optional[list]) -> List[str]:
+        """Model contents: the last HISTORY_LIMIT history messages, then the current message"""
+        contents = [msg["content"] for msg in conversation_history[-HISTORY_LIMIT:]] if conversation_history else []
+        contents.append(message)
+        return contents
+    
     async def generate_response_stream(self, message: str, conversation_history: Optional[list] = None, enable_search: bool = False, model: str = "gemini-2.5-flash") -> AsyncGenerator[str, None]:
         """
         Generate streaming response from Gemini API
@@ -35,37 +121,46 @@ class GeminiService:
             model: Gemini model to use
             
         Yields:
-            str: Chunks of the AI response
+            str: Chunks of the AI response; an error after the first chunk is raised to the caller
         """
+        # Build the full conversation context including history and current message
+        contents = self._build_contents(message, conversation_history)
+        
+        # Configure generation with search grounding if enabled
+        config = {}
+        if enable_search:
+            config["tools"] = [{"google_search": {}}]
+        
+        # Same key as generate_response, which sends the same request unstreamed
+        cache_key = ("text", model, enable_search, tuple(contents))
+        cached = self.responses.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+        
+        # Only opening the stream is guarded; the per-chunk loop runs outside the try
         try:
-            # Build the full conversation context including history and current message
-            contents = []
-            
-            # Add conversation history
-            if conversation_history:
-                for msg in conversation_history[-10:]:  # Limit context to last 10 messages
-                    contents.append(msg["content"])
-            
-            # Add current message
-            contents.append(message)
-            
-            # Configure generation with search grounding if enabled
-            config = {}
-            if enable_search:
-                config["tools"] = [{"google_search": {}}]
-            
-            # Generate streaming response using async client
-            async for chunk in await self.client.aio.models.generate_content_stream(
+            stream = await self.client.aio.models.generate_content_stream(
                 model=model,
                 contents=contents,
                 config=config
-            ):
-                if chunk.text:
-                    yield chunk.text
-                    
+            )
         except Exception as e:
             logger.error(f"Error generating Gemini response: {e}")
             yield f"Error: Unable to generate response. Please try again."
+            return
+        
+        chunks = []
+        async for chunk in stream:
+            # chunk.text is a property that joins the candidate's parts; read it once
+            text = chunk.text
+            if text:
+                chunks.append(text)
+                yield text
+        
+        # Only a stream that ran to completion is cached
+        if chunks:
+            self.responses.set(cache_key, "".join(chunks))
     
     async def generate_response_with_grounding(self, message: str, conversation_history: Optional[list] = None, enable_search: bool = False, url_context: Optional[List[str]] = None, model: str = "gemini-2.5-flash") -> Tuple[str, List[Reference], List[str], List[GroundingSupport], List[str], bool]:
         """
@@ -83,15 +178,7 @@ class GeminiService:
         """
         try:
             # Build the full conversation context including history and current message
-            contents = []
-            
-            # Add conversation history
-            if conversation_history:
-                for msg in conversation_history[-10:]:  # Limit context to last 10 messages
-                    contents.append(msg["content"])
-            
-            # Add current message
-            contents.append(message)
+            contents = self._build_contents(message, conversation_history)
             
             # Configure generation with tools if enabled
             config = {}
@@ -99,10 +186,9 @@ class GeminiService:
             if enable_search:
                 tools.append({"google_search": {}})
             
-            # Auto-detect URLs in the message content
-            import re
-            url_pattern = r'https?://[^\s<>"{}|\\^`\[\]]+[^\s<>"{}|\\^`\[\].,;:!?)]'
-            detected_urls = re.findall(url_pattern, contents[-1])
+            # Auto-detect URLs in the message content; most messages have none, and
+            # the substring check rules that out without running the regex
+            detected_urls = _URL_PATTERN.findall(message) if 'http' in message else []
             
             if detected_urls:
                 tools.append({"url_context": {}})
@@ -112,6 +198,11 @@ class GeminiService:
             if tools:
                 config["tools"] = tools
             
+            cache_key = ("grounded", model, enable_search, tuple(url_context or ()), tuple(contents))
+            cached = self.responses.get(cache_key)
+            if cached is not None:
+                return cached
+            
             # Generate complete response using async client
             response = await self.client.aio.models.generate_content(
                 model=model,
@@ -120,7 +211,7 @@ class GeminiService:
             )
             
             # Extract response text
-            response_text = response.text if response.text else ""
+            response_text = response.text or ""
             
             # Extract grounding metadata
             references = []
@@ -136,38 +227,20 @@ class GeminiService:
                     grounding_metadata = candidate.grounding_metadata
                     
                     # Extract search queries (webSearchQueries in actual API)
-                    if hasattr(grounding_metadata, 'web_search_queries'):
-                        search_queries = grounding_metadata.web_search_queries or []
-                    elif hasattr(grounding_metadata, 'webSearchQueries'):
-                        search_queries = grounding_metadata.webSearchQueries or []
+                    search_queries = _pick(grounding_metadata, 'web_search_queries', 'webSearchQueries', default=[])
                     
                     # Extract grounding chunks and create references
-                    grounding_chunks = []
-                    if hasattr(grounding_metadata, 'grounding_chunks'):
-                        grounding_chunks = grounding_metadata.grounding_chunks or []
-                    elif hasattr(grounding_metadata, 'groundingChunks'):
-                        grounding_chunks = grounding_metadata.groundingChunks or []
+                    grounding_chunks = _pick(grounding_metadata, 'grounding_chunks', 'groundingChunks', default=[])
                     
                     for i, chunk in enumerate(grounding_chunks):
-                        web_data = None
-                        if hasattr(chunk, 'web') and chunk.web:
-                            web_data = chunk.web
-                        elif isinstance(chunk, dict) and 'web' in chunk:
-                            web_data = chunk['web']
+                        web_data = _pick(chunk, 'web')
                         
                         if web_data:
-                            # Handle both attribute access and dictionary access
-                            uri = getattr(web_data, 'uri', None) or (web_data.get('uri') if isinstance(web_data, dict) else '')
-                            title = getattr(web_data, 'title', None) or (web_data.get('title') if isinstance(web_data, dict) else '')
+                            uri = _pick(web_data, 'uri', default='')
+                            title = _pick(web_data, 'title', default='')
                             
                             if uri:
-                                # Extract domain from URI
-                                try:
-                                    from urllib.parse import urlparse
-                                    parsed_url = urlparse(uri)
-                                    domain = parsed_url.netloc or 'Unknown'
-                                except:
-                                    domain = uri.split('/')[2] if '/' in uri else 'Unknown'
+                                domain = _extract_domain(uri)
                                 
                                 reference = Reference(
                                     id=i + 1,
@@ -179,45 +252,33 @@ class GeminiService:
                                 references.append(reference)
                     
                     # Extract grounding supports
-                    supports_data = []
-                    if hasattr(grounding_metadata, 'grounding_supports'):
-                        supports_data = grounding_metadata.grounding_supports or []
-                    elif hasattr(grounding_metadata, 'groundingSupports'):
-                        supports_data = grounding_metadata.groundingSupports or []
+                    supports_data = _pick(grounding_metadata, 'grounding_supports', 'groundingSupports', default=[])
                     
                     for support in supports_data:
-                        segment = None
-                        indices = []
-                        
-                        if hasattr(support, 'segment') and support.segment:
-                            segment = support.segment
-                            indices = getattr(support, 'grounding_chunk_indices', []) or getattr(support, 'groundingChunkIndices', [])
-                        elif isinstance(support, dict):
-                            segment = support.get('segment')
-                            indices = support.get('groundingChunkIndices', [])
+                        segment = _pick(support, 'segment')
+                        indices = _pick(support, 'grounding_chunk_indices', 'groundingChunkIndices', default=[])
                         
                         if segment:
-                            start_idx = getattr(segment, 'start_index', None) or getattr(segment, 'startIndex', None) or (segment.get('startIndex') if isinstance(segment, dict) else 0)
-                            end_idx = getattr(segment, 'end_index', None) or getattr(segment, 'endIndex', None) or (segment.get('endIndex') if isinstance(segment, dict) else 0)
-                            text = getattr(segment, 'text', None) or (segment.get('text') if isinstance(segment, dict) else '')
-                            
-                            grounding_support = GroundingSupport(
-                                start_index=start_idx or 0,
-                                end_index=end_idx or 0,
-                                text=text or '',
-                                reference_indices=[i + 1 for i in indices] if indices else []
-                            )
-                            grounding_supports.append(grounding_support)
+                            grounding_supports.append(GroundingSupport(
+                                start_index=_pick(segment, 'start_index', 'startIndex', default=0),
+                                end_index=_pick(segment, 'end_index', 'endIndex', default=0),
+                                text=_pick(segment, 'text', default=''),
+                                # Chunk indices are 0-based; reference ids start at 1
+                                reference_indices=[i + 1 for i in indices]
+                            ))
             
             # Check for URL context usage
             if url_context and len(url_context) > 0:
                 grounded = True  # URL context also counts as grounded
             
             # Process inline citations in the response text
-            if grounded and grounding_supports and references:
+            if grounded and references and any(support.reference_indices for support in grounding_supports):
                 response_text = self._insert_inline_citations(response_text, grounding_supports)
             
-            return response_text, references, search_queries, grounding_supports, url_context_urls, grounded
+            result = (response_text, references, search_queries, grounding_supports, url_context_urls, grounded)
+            if response_text:
+                self.responses.set(cache_key, result)
+            return result
             
         except Exception as e:
             logger.error(f"Error generating Gemini response with grounding: {e}")
@@ -236,17 +297,50 @@ class GeminiService:
             str: Complete AI response
         """
         try:
-            # Collect all chunks from streaming response
-            response_chunks = []
-            async for chunk in self.generate_response_stream(message, conversation_history, model=model):
-                response_chunks.append(chunk)
+            contents = self._build_contents(message, conversation_history)
+            cache_key = ("text", model, False, tuple(contents))
+            cached = self.responses.get(cache_key)
+            if cached is not None:
+                return cached
             
-            return "".join(response_chunks)
+            # One request for the whole answer; streaming only pays off when chunks are forwarded
+            response = await self.client.aio.models.generate_content(
+                model=model,
+                contents=contents
+            )
+            
+            text = response.text or ""
+            if text:
+                self.responses.set(cache_key, text)
+            return text
             
         except Exception as e:
             logger.error(f"Error generating Gemini response: {e}")
             return "Error: Unable to generate response. Please try again."
     
+    async def generate_batch(self, messages: List[str], model: str = "gemini-2.5-flash", max_concurrency: int = BATCH_CONCURRENCY) -> List[str]:
+        """
+        Answer independent prompts concurrently
+        
+        Every request is scheduled before any is awaited; the semaphore keeps
+        at most `max_concurrency` of them in flight.
+        
+        Args:
+            messages: Prompts, each answered without history
+            model: Gemini model to use
+            max_concurrency: Maximum simultaneous API requests
+            
+        Returns:
+            List[str]: Responses in the order of `messages`
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def generate_one(message: str) -> str:
+            async with semaphore:
+                return await self.generate_response(message, model=model)
+        
+        return await asyncio.gather(*(generate_one(message) for message in messages))
+    
     async def generate_title(self, first_message: str) -> str:
         """
         Generate a title for a conversation based on the first message
@@ -288,23 +382,28 @@ class GeminiService:
             str: Text with inline citations inserted
         """
         try:
-            # Sort supports by start index in reverse order to maintain indices when inserting
-            sorted_supports = sorted(grounding_supports, key=lambda x: x.start_index, reverse=True)
-            
-            result_text = text
-            
-            for support in sorted_supports:
-                if support.reference_indices:
-                    # Create citation string like [1][2] for multiple references
-                    citations = ''.join([f'[{idx}]' for idx in support.reference_indices])
-                    
-                    # Insert citation at the end of the grounded segment
-                    end_pos = support.end_index
-                    if end_pos <= len(result_text):
-                        # Insert citation after the grounded text
-                        result_text = result_text[:end_pos] + citations + result_text[end_pos:]
-            
-            return result_text
+            # (end, start, citation string like [1][2]) per citable support; the tuples
+            # sort on their positions in C, and stably, without a Python key per comparison
+            citations = [
+                (support.end_index, support.start_index, ''.join([f'[{idx}]' for idx in support.reference_indices]))
+                for support in grounding_supports
+                if support.reference_indices and support.end_index <= len(text)
+            ]
+            if not citations:
+                return text
+            citations.sort(key=itemgetter(0, 1))
+            
+            # Walk the supports in text order, copying each stretch of the original text once
+            parts = []
+            cursor = 0
+            for end_pos, _, citation in citations:
+                # Insert citation at the end of the grounded segment
+                parts.append(text[cursor:end_pos])
+                parts.append(citation)
+                cursor = end_pos
+            parts.append(text[cursor:])
+            
+            return ''.join(parts)
             
         except Exception as e:
             logger.error(f"Error inserting inline citations: {e}")
@@ -314,68 +413,73 @@ class GeminiService:
         """
         Get list of available Gemini models that support generateContent
         
+        The API listing is reused for `models_cache_ttl` seconds; concurrent
+        callers share a single refresh. Fallback models are never cached.
+        
         Returns:
             List[Dict[str, str]]: List of models with id and name
         """
-        try:
-            models = []
-            logger.info("Fetching available models from Google AI API...")
-            
-            # Use the synchronous models.list() method - it's not async
-            for model in self.client.models.list():
-                logger.debug(f"Checking model: {model.name}, supported_actions: {getattr(model, 'supported_actions', 'None')}")
-                
-                # Check if model supports generateContent action
-                if hasattr(model, 'supported_actions') and 'generateContent' in model.supported_actions:
-                    # Extract model name and create a display name
-                    model_id = model.name
-                    # Remove 'models/' prefix if present
-                    display_name = model_id.replace('models/', '')
-                    # Create a more readable name
-                    display_name = display_name.replace('gemini-', 'Gemini ').replace('-', ' ').title()
-                    
-                    models.append({
-                        'id': model_id,
-                        'name': display_name,
-                        'description': f'Google {display_name} model'
-                    })
-                    logger.info(f"Added model: {model_id} -> {display_name}")
-            
-            # Sort models by name
-            models.sort(key=lambda x: x['name'])
-            logger.info(f"Found {len(models)} models that support generateContent")
+        cached = self._cached_models()
+        if cached is not None:
+            return cached
+        async with self._models_lock:
+            # Another request may have refreshed the list while we waited
+            cached = self._cached_models()
+            if cached is not None:
+                return cached
+            try:
+                logger.info("Fetching available models from Google AI API...")
+                # models.list() is synchronous and pages over HTTP, so keep it off the event loop
+                models = await asyncio.to_thread(self._list_models)
+            except Exception as e:
+                logger.error(f"Error fetching available models: {e}")
+                return self._get_fallback_models()
             
             # If no models found, return fallback
             if not models:
                 logger.warning("No models found from API, returning fallback models")
                 return self._get_fallback_models()
-                
-            return models
             
-        except Exception as e:
-            logger.error(f"Error fetching available models: {e}")
-            return self._get_fallback_models()
+            self._models_cache = (time.monotonic() + settings.models_cache_ttl, models)
+            return models
+    
+    def _cached_models(self) -> Optional[List[Dict[str, str]]]:
+        """Return the cached model list if present and not expired"""
+        if self._models_cache is None:
+            return None
+        expires_at, models = self._models_cache
+        if time.monotonic() >= expires_at:
+            return None
+        return models
+    
+    def _list_models(self) -> List[Dict[str, str]]:
+        """List models supporting generateContent from the API (blocking)"""
+        models = []
+        for model in self.client.models.list():
+            logger.debug(f"Checking model: {model.name}, supported_actions: {getattr(model, 'supported_actions', 'None')}")
+            
+            # Check if model supports generateContent action
+            if hasattr(model, 'supported_actions') and 'generateContent' in model.supported_actions:
+                # Extract model name and create a display name
+                model_id = model.name
+                # Drop the 'models/' prefix and make a readable name: models/gemini-2.5-pro -> Gemini 2.5 Pro
+                display_name = model_id.removeprefix('models/').translate(_DISPLAY_NAME_TABLE).title()
+                
+                models.append({
+                    'id': model_id,
+                    'name': display_name,
+                    'description': f'Google {display_name} model'
+                })
+                logger.info(f"Added model: {model_id} -> {display_name}")
+        
+        # Sort models by name
+        models.sort(key=lambda x: x['name'])
+        logger.info(f"Found {len(models)} models that support generateContent")
+        return models
     
     def _get_fallback_models(self) -> List[Dict[str, str]]:
         """Return fallback models if API fails"""
-        return [
-            {
-                'id': 'gemini-2.5-flash',
-                'name': 'Gemini 2.5 Flash',
-                'description': 'Fast and versatile model for most tasks'
-            },
-            {
-                'id': 'gemini-2.5-pro',
-                'name': 'Gemini 2.5 Pro',
-                'description': 'The most powerful model for demanding tasks'
-            },
-            {
-                'id': 'gemini-2.5-flash-lite',
-                'name': 'Gemini 2.5 Flash Lite',
-                'description': 'Best performance for complex reasoning tasks'
-            }
-        ]
-
+        return list(_FALLBACK_MODELS)
 
 # Global service instance
 gemini_service = GeminiService()
\ No newline at end of file
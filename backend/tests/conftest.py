@@ -17,8 +17,15 @@ def test_env():
     yield
 
 
-@pytest.fixture()
+@pytest.fixture(scope="session")
+def server_key(test_env):
+    from backend.services.encryption_service import EncryptionService
+    return EncryptionService.get_server_encryption_key()
+
+
+@pytest.fixture(scope="module")
 def app_client(test_env):
+    # One client per test module; per-test state (stores, service doubles) lives in function-scoped fixtures
     # Patch Firestore client to avoid real GCP calls during import
     class _DummyDoc:
         def set(self, *a, **k):
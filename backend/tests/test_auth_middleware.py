@@ -0,0 +1,90 @@
+import asyncio
+import pytest
+from backend.middleware import auth_middleware
+from backend.middleware.auth_middleware import TokenCache
+
+
+auth_service = auth_middleware.auth_service
+
+
+@pytest.fixture()
+def counted_verify(monkeypatch):
+    calls = []
+    original = auth_service.verify_token
+
+    def _verify(token, token_type="access"):
+        calls.append(token)
+        return original(token, token_type=token_type)
+
+    monkeypatch.setattr(auth_service, "verify_token", _verify)
+    monkeypatch.setattr(auth_middleware, "token_cache", TokenCache(maxsize=2, ttl=60))
+    yield calls
+
+
+def test_verified_token_is_reused(counted_verify):
+    token = auth_service.create_access_token({"sub": "admin"})
+
+    first = auth_middleware._verify_access_token(token)
+    second = auth_middleware._verify_access_token(token)
+
+    assert first.username == second.username == "admin"
+    assert len(counted_verify) == 1
+
+
+def test_token_cache_evicts_least_recently_used(counted_verify):
+    tokens = [auth_service.create_access_token({"sub": f"user{i}"}) for i in range(3)]
+    for token in tokens:
+        auth_middleware._verify_access_token(token)
+
+    # Oldest entry was evicted, so it is verified again
+    auth_middleware._verify_access_token(tokens[0])
+    assert len(counted_verify) == 4
+
+
+def test_token_cache_disabled_with_zero_ttl(counted_verify, monkeypatch):
+    monkeypatch.setattr(auth_middleware, "token_cache", TokenCache(maxsize=10, ttl=0))
+    token = auth_service.create_access_token({"sub": "admin"})
+
+    auth_middleware._verify_access_token(token)
+    auth_middleware._verify_access_token(token)
+
+    assert len(counted_verify) == 2
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("", None),
+    ("Bearer abc.def", "abc.def"),
+    ("bearer abc.def", "abc.def"),
+    ("Basic abc", None),
+    ("Bearer", None),
+])
+def test_bearer_token_parsing(header, expected):
+    assert asyncio.run(auth_middleware.bearer_token(header)) == expected
+
+
+def test_password_hashes_verify():
+    import hashlib
+    hashed = auth_service.hash_password("s3cret")
+    assert hashed.startswith("scrypt$")
+    assert auth_service.verify_password("s3cret", hashed)
+    assert not auth_service.verify_password("wrong", hashed)
+    assert not auth_service.verify_password("s3cret", "scrypt$broken")
+
+    # Plain SHA-256 digests configured before scrypt support keep working
+    legacy = hashlib.sha256(b"s3cret").hexdigest()
+    assert auth_service.verify_password("s3cret", legacy)
+    assert not auth_service.verify_password("wrong", legacy)
+
+
+def test_cached_token_never_outlives_its_exp(counted_verify, monkeypatch):
+    from datetime import timedelta
+    monkeypatch.setattr(auth_middleware, "token_cache", TokenCache(maxsize=2, ttl=3600))
+    token = auth_service.create_access_token({"sub": "admin"}, expires_delta=timedelta(seconds=30))
+    token_data = auth_middleware._verify_access_token(token)
+    assert token_data.expires_at is not None
+
+    # Past the token's own expiry the cache entry is gone, even with a long cache TTL
+    real_monotonic = auth_middleware.time.monotonic
+    monkeypatch.setattr(auth_middleware.time, "monotonic", lambda: real_monotonic() + 60)
+    assert auth_middleware.token_cache.get(token) is None
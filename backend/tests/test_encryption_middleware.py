@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+from backend.middleware import encryption_middleware
+from backend.middleware.encryption_middleware import EncryptionMiddleware
+
+
+EncryptionService = encryption_middleware.EncryptionService
+
+
+def _json_app(payload, chunks=1):
+    body = json.dumps(payload).encode()
+    size = -(-len(body) // chunks)
+
+    async def app(scope, receive, send):
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        parts = [body[i:i + size] for i in range(0, len(body), size)]
+        for i, part in enumerate(parts):
+            await send({"type": "http.response.body", "body": part, "more_body": i < len(parts) - 1})
+
+    return app
+
+
+def _get(app, path="/api/notes/"):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": path, "headers": []}
+    asyncio.run(EncryptionMiddleware(app)(scope, receive, send))
+    return messages
+
+
+def test_small_response_is_encrypted_whole(monkeypatch):
+    monkeypatch.setattr(encryption_middleware.settings, "encryption_stream_threshold", 0)
+    payload = {"items": list(range(50))}
+
+    start, body = _get(_json_app(payload, chunks=3))
+
+    encrypted = json.loads(body["body"])
+    key = EncryptionService.get_server_encryption_key()
+    assert EncryptionService.decrypt_data(encrypted["encrypted_data"], key) == payload
+    assert dict(start["headers"])[b"content-length"] == str(len(body["body"])).encode()
+
+
+def test_large_response_is_streamed_as_encrypted_frames(monkeypatch):
+    monkeypatch.setattr(encryption_middleware.settings, "encryption_stream_threshold", 32)
+    payload = {"items": list(range(50))}
+
+    messages = _get(_json_app(payload, chunks=3))
+    start, bodies = messages[0], messages[1:]
+
+    headers = dict(start["headers"])
+    assert headers[b"x-encrypted-chunked"] == b"1"
+    assert headers[b"content-type"] == b"application/octet-stream"
+    assert b"content-length" not in headers
+    assert len(bodies) > 2 and not bodies[-1]["more_body"]
+
+    key = EncryptionService.get_server_encryption_key()
+    plain = b"".join(
+        EncryptionService.decrypt_chunk(m["body"], key, i, final=(i == len(bodies) - 1))
+        for i, m in enumerate(bodies)
+    )
+    assert json.loads(plain) == payload
+
+
+def test_large_payload_crypto_runs_off_the_event_loop(monkeypatch):
+    monkeypatch.setattr(encryption_middleware.settings, "encryption_stream_threshold", 0)
+    monkeypatch.setattr(encryption_middleware, "CRYPTO_OFFLOAD_THRESHOLD", 100)
+    offloaded = []
+    to_thread = asyncio.to_thread
+
+    async def _to_thread(func, *args):
+        offloaded.append(func.__name__)
+        return await to_thread(func, *args)
+
+    monkeypatch.setattr(encryption_middleware.asyncio, "to_thread", _to_thread)
+
+    _get(_json_app({"ok": True}))
+    assert offloaded == []
+
+    payload = {"items": list(range(200))}
+    start, body = _get(_json_app(payload))
+    assert offloaded == ["encrypt_bytes_b64"]
+    key = EncryptionService.get_server_encryption_key()
+    assert EncryptionService.decrypt_data(json.loads(body["body"])["encrypted_data"], key) == payload
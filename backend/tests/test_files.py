@@ -1,81 +1,87 @@
+import contextlib
+import io
 import pytest
 from backend.services.encryption_service import EncryptionService
 
 
 class FakeGCS:
     def __init__(self):
-        self.store = {False: {}, True: {}}
+        self.store: dict[tuple[bool, str], bytes] = {}
     def upload_from_bytes(self, data: bytes, file_id: str, is_public=False):
-        self.store[is_public][file_id] = data
+        self.store[(is_public, file_id)] = data
         return (f"{'public' if is_public else 'private'}/{file_id}", len(data))
     def upload_from_url(self, url: str, file_id: str, is_public=False):
         content = b"url-bytes"
-        self.store[is_public][file_id] = content
+        self.store[(is_public, file_id)] = content
         return (f"{'public' if is_public else 'private'}/{file_id}", len(content))
     def list_files(self, is_public=None):
         items = []
-        if is_public is None:
-            spaces = [False, True]
-        else:
-            spaces = [is_public]
-        for pub in spaces:
-            for fid, data in self.store[pub].items():
-                items.append({
-                    "file_id": fid,
-                    "object_path": f"{'public' if pub else 'private'}/{fid}",
-                    "size": len(data),
-                    "is_public": pub
-                })
+        for (pub, fid), data in self.store.items():
+            if is_public is not None and pub != is_public:
+                continue
+            items.append({
+                "file_id": fid,
+                "object_path": f"{'public' if pub else 'private'}/{fid}",
+                "size": len(data),
+                "is_public": pub
+            })
         return items
     def download_file(self, file_id: str, is_public=False):
-        return self.store[is_public][file_id]
+        return self.store[(is_public, file_id)]
+    @contextlib.contextmanager
+    def blob_writer(self, file_id: str, is_public=False, chunk_size=1 << 20):
+        writer = io.BytesIO()
+        yield writer, f"{'public' if is_public else 'private'}/{file_id}"
+        self.store[(is_public, file_id)] = writer.getvalue()
+    def open_blob_stream(self, file_id: str, is_public=False, chunk_size=1 << 20):
+        data = self.store[(is_public, file_id)]
+        return io.BytesIO(data), len(data)
     def rename_file(self, old_file_id: str, new_file_id: str, is_public=False):
-        self.store[is_public][new_file_id] = self.store[is_public].pop(old_file_id)
+        self.store[(is_public, new_file_id)] = self.store.pop((is_public, old_file_id))
         return f"{'public' if is_public else 'private'}/{new_file_id}"
     def delete_file(self, file_id: str, is_public=False):
-        if file_id in self.store[is_public]:
-            del self.store[is_public][file_id]
-            return True
-        return False
+        return self.store.pop((is_public, file_id), None) is not None
     def toggle_share(self, file_id: str, current_is_public: bool):
-        data = self.store[current_is_public].pop(file_id)
+        data = self.store.pop((current_is_public, file_id))
         new_pub = not current_is_public
-        self.store[new_pub][file_id] = data
+        self.store[(new_pub, file_id)] = data
         return (f"{'public' if new_pub else 'private'}/{file_id}", new_pub)
     def get_file_info(self, file_id: str, is_public=False):
-        data = self.store[is_public][file_id]
+        data = self.store[(is_public, file_id)]
         return {"size": len(data), "content_type": None, "created": None, "updated": None}
 
 
 @pytest.fixture(autouse=True)
 def patch_gcs(monkeypatch):
-    from backend.services import gcs_service as gcs_mod
-    gcs_mod.gcs_service = FakeGCS()
-    yield
+    # The router imported gcs_service by name, so its reference is the one to replace
+    from backend.routers import files as files_router
+    fake = FakeGCS()
+    monkeypatch.setattr(files_router, "gcs_service", fake)
+    yield fake
 
 
-def test_file_upload_list_download_delete(app_client):
+def test_file_upload_list_download_delete(app_client, server_key, patch_gcs):
     # List empty
     r0 = app_client.get("/api/files/")
     assert r0.status_code == 200
-    dec0 = EncryptionService.decrypt_data(r0.json()["encrypted_data"], EncryptionService.get_server_encryption_key())
+    dec0 = EncryptionService.decrypt_data(r0.json()["encrypted_data"], server_key)
     assert dec0["files"] == []
 
     # Upload
     data = b"hello"
     r1 = app_client.post("/api/files/upload", files={"file": ("hello.txt", data)})
     assert r1.status_code == 200
-    dec1 = EncryptionService.decrypt_data(r1.json()["encrypted_data"], EncryptionService.get_server_encryption_key())
+    dec1 = EncryptionService.decrypt_data(r1.json()["encrypted_data"], server_key)
     fid = dec1["file_id"]
 
     # List non-empty
     r2 = app_client.get("/api/files/")
-    dec2 = EncryptionService.decrypt_data(r2.json()["encrypted_data"], EncryptionService.get_server_encryption_key())
+    dec2 = EncryptionService.decrypt_data(r2.json()["encrypted_data"], server_key)
     assert any(item["file_id"] == fid for item in dec2["files"])
 
     # Info
     r3 = app_client.get(f"/api/files/{fid}")
-    dec3 = EncryptionService.decrypt_data(r3.json()["encrypted_data"], EncryptionService.get_server_encryption_key())
+    dec3 = EncryptionService.decrypt_data(r3.json()["encrypted_data"], server_key)
     assert dec3["size"] == len(data)
 
     # Download
@@ -86,14 +92,21 @@ def test_file_upload_list_download_delete(app_client):
     # Rename
     r5 = app_client.patch(f"/api/files/{fid}", data={"new_file_id": "newid", "public": "false"})
     assert r5.status_code == 200
-    dec5 = EncryptionService.decrypt_data(r5.json()["encrypted_data"], EncryptionService.get_server_encryption_key())
+    dec5 = EncryptionService.decrypt_data(r5.json()["encrypted_data"], server_key)
     assert dec5["file_id"] == "newid"
 
     # Toggle share
     r6 = app_client.post(f"/api/files/newid/toggle-share", data={"current_public": "false"})
     assert r6.status_code == 200
-    dec6 = EncryptionService.decrypt_data(r6.json()["encrypted_data"], EncryptionService.get_server_encryption_key())
+    dec6 = EncryptionService.decrypt_data(r6.json()["encrypted_data"], server_key)
     assert dec6["is_public"] is True
+    assert list(patch_gcs.store) == [(True, "newid")]
+
+    # Listing filtered by visibility only returns the shared file
+    r6a = app_client.get("/api/files/?is_public=false")
+    assert EncryptionService.decrypt_data(r6a.json()["encrypted_data"], server_key)["files"] == []
+    r6c = app_client.get("/api/files/?is_public=true")
+    assert [f["file_id"] for f in EncryptionService.decrypt_data(r6c.json()["encrypted_data"], server_key)["files"]] == ["newid"]
 
     # Public download via site route
     r6b = app_client.get(f"/api/files/public/newid")
@@ -101,7 +114,56 @@ def test_file_upload_list_download_delete(app_client):
     assert r6b.content == data
 
     # Delete
-    r7 = app_client.delete("/api/files/newid")
+    r7 = app_client.delete("/api/files/newid?public=true")
     assert r7.status_code == 200
-    dec7 = EncryptionService.decrypt_data(r7.json()["encrypted_data"], EncryptionService.get_server_encryption_key())
+    dec7 = EncryptionService.decrypt_data(r7.json()["encrypted_data"], server_key)
     assert dec7["success"] is True
+    assert patch_gcs.store == {}
+
+
+def test_file_upload_encrypted_binary_frames(app_client, server_key, monkeypatch):
+    from backend.routers import files as files_router
+    key = server_key
+    data = b"0123456789abcdefghij"
+    frames = [data[i:i + 8] for i in range(0, len(data), 8)]
+    body = b"".join(
+        EncryptionService.encrypt_frame(frame, key, i, final=(i == len(frames) - 1))
+        for i, frame in enumerate(frames)
+    )
+
+    r1 = app_client.post(
+        "/api/files/upload-encrypted-binary",
+        files={"file": ("blob.bin", body)},
+        data={"file_id": "bin1", "frame_size": "8"},
+    )
+    assert r1.status_code == 200
+    dec1 = EncryptionService.decrypt_data(r1.json()["encrypted_data"], key)
+    assert dec1["size"] == len(data)
+
+    r2 = app_client.get("/api/files/bin1/download")
+    assert r2.content == data
+
+    # Dropping the final frame is detected and nothing is stored
+    r3 = app_client.post(
+        "/api/files/upload-encrypted-binary",
+        files={"file": ("blob.bin", body[:2 * (8 + EncryptionService.FRAME_OVERHEAD)])},
+        data={"file_id": "bin2", "frame_size": "8"},
+    )
+    assert r3.status_code == 400
+
+    # Past the size limit is 413; the frames themselves are valid
+    monkeypatch.setattr(files_router, "MAX_UPLOAD_SIZE", 10)
+    r4 = app_client.post(
+        "/api/files/upload-encrypted-binary",
+        files={"file": ("blob.bin", body)},
+        data={"file_id": "bin3", "frame_size": "8"},
+    )
+    assert r4.status_code == 413
+
+
+def test_file_upload_over_limit_is_413(app_client, monkeypatch, patch_gcs):
+    from backend.routers import files as files_router
+    monkeypatch.setattr(files_router, "MAX_UPLOAD_SIZE", 4)
+    r = app_client.post("/api/files/upload", files={"file": ("big.txt", b"0123456789")})
+    assert r.status_code == 413
+    assert patch_gcs.store == {}
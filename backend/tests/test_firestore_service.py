@@ -0,0 +1,387 @@
+import asyncio
+from datetime import datetime
+from unittest.mock import patch
+import pytest
+from backend.models import Message, MessageRole
+
+
+class _Snapshot:
+    def __init__(self, data):
+        self._data = data
+        self.exists = data is not None
+    def to_dict(self):
+        return dict(self._data)
+
+
+class _Doc:
+    def __init__(self, db, doc_id):
+        self.db = db
+        self.doc_id = doc_id
+        self.id = doc_id
+    def get(self, field_paths=None):
+        self.db.reads += 1
+        return _Snapshot(self.db.docs.get(self.doc_id))
+    def update(self, fields):
+        from google.api_core.exceptions import InvalidArgument, NotFound
+        if self.doc_id not in self.db.docs:
+            raise NotFound(self.doc_id)
+        if "messages" in fields:
+            self.db.array_writes += 1
+            if self.db.error is not None:
+                raise self.db.error
+            if self.db.full:
+                raise InvalidArgument("Document exceeds the maximum allowed size")
+        from google.cloud import firestore
+        self.db.updates.append((self.doc_id, fields))
+        # The server fills in SERVER_TIMESTAMP fields
+        self.db.docs[self.doc_id].update({
+            k: datetime.now() if v is firestore.SERVER_TIMESTAMP else v for k, v in fields.items()
+        })
+    def delete(self):
+        self.db.docs.pop(self.doc_id, None)
+    def collection(self, name):
+        return _SubCol(self.db, f"{self.doc_id}/{name}/")
+
+
+class _SubCol:
+    def __init__(self, db, prefix):
+        self.db = db
+        self.prefix = prefix
+    def document(self, doc_id):
+        return _Doc(self.db, self.prefix + doc_id)
+    def list_documents(self):
+        return [_Doc(self.db, key) for key in self.db.docs if key.startswith(self.prefix)]
+    def order_by(self, field):
+        db, prefix = self.db, self.prefix
+        class _Ordered:
+            def stream(self):
+                docs = [data for key, data in db.docs.items() if key.startswith(prefix)]
+                return iter([_Snapshot(data) for data in sorted(docs, key=lambda d: d[field])])
+        return _Ordered()
+
+
+class _Query:
+    def __init__(self, db, ops):
+        self.db = db
+        self.ops = ops
+    def __getattr__(self, name):
+        return lambda *a, **k: _Query(self.db, self.ops + [(name, a[0] if a else k["filter"])])
+    def stream(self):
+        self.db.queries.append(self.ops)
+        return iter(self.db.listed)
+
+
+class _DB:
+    def __init__(self):
+        self.reads = 0
+        self.commits = 0
+        self.queries = []
+        self.updates = []
+        self.listed = []
+        self.full = False
+        self.error = None
+        self.array_writes = 0
+        now = datetime(2024, 1, 1)
+        self.docs = {"c1": {"conversation_id": "c1", "title": "T", "messages": [],
+                            "created_at": now, "last_updated": now, "starred": False}}
+    def collection(self, name):
+        db = self
+        class _Col:
+            def document(self, doc_id):
+                return _Doc(db, doc_id)
+            def select(self, fields):
+                return self
+            def order_by(self, field, direction=None):
+                return _Query(db, [("order_by", field)])
+            def stream(self):
+                for doc_id, data in list(db.docs.items()):
+                    snap = _Snapshot(data)
+                    snap.id = doc_id
+                    snap.reference = _Doc(db, doc_id)
+                    yield snap
+        return _Col()
+    def get_all(self, refs):
+        for ref in refs:
+            self.reads += 1
+            snap = _Snapshot(self.docs.get(ref.id))
+            snap.id = ref.id
+            yield snap
+    def batch(self):
+        db = self
+        class _Batch:
+            def __init__(self):
+                self.refs = []
+                self.writes = []
+            def delete(self, ref):
+                self.refs.append(ref)
+            def set(self, ref, data):
+                self.writes.append(lambda: db.docs.__setitem__(ref.id, dict(data)))
+            def update(self, ref, fields):
+                self.writes.append(lambda: ref.update(fields))
+            def commit(self):
+                db.commits += 1
+                for write in self.writes:
+                    write()
+                for ref in self.refs:
+                    del db.docs[ref.id]
+        return _Batch()
+
+
+@pytest.fixture()
+def service(test_env):
+    with patch("google.cloud.firestore.Client", lambda *a, **k: None):
+        from backend.services.firestore_service import FirestoreService, ConversationCache
+        svc = FirestoreService()
+    svc.db = _DB()
+    svc.cache = ConversationCache(maxsize=2, ttl=60)
+    return svc
+
+
+def test_get_conversation_is_cached_until_written(service):
+    first = asyncio.run(service.get_conversation("c1"))
+    second = asyncio.run(service.get_conversation("c1"))
+    assert first is second
+    assert service.db.reads == 1
+
+    assert asyncio.run(service.star_conversation("c1", True))
+    third = asyncio.run(service.get_conversation("c1"))
+    assert third.starred is True
+    assert service.db.reads == 2
+
+
+def test_missing_conversation_is_not_cached(service):
+    assert asyncio.run(service.get_conversation("nope")) is None
+    assert asyncio.run(service.get_conversation("nope")) is None
+    assert service.db.reads == 2
+
+
+def test_conversation_cache_evicts_least_recently_used(test_env):
+    with patch("google.cloud.firestore.Client", lambda *a, **k: None):
+        from backend.services.firestore_service import ConversationCache
+    cache = ConversationCache(maxsize=2, ttl=60)
+    for cid in ("a", "b", "c"):
+        cache.set(cid, cid)
+    assert cache.get("a") is None
+    assert cache.get("c") == "c"
+
+    disabled = ConversationCache(maxsize=2, ttl=0)
+    disabled.set("a", "a")
+    assert disabled.get("a") is None
+
+
+def test_read_racing_a_write_is_not_cached(service):
+    original_get = _Doc.get
+
+    def racing_get(doc, field_paths=None):
+        snap = original_get(doc, field_paths)
+        # A write lands while the read is in flight
+        service.cache.invalidate(doc.doc_id)
+        return snap
+
+    with patch.object(_Doc, "get", racing_get):
+        asyncio.run(service.get_conversation("c1"))
+    asyncio.run(service.get_conversation("c1"))
+    assert service.db.reads == 2
+
+
+def test_bulk_delete_nonstarred_batches_and_invalidates(service):
+    now = datetime(2024, 1, 1)
+    for i in range(1001):
+        service.db.docs[f"n{i}"] = {"conversation_id": f"n{i}", "created_at": now, "last_updated": now}
+    service.db.docs["s"] = {"conversation_id": "s", "starred": True, "created_at": now, "last_updated": now}
+    asyncio.run(service.get_conversation("c1"))
+
+    assert asyncio.run(service.bulk_delete_nonstarred()) == 1002
+    assert service.db.commits == 3
+    assert list(service.db.docs) == ["s"]
+    assert asyncio.run(service.get_conversation("c1")) is None
+
+
+def test_list_conversations_filters_and_pages_in_query(service):
+    asyncio.run(service.list_conversations(10, starred=True, cursor="c1"))
+    ops = service.db.queries[-1]
+    assert [op for op, _ in ops] == ["order_by", "where", "start_after", "limit", "select"]
+    assert ops[1][1].field_path == "starred" and ops[1][1].value is True
+
+    # Offset paging is kept for callers without a cursor
+    asyncio.run(service.list_conversations(10, 20))
+    assert [op for op, _ in service.db.queries[-1]] == ["order_by", "offset", "limit", "select"]
+
+
+def test_list_unstarred_includes_conversations_without_the_field(service):
+    now = datetime(2024, 1, 1)
+    for doc_id, starred in (("a", False), ("b", True), ("legacy", None), ("c", False)):
+        data = {"conversation_id": doc_id, "created_at": now, "last_updated": now, "summary_version": 1}
+        if starred is not None:
+            data["starred"] = starred
+        snap = _Snapshot(data)
+        snap.id = doc_id
+        service.db.listed.append(snap)
+
+    page = asyncio.run(service.list_conversations(2, 1, starred=False))
+    # No equality filter: it would drop "legacy", which has no starred field
+    assert [op for op, _ in service.db.queries[-1]] == ["order_by", "select"]
+    assert [c.conversation_id for c in page] == ["legacy", "c"]
+
+
+def test_list_conversations_projects_summary_fields(service):
+    now = datetime(2024, 1, 1)
+    fresh = {"conversation_id": "c2", "title": "New", "created_at": now, "last_updated": now,
+             "starred": False, "message_count": 4, "last_message_preview": "latest",
+             "summary_version": 1}
+    for doc_id, data in (("c2", fresh), ("c1", {k: v for k, v in service.db.docs["c1"].items() if k != "messages"})):
+        snap = _Snapshot(data)
+        snap.id = doc_id
+        service.db.listed.append(snap)
+    service.db.docs["c1"]["messages"] = [{"content": "x" * 150}]
+
+    summaries = asyncio.run(service.list_conversations(10))
+    fields = dict(service.db.queries[-1])["select"]
+    assert "messages" not in fields
+    assert [s.conversation_id for s in summaries] == ["c2", "c1"]
+    assert (summaries[0].message_count, summaries[0].preview) == (4, "latest")
+    # Conversations written before the summary fields are read in full once
+    assert summaries[1].message_count == 1
+    assert summaries[1].preview == "x" * 100 + "..."
+    assert service.db.reads == 1
+
+
+def test_add_messages_is_one_update_without_existence_read(service):
+    user = Message(role=MessageRole.USER, content="hi")
+    ai = Message(role=MessageRole.AI, content="hello")
+
+    assert asyncio.run(service.add_message_to_conversation_with_grounding("c1", user, ai))
+    assert service.db.reads == 0
+    assert len(service.db.updates) == 1
+    doc_id, fields = service.db.updates[0]
+    assert [m["content"] for m in fields["messages"].values] == ["hi", "hello"]
+
+
+def test_full_conversation_overflows_into_subcollection(service):
+    service.db.docs["c1"]["messages"] = [
+        Message(role=MessageRole.USER, content="first", created_at=datetime(2024, 1, 1)).model_dump()
+    ]
+    service.db.full = True
+    user = Message(role=MessageRole.USER, content="hi", created_at=datetime(2024, 1, 2))
+    ai = Message(role=MessageRole.AI, content="hello", created_at=datetime(2024, 1, 3))
+
+    assert asyncio.run(service.append_messages("c1", [user, ai]))
+    assert service.db.docs["c1"]["messages_overflow"] is True
+    conversation = asyncio.run(service.get_conversation("c1"))
+    assert [m.content for m in conversation.messages] == ["first", "hi", "hello"]
+
+    # Later appends go straight to the subcollection instead of retrying the array
+    later = Message(role=MessageRole.USER, content="again", created_at=datetime(2024, 1, 4))
+    assert asyncio.run(service.append_messages("c1", [later]))
+    assert service.db.array_writes == 1
+    conversation = asyncio.run(service.get_conversation("c1"))
+    assert [m.content for m in conversation.messages] == ["first", "hi", "hello", "again"]
+
+    # Deleting the conversation removes its overflow messages too
+    assert asyncio.run(service.delete_conversation("c1"))
+    assert service.db.docs == {}
+
+
+def test_other_invalid_argument_does_not_overflow(service):
+    from google.api_core.exceptions import InvalidArgument
+    service.db.error = InvalidArgument("Property name is invalid")
+    user = Message(role=MessageRole.USER, content="hi", created_at=datetime(2024, 1, 2))
+
+    assert not asyncio.run(service.append_messages("c1", [user]))
+    assert "messages_overflow" not in service.db.docs["c1"]
+    assert not [key for key in service.db.docs if key.startswith("c1/")]
+
+
+def test_client_pool_round_robin(test_env, monkeypatch):
+    with patch("google.cloud.firestore.Client", lambda *a, **k: object()):
+        from backend.services.firestore_service import FirestoreService, settings
+        monkeypatch.setattr(settings, "firestore_pool_size", 3)
+        svc = FirestoreService()
+    handed_out = [svc.db for _ in range(6)]
+    assert len({id(c) for c in handed_out}) == 3
+    assert handed_out[:3] == handed_out[3:]
+
+
+def test_firestore_calls_run_off_the_event_loop(service, monkeypatch):
+    import threading
+    threads = []
+    original_get = _Doc.get
+
+    def _get(self):
+        threads.append(threading.get_ident())
+        return original_get(self)
+
+    monkeypatch.setattr(_Doc, "get", _get)
+    asyncio.run(service.get_conversation("c1"))
+    asyncio.run(service.rename_conversation("c1", "New"))
+    assert threads and threading.get_ident() not in threads
+
+
+def test_rename_skips_the_existence_read(service):
+    assert asyncio.run(service.rename_conversation("c1", "Renamed"))
+    assert not asyncio.run(service.rename_conversation("missing", "Renamed"))
+    assert service.db.reads == 0
+    assert service.db.docs["c1"]["title"] == "Renamed"
+
+
+def test_bulk_delete_keeps_conversations_whose_overflow_delete_failed(service, monkeypatch):
+    import sys
+    now = datetime(2024, 1, 1)
+    for conversation_id in ("o1", "o2"):
+        service.db.docs[conversation_id] = {"conversation_id": conversation_id, "created_at": now,
+                                            "last_updated": now, "messages_overflow": True}
+        service.db.docs[f"{conversation_id}/messages/m"] = {"content": "x"}
+
+    batch_factory = service.db.batch
+
+    def _batch():
+        batch = batch_factory()
+        commit = batch.commit
+        def _commit():
+            if any(ref.id.startswith("o2/") for ref in batch.refs):
+                raise RuntimeError("commit failed")
+            commit()
+        batch.commit = _commit
+        return batch
+
+    monkeypatch.setattr(service.db, "batch", _batch)
+    fs_module = sys.modules[type(service).__module__]
+    monkeypatch.setattr(fs_module, "BATCH_LIMIT", 1)
+
+    # c1 and o1 are deleted; o2 stays with its messages because their batch failed
+    assert asyncio.run(service.bulk_delete_nonstarred()) == 2
+    assert sorted(service.db.docs) == ["o2", "o2/messages/m"]
+
+
+def test_bulk_delete_bounds_concurrent_commits(service, monkeypatch):
+    import sys
+    import threading
+    import time
+    fs_module = sys.modules[type(service).__module__]
+    monkeypatch.setattr(fs_module, "BATCH_COMMIT_CONCURRENCY", 2)
+    now = datetime(2024, 1, 1)
+    for i in range(2500):
+        service.db.docs[f"n{i}"] = {"conversation_id": f"n{i}", "created_at": now, "last_updated": now}
+
+    lock = threading.Lock()
+    active = [0, 0]  # current, peak
+    batch_factory = service.db.batch
+
+    def _batch():
+        batch = batch_factory()
+        commit = batch.commit
+        def _commit():
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            time.sleep(0.02)
+            with lock:
+                commit()
+                active[0] -= 1
+        batch.commit = _commit
+        return batch
+
+    monkeypatch.setattr(service.db, "batch", _batch)
+    assert asyncio.run(service.bulk_delete_nonstarred()) == 2501
+    assert service.db.commits == 6
+    assert active[1] == 2
@@ -0,0 +1,152 @@
+import asyncio
+from types import SimpleNamespace
+
+
+class _Models:
+    def __init__(self):
+        self.calls = 0
+    def list(self):
+        self.calls += 1
+        return [
+            SimpleNamespace(name="models/gemini-2.5-pro", supported_actions=["generateContent"]),
+            SimpleNamespace(name="models/embedding-001", supported_actions=["embedContent"]),
+        ]
+
+
+def _service(monkeypatch, models):
+    from backend.services.gemini_service import GeminiService
+    svc = GeminiService()
+    monkeypatch.setattr(svc, "client", SimpleNamespace(models=models))
+    return svc
+
+
+def test_model_list_is_cached(monkeypatch):
+    models = _Models()
+    svc = _service(monkeypatch, models)
+
+    async def fetch_concurrently():
+        return await asyncio.gather(*(svc.get_available_models() for _ in range(5)))
+
+    results = asyncio.run(fetch_concurrently())
+    assert results[0] == [{"id": "models/gemini-2.5-pro", "name": "Gemini 2.5 Pro",
+                           "description": "Google Gemini 2.5 Pro model"}]
+    assert all(r == results[0] for r in results)
+    assert models.calls == 1
+
+
+def test_fallback_models_are_not_cached(monkeypatch):
+    class _Failing(_Models):
+        def list(self):
+            self.calls += 1
+            raise RuntimeError("unavailable")
+
+    models = _Failing()
+    svc = _service(monkeypatch, models)
+    first = asyncio.run(svc.get_available_models())
+    asyncio.run(svc.get_available_models())
+    assert first == svc._get_fallback_models()
+    assert models.calls == 2
+
+
+def test_extract_domain_matches_netloc():
+    from urllib.parse import urlparse
+    from backend.services.gemini_service import _extract_domain
+    for uri in ["https://a.com/x", "https://a.com", "https://a.com?q=1/2", "http://u@h:80#f"]:
+        assert _extract_domain(uri) == urlparse(uri).netloc
+    assert _extract_domain("not a url") == "Unknown"
+
+
+def test_inline_citations_follow_their_segments():
+    from backend.models import GroundingSupport
+    from backend.services.gemini_service import GeminiService
+    supports = [
+        GroundingSupport(start_index=6, end_index=11, text="world", reference_indices=[2]),
+        GroundingSupport(start_index=0, end_index=5, text="Hello", reference_indices=[1, 3]),
+        GroundingSupport(start_index=0, end_index=99, text="", reference_indices=[4]),
+    ]
+    text = GeminiService._insert_inline_citations(None, "Hello world!", supports)
+    assert text == "Hello[1][3] world[2]!"
+
+
+def test_generate_response_is_one_request(monkeypatch):
+    calls = []
+
+    async def generate_content(model, contents):
+        calls.append(contents)
+        return SimpleNamespace(text="answer")
+
+    svc = _service(monkeypatch, _Models())
+    svc.client.aio = SimpleNamespace(models=SimpleNamespace(generate_content=generate_content))
+    history = [{"role": "user", "content": str(i)} for i in range(12)]
+
+    assert asyncio.run(svc.generate_response("now", history)) == "answer"
+    assert calls == [[str(i) for i in range(2, 12)] + ["now"]]
+
+
+def test_grounding_metadata_is_parsed_into_references(monkeypatch):
+    from google.genai import types
+    response = types.GenerateContentResponse(candidates=[types.Candidate(
+        content=types.Content(role="model", parts=[types.Part(text="Paris is the capital.")]),
+        grounding_metadata=types.GroundingMetadata(
+            web_search_queries=["capital of france"],
+            grounding_chunks=[types.GroundingChunk(web=types.GroundingChunkWeb(uri="https://example.org/paris", title="Paris"))],
+            grounding_supports=[types.GroundingSupport(
+                segment=types.Segment(start_index=0, end_index=5, text="Paris"),
+                grounding_chunk_indices=[0],
+            )],
+        ),
+    )])
+
+    async def generate_content(model, contents, config):
+        return response
+
+    svc = _service(monkeypatch, _Models())
+    svc.client.aio = SimpleNamespace(models=SimpleNamespace(generate_content=generate_content))
+    text, references, queries, supports, _, grounded = asyncio.run(
+        svc.generate_response_with_grounding("capital?", enable_search=True)
+    )
+
+    assert grounded and queries == ["capital of france"]
+    assert [(r.id, r.title, r.domain) for r in references] == [(1, "Paris", "example.org")]
+    assert [(s.start_index, s.end_index, s.reference_indices) for s in supports] == [(0, 5, [1])]
+    assert text == "Paris[1] is the capital."
+
+
+def test_identical_prompts_reuse_the_answer_when_enabled(monkeypatch):
+    from backend.services.gemini_service import ResponseCache
+    calls = []
+
+    async def generate_content(model, contents):
+        calls.append(contents)
+        return SimpleNamespace(text="answer")
+
+    svc = _service(monkeypatch, _Models())
+    svc.client.aio = SimpleNamespace(models=SimpleNamespace(generate_content=generate_content))
+
+    # Off by default
+    asyncio.run(svc.generate_response("hi"))
+    asyncio.run(svc.generate_response("hi"))
+    assert len(calls) == 2
+
+    svc.responses = ResponseCache(maxsize=8, ttl=60)
+    assert asyncio.run(svc.generate_response("hi")) == "answer"
+    assert asyncio.run(svc.generate_response("hi")) == "answer"
+    asyncio.run(svc.generate_response("hi", [{"role": "user", "content": "earlier"}]))
+    assert len(calls) == 4
+
+
+def test_generate_batch_bounds_concurrency_and_keeps_order(monkeypatch):
+    svc = _service(monkeypatch, _Models())
+    active = [0, 0]  # current, peak
+
+    async def generate_response(message, conversation_history=None, model=None):
+        active[0] += 1
+        active[1] = max(active[1], active[0])
+        await asyncio.sleep(0.01)
+        active[0] -= 1
+        return message.upper()
+
+    monkeypatch.setattr(svc, "generate_response", generate_response)
+    results = asyncio.run(svc.generate_batch([f"m{i}" for i in range(10)], max_concurrency=3))
+    assert results == [f"M{i}" for i in range(10)]
+    assert active[1] == 3
@@ -38,6 +38,16 @@ def test_root_endpoint(client):
     assert data["docs"] == "/docs"
 
 
+def test_routes_registered_once():
+    """Each method/path pair is served by exactly one route"""
+    seen = set()
+    for route in app.routes:
+        for method in getattr(route, "methods", None) or ["*"]:
+            key = (method, route.path)
+            assert key not in seen, f"duplicate route {key}"
+            seen.add(key)
+
+
 @patch('backend.services.gemini_service.gemini_service')
 @patch('backend.services.firestore_service.firestore_service')
 def test_chat_endpoint_new_conversation(mock_firestore, mock_gemini, client):
@@ -1,59 +1,173 @@
+import asyncio
+import functools
+import orjson
+from datetime import datetime, timezone
 import pytest
 from backend.services.encryption_service import EncryptionService
 
 
-def _enc_body(payload: dict) -> dict:
-    key = EncryptionService.get_server_encryption_key()
-    return {"encrypted_data": EncryptionService.encrypt_data(payload, key)}
+@functools.lru_cache(maxsize=None)
+def _encrypt_items(items: tuple, key: str) -> str:
+    return EncryptionService.encrypt_data(dict(items), key)
+
+
+def _enc_body(payload: dict, key: str) -> dict:
+    # Flat payloads repeat across tests, so each distinct one is encrypted once
+    try:
+        encrypted = _encrypt_items(tuple(sorted(payload.items())), key)
+    except TypeError:  # nested lists/dicts are unhashable
+        encrypted = EncryptionService.encrypt_data(payload, key)
+    return {"encrypted_data": encrypted}
+
+
+def _dec(resp, key: str):
+    return EncryptionService.decrypt_data(orjson.loads(resp.content)["encrypted_data"], key)
+
+
+def _call(handler: str, **kwargs):
+    """Run a notes handler without the HTTP transport or response encryption; returns (status, body)"""
+    from backend.routers import notes as notes_router
+    from backend.services.auth_service import TokenData
+    resp = asyncio.run(getattr(notes_router, handler)(current_user=TokenData(username="tester"), **kwargs))
+    return resp.status_code, orjson.loads(resp.body)
+
+
+class DummySnapshot:
+    __slots__ = ("_d", "id", "exists")
+    def __init__(self, data, doc_id):
+        self._d = data
+        self.id = doc_id
+        self.exists = data is not None
+    def to_dict(self):
+        return self._d
 
 
 class DummyDoc:
+    __slots__ = ("store", "note_id")
     def __init__(self, store, note_id):
         self.store = store
         self.note_id = note_id
     def set(self, data):
         self.store[self.note_id] = data
     def update(self, updates):
-        self.store[self.note_id].update(updates)
-    def get(self):
-        class _R:
-            def __init__(self, d):
-                self._d = d
-                self.exists = d is not None
-            def to_dict(self):
-                return self._d
-        return _R(self.store.get(self.note_id))
+        from google.cloud import firestore
+        note = self.store[self.note_id]
+        for field, value in updates.items():
+            if value is firestore.DELETE_FIELD:
+                note.pop(field, None)
+            else:
+                note[field] = value
+    def get(self, field_paths=None):
+        data = self.store.get(self.note_id)
+        if data is not None and field_paths is not None:
+            data = {k: v for k, v in data.items() if k in field_paths}
+        return DummySnapshot(data, self.note_id)
     def delete(self):
         self.store.pop(self.note_id, None)
 
 
+class DummyQuery:
+    def __init__(self, store, field):
+        self.store = store
+        self.field = field
+        self._after = None
+        self._offset = 0
+        self._limit = None
+        self._fields = None
+    def select(self, fields):
+        self._fields = fields
+        return self
+    def start_after(self, snapshot):
+        self._after = snapshot.id
+        return self
+    def offset(self, n):
+        self._offset = n
+        return self
+    def limit(self, n):
+        self._limit = n
+        return self
+    def stream(self):
+        notes = list(self.store.values())
+        if self.field is not None:
+            # Like Firestore, ordering on a field leaves out documents without it
+            notes = sorted((n for n in notes if n.get(self.field) is not None),
+                           key=lambda n: n[self.field], reverse=True)
+        if self._after is not None:
+            ids = [n["note_id"] for n in notes]
+            notes = notes[ids.index(self._after) + 1:]
+        notes = notes[self._offset:]
+        if self._limit is not None:
+            notes = notes[:self._limit]
+        if self._fields is not None:
+            notes = [{k: v for k, v in n.items() if k in self._fields} for n in notes]
+        return iter([DummySnapshot(note, note["note_id"]) for note in notes])
+
+
+class DummyOwnerQuery:
+    __slots__ = ("store", "owner")
+    def __init__(self, store, owner):
+        self.store = store
+        self.owner = owner
+    def stream(self):
+        owner = self.owner
+        return (DummySnapshot(note, note.get("note_id")) for note in self.store.values()
+                if note.get("owner") == owner)
+
+
 class DummyCol:
+    __slots__ = ("store",)
     def __init__(self, store):
         self.store = store
     def document(self, note_id):
         return DummyDoc(self.store, note_id)
+    def order_by(self, field, direction=None):
+        return DummyQuery(self.store, field)
+    def select(self, fields):
+        return DummyQuery(self.store, None).select(fields)
+    def stream(self):
+        return DummyQuery(self.store, None).stream()
     def where(self, field, op, value):
-        class _Q:
-            def __init__(self, store, owner):
-                self.store = store
-                self.owner = owner
-            def stream(self):
-                for note in self.store.values():
-                    if note.get("owner") == self.owner:
-                        class _D:
-                            def __init__(self, data):
-                                self._d = data
-                            def to_dict(self):
-                                return self._d
-                        yield _D(note)
-        return _Q(self.store, value)
+        return DummyOwnerQuery(self.store, value)
+
+
+class DummyBatch:
+    def __init__(self):
+        self.ops = []
+        self.commits = 0
+    def set(self, ref, data):
+        self.ops.append(lambda: ref.set(data))
+    def update(self, ref, updates):
+        self.ops.append(lambda: ref.update(updates))
+    def delete(self, ref):
+        self.ops.append(ref.delete)
+    def commit(self):
+        self.commits += 1
+        for op in self.ops:
+            op()
 
 
 class DummyDB:
+    __slots__ = ("store", "batches")
     def __init__(self):
         self.store = {}
+        self.batches = []
     def collection(self, name):
         return DummyCol(self.store)
+    def batch(self):
+        self.batches.append(DummyBatch())
+        return self.batches[-1]
+    def get_all(self, refs):
+        for ref in reversed(refs):
+            yield ref.get()
+
+
+def _seed_note(fs, note_id: str, title: str, content: str) -> None:
+    """Store a note as create_note would, without a request round trip"""
+    from backend.routers.notes import _note_preview, _search_text
+    now = datetime.now(timezone.utc)
+    fs.db.store[note_id] = {"note_id": note_id, "title": title, "content": content,
+                            "preview": _note_preview(content), "search_text": _search_text(title, content),
+                            "created_at": now, "updated_at": now}
 
 
 @pytest.fixture(autouse=True)
@@ -64,16 +178,15 @@ def patch_notes_fs(monkeypatch):
             self.db = DummyDB()
     fs_inst = _FS()
     monkeypatch.setattr(notes_router, "get_fs", lambda: fs_inst)
-    yield
+    yield fs_inst
 
 
-def test_create_and_get_note(app_client):
+def test_create_and_get_note(app_client, server_key):
     # Create note
-    resp = app_client.post("/api/notes/", json=_enc_body({"title": "T1", "content": "Hello"}))
+    resp = app_client.post("/api/notes/", json=_enc_body({"title": "T1", "content": "Hello"}, server_key))
     assert resp.status_code == 201
-    body = resp.json()
     # Response is encrypted by middleware: decrypt
-    decrypted = EncryptionService.decrypt_data(body["encrypted_data"], EncryptionService.get_server_encryption_key())
+    decrypted = _dec(resp, server_key)
     assert decrypted["title"] == "T1"
     assert decrypted["content"] == "Hello"
     note_id = decrypted["note_id"]
@@ -81,63 +194,165 @@ def test_create_and_get_note(app_client):
     # Get note
     resp2 = app_client.get(f"/api/notes/{note_id}")
     assert resp2.status_code == 200
-    dec2 = EncryptionService.decrypt_data(resp2.json()["encrypted_data"], EncryptionService.get_server_encryption_key())
+    dec2 = _dec(resp2, server_key)
     assert dec2["title"] == "T1"
     assert dec2["content"] == "Hello"
 
 
-def test_list_and_update_and_delete_note(app_client):
-    # Create a note
-    r = app_client.post("/api/notes/", json=_enc_body({"title": "X", "content": "A"}))
-    note_id = EncryptionService.decrypt_data(r.json()["encrypted_data"], EncryptionService.get_server_encryption_key())["note_id"]
+def test_list_and_update_and_delete_note(patch_notes_fs):
+    # Handlers are called directly; test_create_and_get_note covers the create handler over HTTP
+    note_id = "n1"
+    _seed_note(patch_notes_fs, note_id, "X", "A")
 
     # List notes
-    rl = app_client.get("/api/notes/")
-    dec_list = EncryptionService.decrypt_data(rl.json()["encrypted_data"], EncryptionService.get_server_encryption_key())
-    assert isinstance(dec_list, list)
-    assert any(n["title"] == "X" for n in dec_list)
+    status, listed = _call("list_notes", q=None, page=None, page_size=None, cursor=None)
+    assert isinstance(listed, list)
+    assert any(n["title"] == "X" for n in listed)
 
     # Update title and content
-    ru = app_client.put(f"/api/notes/{note_id}", json=_enc_body({"title": "Y", "content": "B"}))
-    dec_u = EncryptionService.decrypt_data(ru.json()["encrypted_data"], EncryptionService.get_server_encryption_key())
-    assert dec_u["title"] == "Y"
-    assert dec_u["content"] == "B"
+    status, updated = _call("update_note", note_id=note_id, decrypted={"title": "Y", "content": "B"})
+    assert updated["title"] == "Y"
+    assert updated["content"] == "B"
 
     # Delete
-    rd = app_client.delete(f"/api/notes/{note_id}")
-    dec_d = EncryptionService.decrypt_data(rd.json()["encrypted_data"], EncryptionService.get_server_encryption_key())
-    assert dec_d["success"] is True
+    status, deleted = _call("delete_note", note_id=note_id)
+    assert deleted["success"] is True
 
 
-def test_search_notes_by_query(app_client):
-    # Create notes with distinct content
-    app_client.post("/api/notes/", json=_enc_body({"title": "Alpha note", "content": "First body"}))
-    app_client.post("/api/notes/", json=_enc_body({"title": "SearchTarget note", "content": "Contains special keyword"}))
+def test_search_notes_by_query(patch_notes_fs):
+    # Notes with distinct content
+    _seed_note(patch_notes_fs, "n1", "Alpha note", "First body")
+    _seed_note(patch_notes_fs, "n2", "SearchTarget note", "Contains special keyword")
 
     # Search using query parameter (backend-side filtering)
-    resp = app_client.get("/api/notes/?q=SearchTarget")
-    assert resp.status_code == 200
-    dec_list = EncryptionService.decrypt_data(resp.json()["encrypted_data"], EncryptionService.get_server_encryption_key())
+    status, found = _call("list_notes", q="SearchTarget", page=None, page_size=None, cursor=None)
+    assert status == 200
 
-    assert isinstance(dec_list, list)
-    assert any("searchtarget" in (n.get("title") or "").lower() or "searchtarget" in (n.get("content") or "").lower() for n in dec_list)
+    assert isinstance(found, list)
+    assert any("searchtarget" in (n.get("title") or "").lower() or "searchtarget" in (n.get("content") or "").lower() for n in found)
 
 
-def test_list_notes_pagination(app_client):
+def test_list_notes_pagination(app_client, server_key):
     # Create multiple notes
     for i in range(15):
-        app_client.post("/api/notes/", json=_enc_body({"title": f"Note {i}", "content": f"Body {i}"}))
+        app_client.post("/api/notes/", json=_enc_body({"title": f"Note {i}", "content": f"Body {i}"}, server_key))
 
     # First page: expect up to 12 notes
     r1 = app_client.get("/api/notes/?page=1&page_size=12")
     assert r1.status_code == 200
-    dec1 = EncryptionService.decrypt_data(r1.json()["encrypted_data"], EncryptionService.get_server_encryption_key())
+    dec1 = _dec(r1, server_key)
     assert isinstance(dec1, list)
     assert len(dec1) == 12
 
     # Second page: remaining notes (<= 3)
     r2 = app_client.get("/api/notes/?page=2&page_size=12")
     assert r2.status_code == 200
-    dec2 = EncryptionService.decrypt_data(r2.json()["encrypted_data"], EncryptionService.get_server_encryption_key())
+    dec2 = _dec(r2, server_key)
     assert isinstance(dec2, list)
     assert 0 < len(dec2) <= 3
+
+
+def test_list_notes_cursor_pagination(app_client, server_key):
+    for i in range(5):
+        app_client.post("/api/notes/", json=_enc_body({"title": f"Note {i}", "content": f"Body {i}"}, server_key))
+
+    r1 = app_client.get("/api/notes/?page_size=3&page=1")
+    first = _dec(r1, server_key)
+    assert len(first) == 3
+
+    r2 = app_client.get(f"/api/notes/?page_size=3&cursor={first[-1]['note_id']}")
+    second = _dec(r2, server_key)
+    assert len(second) == 2
+    assert not {n["note_id"] for n in first} & {n["note_id"] for n in second}
+
+
+def test_bulk_notes_single_commit(app_client, patch_notes_fs, server_key):
+    r = app_client.post("/api/notes/", json=_enc_body({"title": "Old", "content": "A"}, server_key))
+    old_id = _dec(r, server_key)["note_id"]
+
+    ops = [{"op": "create", "title": f"N{i}", "content": "x"} for i in range(3)]
+    ops.append({"op": "update", "note_id": old_id, "title": "Renamed"})
+    rb = app_client.post("/api/notes/bulk", json=_enc_body({"ops": ops}, server_key))
+    assert rb.status_code == 200
+    results = _dec(rb, server_key)["results"]
+    assert len(results) == 4
+    db = patch_notes_fs.db
+    assert len(db.batches) == 1 and db.batches[0].commits == 1
+    assert db.store[old_id]["title"] == "Renamed"
+
+    deletes = [{"op": "delete", "note_id": res["note_id"]} for res in results]
+    app_client.post("/api/notes/bulk", json=_enc_body({"ops": deletes}, server_key))
+    assert db.store == {}
+
+    too_many = [{"op": "delete", "note_id": "x"}] * 501
+    assert app_client.post("/api/notes/bulk", json=_enc_body({"ops": too_many}, server_key)).status_code == 400
+
+
+def test_get_many_notes(app_client, server_key):
+    ids = []
+    for i in range(3):
+        r = app_client.post("/api/notes/", json=_enc_body({"title": f"N{i}", "content": f"Body {i}"}, server_key))
+        ids.append(_dec(r, server_key)["note_id"])
+
+    wanted = [ids[2], "missing", ids[0], ids[2]]
+    resp = app_client.post("/api/notes/get_many", json=_enc_body({"note_ids": wanted}, server_key))
+    assert resp.status_code == 200
+    notes = _dec(resp, server_key)
+    assert [n["note_id"] for n in notes] == [ids[2], ids[0]]
+    assert notes[0]["content"] == "Body 2"
+
+
+def test_list_notes_projects_previews(app_client, patch_notes_fs, server_key):
+    app_client.post("/api/notes/", json=_enc_body({"title": "Long", "content": "x" * 500}, server_key))
+    # Stored before previews existed: no preview field
+    patch_notes_fs.db.store["legacy"] = {"note_id": "legacy", "title": "Old", "content": "Old body",
+                                         "created_at": datetime(2020, 1, 1, tzinfo=timezone.utc), "updated_at": datetime(2020, 1, 1, tzinfo=timezone.utc)}
+
+    resp = app_client.get("/api/notes/?page=1&page_size=10")
+    notes = _dec(resp, server_key)
+    assert [n["content"] for n in notes] == ["x" * 200, "Old body"]
+
+
+def test_search_uses_stored_text_and_legacy_content(app_client, patch_notes_fs, server_key):
+    r = app_client.post("/api/notes/", json=_enc_body({"title": "Fresh", "content": "Mentions ZEBRA here"}, server_key))
+    note_id = _dec(r, server_key)["note_id"]
+    store = patch_notes_fs.db.store
+    assert "zebra" in store[note_id]["search_text"]
+    patch_notes_fs.db.store["legacy"] = {"note_id": "legacy", "title": "Old", "content": "a zebra too",
+                                         "created_at": datetime(2020, 1, 1, tzinfo=timezone.utc), "updated_at": datetime(2020, 1, 1, tzinfo=timezone.utc)}
+
+    resp = app_client.get("/api/notes/?q=Zebra")
+    notes = _dec(resp, server_key)
+    assert {n["note_id"] for n in notes} == {note_id, "legacy"}
+
+    # A partial bulk update drops the stale text so search reads the content again
+    app_client.post("/api/notes/bulk", json=_enc_body({"ops": [{"op": "update", "note_id": note_id, "content": "plain"}]}, server_key))
+    assert "search_text" not in store[note_id]
+    resp = app_client.get("/api/notes/?q=zebra")
+    notes = _dec(resp, server_key)
+    assert [n["note_id"] for n in notes] == ["legacy"]
+
+
+def test_title_only_update_keeps_content_searchable(app_client, patch_notes_fs, server_key):
+    r = app_client.post("/api/notes/", json=_enc_body({"title": "Before", "content": "Walrus facts"}, server_key))
+    note_id = _dec(r, server_key)["note_id"]
+
+    app_client.put(f"/api/notes/{note_id}", json=_enc_body({"title": "After"}, server_key))
+    stored = patch_notes_fs.db.store[note_id]
+    assert stored["content"] == "Walrus facts"
+    assert stored["search_text"] == "after\nwalrus facts"
+
+
+def test_unpaged_list_keeps_notes_without_updated_at_last(patch_notes_fs):
+    _seed_note(patch_notes_fs, "n1", "Dated", "Body")
+    # Written outside the API: no updated_at, while the others carry aware Firestore timestamps
+    patch_notes_fs.db.store["undated"] = {"note_id": "undated", "title": "Undated", "content": "Old body",
+                                          "created_at": datetime(2020, 1, 1, tzinfo=timezone.utc)}
+
+    status, listed = _call("list_notes", q=None, page=None, page_size=None, cursor=None)
+    assert status == 200
+    assert [n["note_id"] for n in listed] == ["n1", "undated"]
+
+    # Server-side paging orders in Firestore, which skips it (see DEPLOYMENT.md)
+    status, paged = _call("list_notes", q=None, page=1, page_size=10, cursor=None)
+    assert [n["note_id"] for n in paged] == ["n1"]
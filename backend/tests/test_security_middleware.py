@@ -0,0 +1,71 @@
+import asyncio
+
+from backend.middleware import security_middleware
+from backend.middleware.security_middleware import SecurityMiddleware, ShardedRateLimiter
+
+
+async def _ok_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": b"{}"})
+
+
+def _call(path="/api/notes/", scheme="http"):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": path, "scheme": scheme, "client": ("1.2.3.4", 5000), "headers": []}
+    asyncio.run(SecurityMiddleware(_ok_app)(scope, receive, send))
+    return messages
+
+
+def test_security_headers_added():
+    headers = dict(_call(scheme="https")[0]["headers"])
+    assert headers[b"x-frame-options"] == b"DENY"
+    assert b"strict-transport-security" in headers
+    assert b"cdn.jsdelivr.net" in dict(_call(path="/docs")[0]["headers"])[b"content-security-policy"]
+
+
+def test_rate_limited_requests_get_429(monkeypatch):
+    monkeypatch.setattr(security_middleware, "rate_limiter", ShardedRateLimiter(1))
+    monkeypatch.setattr(security_middleware, "RATE_LIMIT_RULES", (("/auth/", 2),))
+
+    statuses = [_call(path="/auth/login")[0]["status"] for _ in range(3)]
+
+    assert statuses == [200, 200, 429]
+    start, body = _call(path="/auth/login")
+    assert dict(start["headers"])[b"retry-after"] == b"60"
+    assert b"Rate limit exceeded" in body["body"]
+    # Other path segments have their own budget
+    assert _call(path="/api/notes/")[0]["status"] == 200
+
+
+def test_fast_routes_bypass_the_app():
+    async def failing_app(scope, receive, send):
+        raise AssertionError("fast route reached the app")
+
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    middleware = SecurityMiddleware(failing_app, fast_routes={"/health": lambda: b'{"status":"healthy"}'})
+    scope = {"type": "http", "method": "GET", "path": "/health", "scheme": "http", "client": None, "headers": []}
+    asyncio.run(middleware(scope, None, send))
+
+    start, body = messages
+    assert start["status"] == 200
+    assert dict(start["headers"])[b"x-content-type-options"] == b"nosniff"
+    assert body["body"] == b'{"status":"healthy"}'
+
+
+def test_rate_limiter_evicts_least_recent_key():
+    limiter = security_middleware.RateLimiter(max_keys=2)
+    for key in ("a", "b", "a", "c"):
+        limiter.is_allowed(key, 10)
+
+    assert list(limiter.requests) == ["a", "c"]